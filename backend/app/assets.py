@@ -0,0 +1,157 @@
+"""Статические файлы с отпечатком содержимого в имени и сжатием заранее
+
+При запуске каждый файл каталога читается один раз: имя получает хеш
+содержимого (favicon-32x32.3f2a9c1b.png), текстовые файлы сжимаются gzip
+и brotli. Такой URL меняется вместе с содержимым, поэтому браузер может
+хранить файл бессрочно и не перепроверять его при повторных визитах.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from typing import NamedTuple, Optional
+
+import brotli
+
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+# Файлы, в которых ссылки на другие файлы заменяются ссылками с отпечатком
+REWRITE = (".webmanifest", ".xml", ".svg", ".css", ".json")
+# Форматы, которые уже сжаты
+COMPRESSED = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".woff2")
+# Предпочтение кодировок при равном q
+ENCODINGS = ("br", "gzip")
+
+
+class Asset(NamedTuple):
+    name: str
+    url: str
+    media_type: str
+    etag: str
+    # Кодировка -> тело, "identity" - без сжатия
+    bodies: dict
+
+
+def fingerprint(name: str, content: bytes):
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    stem, ext = os.path.splitext(name)
+    return "{}.{}{}".format(stem, digest, ext), digest
+
+
+def accepted_encodings(header: Optional[str]):
+    """Кодировки из Accept-Encoding, кроме запрещенных q=0"""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, *params = [value.strip() for value in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class Assets:
+    def __init__(self, directory: str, prefix: str = "/static/"):
+        self.directory = directory
+        self.prefix = prefix
+        # Имя файла -> Asset и имя с отпечатком -> Asset
+        self.by_name = {}
+        self.by_url = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            files = {}
+            if os.path.isdir(self.directory):
+                for root, _, names in os.walk(self.directory):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        relative = os.path.relpath(path, self.directory)
+                        with open(path, "rb") as f:
+                            files[relative.replace(os.sep, "/")] = f.read()
+            # Сначала файлы без ссылок, чтобы отпечаток ссылки был уже известен
+            names = sorted(files, key=lambda name: name.endswith(REWRITE))
+            for name in names:
+                self._add(name, files[name])
+            self.loaded = True
+
+    def _add(self, name: str, content: bytes):
+        if name.endswith(REWRITE):
+            content = self._rewrite(content)
+        hashed, digest = fingerprint(name, content)
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or name.endswith(REWRITE):
+            media_type += "; charset=utf-8"
+        bodies = {"identity": content}
+        if not name.lower().endswith(COMPRESSED):
+            compressed = {
+                "br": brotli.compress(content, quality=11),
+                "gzip": gzip.compress(content, compresslevel=9, mtime=0),
+            }
+            # Сжатый вариант хранится, только если он меньше исходного
+            for encoding, body in compressed.items():
+                if len(body) < len(content):
+                    bodies[encoding] = body
+        asset = Asset(
+            name, self.prefix + hashed, media_type, '"{}"'.format(digest), bodies
+        )
+        self.by_name[name] = asset
+        self.by_url[hashed] = asset
+
+    def _rewrite(self, content: bytes):
+        """Ссылки /name и /static/name на известные файлы - с отпечатком"""
+        if not self.by_name:
+            return content
+        text = content.decode("utf-8")
+        names = "|".join(
+            re.escape(name) for name in sorted(self.by_name, key=len, reverse=True)
+        )
+        pattern = r"(?<![\w.-])(?:{})?/({})(?![\w.-])".format(
+            re.escape(self.prefix.rstrip("/")), names
+        )
+        text = re.sub(pattern, lambda match: self.by_name[match.group(1)].url, text)
+        return text.encode("utf-8")
+
+    def url(self, name: str):
+        """URL файла для шаблонов, неизвестный файл - без отпечатка"""
+        self.load()
+        asset = self.by_name.get(name)
+        return asset.url if asset else self.prefix + name
+
+    def find(self, path: str):
+        """(Asset, неизменяемый ли URL) по пути после префикса"""
+        self.load()
+        asset = self.by_url.get(path)
+        if asset is not None:
+            return asset, True
+        return self.by_name.get(path), False
+
+    def stats(self):
+        self.load()
+        assets = self.by_name.values()
+        return {
+            "files": len(self.by_name),
+            "bytes": sum(len(asset.bodies["identity"]) for asset in assets),
+            "compressed_bytes": sum(min(map(len, a.bodies.values())) for a in assets),
+        }
+
+
+def choose_encoding(asset: Asset, accept_encoding: Optional[str]):
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in ENCODINGS:
+        if encoding in asset.bodies and encoding in accepted:
+            return encoding
+    return "identity"
@@ -0,0 +1,80 @@
+"""Сессии домохозяйств и их кэш в памяти воркера
+
+Токен сессии приходит в cookie при каждом запросе htmx, поэтому
+домохозяйство по токену берется из кэша с TTL, а в БД идет только промах.
+В БД хранится хеш токена: утечка БД не дает войти в чужие списки.
+"""
+
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+def new_token():
+    return secrets.token_urlsafe(32)
+
+
+def token_hash(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionCache:
+    """LRU кэш: хеш токена -> id домохозяйства, None - сессии нет
+
+    Запись живет не дольше ttl и не дольше самой сессии. Отсутствующие
+    сессии кэшируются на negative_ttl, чтобы перебор токенов не нагружал БД.
+    Выход из сессии в другом воркере виден здесь не позже чем через ttl.
+    """
+
+    def __init__(self, ttl: float = 60, negative_ttl: float = 5, maxsize: int = 100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key: str):
+        """(найдено ли в кэше, id домохозяйства или None)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None and entry[1] > now:
+                self._sessions.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                del self._sessions[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: str, household_id, expires_in: float = None):
+        """Запись результата запроса в БД, expires_in - остаток жизни сессии"""
+        ttl = self.ttl if household_id is not None else self.negative_ttl
+        if expires_in is not None:
+            ttl = min(ttl, expires_in)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._sessions[key] = (household_id, time.monotonic() + ttl)
+            self._sessions.move_to_end(key)
+            if len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._sessions),
+            "maxsize": self.maxsize,
+        }
@@ -0,0 +1,130 @@
+"""Пересчет clear_name существующих продуктов по текущим правилам нормализации
+
+python -m app.backfill --batch-size 1000
+
+Продукты читаются пачками по id, измененные имена записываются одним
+executemany в короткой транзакции на пачку, так что таблица не блокируется
+надолго, а прерванный пересчет можно просто запустить заново.
+"""
+
+import argparse
+import asyncio
+import json
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import main
+from .main import Product, create_db_engine, data_version_path
+from .names import RULES_VERSION, clear
+from .versions import DataVersion
+
+product = Product.__table__
+
+UPDATE_CLEAR_NAME = (
+    update(product)
+    .where(product.c.id == bindparam("product_id"))
+    .values(clear_name=bindparam("new_clear_name"))
+)
+
+
+async def read_batch(engine, after_id: int, batch_size: int):
+    query = (
+        select(product.c.id, product.c.name, product.c.clear_name)
+        .where(product.c.id > after_id)
+        .order_by(product.c.id)
+        .limit(batch_size)
+    )
+    async with engine.connect() as connection:
+        return (await connection.execute(query)).all()
+
+
+async def write_batch(engine, changes: list):
+    """Запись пачки, при конфликте уникальности - по одной строке
+
+    Возвращает id продуктов, новое имя которых совпало с уже существующим.
+    """
+    try:
+        async with engine.begin() as connection:
+            await connection.execute(UPDATE_CLEAR_NAME, changes)
+        return []
+    except IntegrityError:
+        pass
+
+    conflicts = []
+    for change in changes:
+        try:
+            async with engine.begin() as connection:
+                await connection.execute(UPDATE_CLEAR_NAME, change)
+        except IntegrityError:
+            conflicts.append(change["product_id"])
+    return conflicts
+
+
+async def backfill(
+    engine, data_version: DataVersion, batch_size: int = 1000, pause: float = 0
+):
+    """Пересчет всех clear_name, pause - пауза между пачками для других записей
+
+    data_version - счетчик той же БД, что и engine: по нему воркеры
+    обновляют кэши.
+    """
+    # Без кэша: миллионы разовых имен вытеснили бы из него поисковые запросы
+    normalize = clear.__wrapped__
+    stats = {"rules_version": RULES_VERSION, "scanned": 0, "updated": 0}
+    conflicts = []
+    after_id = 0
+    while True:
+        rows = await read_batch(engine, after_id, batch_size)
+        if not rows:
+            break
+        after_id = rows[-1].id
+        stats["scanned"] += len(rows)
+
+        changes = []
+        for row in rows:
+            clear_name = normalize(row.name)
+            if clear_name != row.clear_name:
+                changes.append({"product_id": row.id, "new_clear_name": clear_name})
+        if changes:
+            batch_conflicts = await write_batch(engine, changes)
+            conflicts.extend(batch_conflicts)
+            stats["updated"] += len(changes) - len(batch_conflicts)
+            # Воркеры приложения обновят кэши только по этим продуктам
+            skipped = set(batch_conflicts)
+            updated = [
+                change["product_id"]
+                for change in changes
+                if change["product_id"] not in skipped
+            ]
+            if updated:
+                data_version.bump(*updated)
+        if pause:
+            await asyncio.sleep(pause)
+
+    stats["conflicts"] = conflicts
+    return stats
+
+
+async def run(args):
+    engine = create_db_engine(args.database_url)
+    data_version = DataVersion(data_version_path(args.database_url))
+    try:
+        return await backfill(engine, data_version, args.batch_size, args.pause)
+    finally:
+        data_version.close()
+        await engine.dispose()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=main.DATABASE_URL)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0, help="секунды")
+    args = parser.parse_args()
+    stats = asyncio.run(run(args))
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,108 @@
+"""Отмена запросов, результат которых уже никто не прочитает
+
+Поиск отправляет запрос на каждое нажатие клавиши, а клиент отменяет
+предыдущие. Запрос отменяется, когда клиент отключился или от того же
+клиента пришел новый запрос с тем же ключом. Выполняющийся запрос SQLite
+прерывается обработчиком прогресса, рендеринг пропускается.
+"""
+
+import asyncio
+import contextlib
+import threading
+
+# Обработчик прогресса вызывается каждые PROGRESS_OPCODES инструкций VM SQLite
+PROGRESS_OPCODES = 1000
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Token:
+    """Признак отмены одного запроса, вызов - для обработчика прогресса"""
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+
+    def __call__(self):
+        return self.cancelled
+
+    def cancel(self, reason: str):
+        if not self.cancelled:
+            self.reason = reason
+            self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+
+class Canceller:
+    def __init__(self):
+        # Ключ клиента -> токен его последнего запроса
+        self.active = {}
+        self.counters = {
+            "superseded": 0,
+            "disconnected": 0,
+            "interrupted": 0,
+            "skipped_renders": 0,
+        }
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.active)
+
+    def start(self, key=None):
+        """Токен нового запроса, предыдущий запрос с тем же ключом отменяется"""
+        token = Token()
+        if key is None:
+            return token
+        with self.lock:
+            previous = self.active.get(key)
+            self.active[key] = token
+        if previous is not None and not previous.cancelled:
+            previous.cancel("superseded")
+        return token
+
+    def finish(self, key, token: Token):
+        with self.lock:
+            if self.active.get(key) is token:
+                del self.active[key]
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        return {**self.counters, "active": len(self.active)}
+
+
+async def watch_disconnect(receive, token: Token):
+    """Отмена токена при отключении клиента, задача снимается по окончании"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            token.cancel("disconnected")
+            return
+
+
+@contextlib.asynccontextmanager
+async def interruptible(session, token: Token, receive=None):
+    """Запросы сессии и ожидание в блоке прерываются при отмене токена
+
+    Обработчик прогресса ставится на соединение только на время блока,
+    поэтому запросы других сессий из пула не затрагивает.
+    """
+    connection = await (await session.connection()).get_raw_connection()
+    driver = connection.driver_connection
+    await driver.set_progress_handler(token, PROGRESS_OPCODES)
+    watcher = None
+    if receive is not None:
+        watcher = asyncio.create_task(watch_disconnect(receive, token))
+    try:
+        yield token
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await driver.set_progress_handler(None, 0)
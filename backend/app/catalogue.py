@@ -0,0 +1,99 @@
+"""Импорт и экспорт каталога продуктов в CSV или JSON Lines
+
+python -m app.catalogue import products.csv
+python -m app.catalogue export products.jsonl
+python -m app.catalogue export - --format csv > products.csv
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import main, migrations
+from .formats import iter_lines, read_rows
+from .versions import ALL, DataVersion
+
+READ_SIZE = 64 * 1024
+
+
+def file_format(path: str, format: str = None):
+    if format:
+        return format
+    return "jsonl" if os.path.splitext(path)[1] in (".jsonl", ".ndjson") else "csv"
+
+
+async def read_file(f):
+    """Поток байтов файла кусками, как тело запроса"""
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def run_import(
+    engine, data_version: DataVersion, path: str, format: str, household_id: int
+):
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        rows = read_rows(iter_lines(read_file(f)), format)
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            stats = await main.import_products(session, rows, household_id)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+    if stats["inserted"]:
+        data_version.bump(ALL)
+    return stats
+
+
+async def run_export(engine, path: str, format: str, household_id: int):
+    f = sys.stdout if path == "-" else open(path, "w", encoding="utf-8", newline="")
+    try:
+        async for chunk in main.export_products(engine, format, household_id):
+            f.write(chunk)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+async def run(args):
+    engine = main.create_db_engine(args.database_url)
+    try:
+        format = file_format(args.path, args.format)
+        if args.command == "import":
+            # Новая установка: таблиц еще нет
+            async with engine.connect() as connection:
+                await connection.run_sync(migrations.upgrade)
+            # Счетчик той же БД: по нему воркеры сбросят кэши
+            data_version = DataVersion(main.data_version_path(args.database_url))
+            try:
+                return await run_import(
+                    engine, data_version, args.path, format, args.household
+                )
+            finally:
+                data_version.close()
+        await run_export(engine, args.path, format, args.household)
+    finally:
+        await engine.dispose()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", help="файл, - для stdin/stdout")
+    parser.add_argument("--format", choices=["csv", "jsonl"])
+    parser.add_argument("--household", type=int, default=main.DEFAULT_HOUSEHOLD)
+    parser.add_argument("--database-url", default=main.DATABASE_URL)
+    args = parser.parse_args()
+    stats = asyncio.run(run(args))
+    if stats:
+        print(json.dumps(stats, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    cli()
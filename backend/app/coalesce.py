@@ -0,0 +1,60 @@
+import threading
+
+
+class ToggleCoalescer:
+    """Отложенные переключения продуктов в списке покупок
+
+    За окно между сбросами от переключений продукта остается только
+    последнее состояние: нажатия "нужен" и "не нужен" подряд не доходят
+    до БД вовсе, а все итоговые состояния записываются одной транзакцией.
+
+    Состояние хранится с версией переключения: нажатия одного пользователя
+    попадают в разные воркеры, и при записи побеждает более позднее.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        # Взятые на запись, но еще не записанные состояния
+        self.flushing = {}
+        self.toggles = 0
+        self.flushed = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def set(self, product_id: int, needed: bool, version: int):
+        with self.lock:
+            self.pending[product_id] = (needed, version)
+            self.toggles += 1
+
+    def state(self, product_id: int):
+        """Еще не записанное состояние продукта: True, False или None"""
+        state = self.pending.get(product_id)
+        if state is None:
+            state = self.flushing.get(product_id)
+        return state[0] if state is not None else None
+
+    def take(self):
+        """Итоговые (состояние, версия) для записи, буфер очищается"""
+        with self.lock:
+            self.flushing, self.pending = self.pending, {}
+            return self.flushing
+
+    def done(self):
+        with self.lock:
+            self.flushed += len(self.flushing)
+            self.flushing = {}
+
+    def restore(self):
+        """Возврат состояний после неудачной записи, новые переключения важнее"""
+        with self.lock:
+            self.pending = {**self.flushing, **self.pending}
+            self.flushing = {}
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "toggles": self.toggles,
+            "flushed": self.flushed,
+        }
@@ -0,0 +1,58 @@
+"""Отложенная запись строк в таблицу пачками вне обработки запроса"""
+
+import threading
+from collections import deque
+
+from sqlalchemy import insert
+
+
+class WriteBehind:
+    """Буфер строк таблицы, сбрасываемый в БД одним INSERT на пачку
+
+    При переполнении буфера (БД недоступна дольше, чем он вмещает)
+    отбрасываются самые старые строки, запрос при этом не ждет БД.
+    """
+
+    def __init__(self, table, max_pending: int = 10000):
+        self.table = table
+        self.pending = deque(maxlen=max_pending)
+        self.written = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, **row):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(row)
+
+    async def flush(self, engine):
+        """Запись накопленных строк, при ошибке они возвращаются в буфер"""
+        with self.lock:
+            rows = list(self.pending)
+            self.pending.clear()
+        if not rows:
+            return 0
+
+        try:
+            async with engine.begin() as connection:
+                await connection.execute(insert(self.table), rows)
+        except Exception:
+            with self.lock:
+                free = self.pending.maxlen - len(self.pending)
+                self.dropped += max(len(rows) - free, 0)
+                if free:
+                    self.pending.extendleft(reversed(rows[-free:]))
+            raise
+        self.written += len(rows)
+        return len(rows)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
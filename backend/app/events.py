@@ -0,0 +1,75 @@
+import asyncio
+from typing import Hashable, Optional, Tuple
+
+# Событие для отставшего подписчика: пропущенные события отброшены,
+# клиенту нужно перечитать список целиком
+RELOAD = ("reload", "")
+
+
+class Subscription:
+    def __init__(self, queue_size: int, topic: Hashable = None):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.topic = topic
+
+    async def get(self, timeout: float) -> Optional[Tuple[str, str]]:
+        """Следующее событие или None, если за timeout событий не было"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broadcaster:
+    """Рассылка событий подписчикам внутри процесса
+
+    У каждого подписчика ограниченная очередь. Если подписчик не успевает
+    читать и очередь заполнена, его события заменяются одним RELOAD, так что
+    медленный клиент не занимает память больше queue_size событий.
+
+    Подписчик получает только события своей темы, например, своего
+    домохозяйства.
+    """
+
+    def __init__(self, queue_size: int = 32, max_subscribers: int = 500):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.lagged = 0
+        self.size = 0
+        # Тема -> подписчики
+        self._subscribers = {}
+
+    def __len__(self):
+        return self.size
+
+    def subscribe(self, topic: Hashable = None) -> Optional[Subscription]:
+        """Новый подписчик или None, если достигнут лимит подписчиков"""
+        if self.size >= self.max_subscribers:
+            return None
+        subscription = Subscription(self.queue_size, topic)
+        self._subscribers.setdefault(topic, set()).add(subscription)
+        self.size += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.topic, set())
+        if subscription in subscribers:
+            subscribers.remove(subscription)
+            self.size -= 1
+            if not subscribers:
+                del self._subscribers[subscription.topic]
+
+    def publish(self, event: str, data: str, topic: Hashable = None):
+        for subscription in self._subscribers.get(topic, ()):
+            try:
+                subscription.queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self.lagged += 1
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(RELOAD)
+
+
+def format_sse(event: str, data: str):
+    """Сообщение в формате text/event-stream"""
+    lines = "".join("data: {}\n".format(line) for line in data.splitlines() or [""])
+    return "event: {}\n{}\n".format(event, lines)
@@ -0,0 +1,80 @@
+"""Чтение и запись каталога продуктов в CSV и JSON Lines построчно
+
+Строки разбираются и форматируются по одной, поэтому размер файла на
+потребление памяти не влияет. В CSV одна запись - одна строка файла.
+"""
+
+import codecs
+import csv
+import io
+import json
+
+MEDIA_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+FIELDS = ("name", "category")
+
+
+def detect_format(content_type: str):
+    """Формат по Content-Type, по умолчанию CSV"""
+    media_type = (content_type or "").split(";")[0].strip()
+    for format, known in MEDIA_TYPES.items():
+        if media_type == known:
+            return format
+    if media_type in ("application/jsonl", "application/json"):
+        return "jsonl"
+    return "csv"
+
+
+async def iter_lines(chunks, encoding: str = "utf-8"):
+    """Строки текста из асинхронного потока байтов"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tail = ""
+    async for chunk in chunks:
+        *lines, tail = (tail + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            yield line + "\n"
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def read_rows(lines, format: str):
+    """Записи {name, category} из строк CSV с заголовком или JSON Lines
+
+    Строки, которые не удалось разобрать, пропускаются с None вместо записи.
+    """
+    header = None
+    async for line in lines:
+        if not line.strip():
+            continue
+        if format == "jsonl":
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+            continue
+
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [value.strip().lstrip("\ufeff").lower() for value in values]
+            if "name" not in header:
+                # Файл без заголовка: в первой колонке названия
+                header = list(FIELDS[: len(values)])
+                yield dict(zip(header, values))
+            continue
+        yield dict(zip(header, values))
+
+
+def format_header(format: str):
+    return ",".join(FIELDS) + "\n" if format == "csv" else ""
+
+
+def format_row(name: str, category: str, format: str):
+    """Строка файла для продукта, category - название категории или None"""
+    if format == "jsonl":
+        row = {"name": name, "category": category}
+        return json.dumps(row, ensure_ascii=False) + "\n"
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow((name, category or ""))
+    return buffer.getvalue()
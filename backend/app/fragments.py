@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from jinja2 import Environment
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU кэш отрендеренных фрагментов шаблонов
+
+    Ключ фрагмента - (шаблон, id строки, версия строки). Версия увеличивается
+    методом bump() при изменении строки, после чего старый фрагмент больше не
+    запрашивается и со временем вытесняется. Потоковые ответы рендерят
+    фрагменты в пуле потоков, поэтому доступ к кэшу под блокировкой.
+    """
+
+    def __init__(self, env: Environment, maxsize: int = 4096):
+        self.env = env
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, row: Hashable):
+        return self._versions.get(row, 0)
+
+    def bump(self, row: Hashable):
+        """Инвалидация всех фрагментов строки"""
+        self._versions[row] = self.version(row) + 1
+
+    def render(self, template: str, row_id: Hashable, version: int, **context):
+        key = (template, row_id, version)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = Markup(self.env.get_template(template).render(context))
+        with self._lock:
+            self._fragments[key] = fragment
+            if len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def invalidate(self):
+        """Инвалидация всех фрагментов, счетчики сохраняются"""
+        with self._lock:
+            self._fragments.clear()
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self._versions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._fragments),
+            "maxsize": self.maxsize,
+        }
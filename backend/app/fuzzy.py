@@ -0,0 +1,283 @@
+"""Нечеткий поиск продуктов по clear_name с опечатками
+
+Слова названий хранятся в BK-дереве по расстоянию Левенштейна, поиск
+слов в радиусе d обходит только ветви, совместимые с неравенством
+треугольника. Результаты упорядочиваются: точное совпадение, префикс,
+подстрока, нечеткое совпадение - и выбираются через кучу без сортировки
+всех кандидатов.
+"""
+
+import heapq
+import threading
+from collections import defaultdict
+
+EXACT, PREFIX, SUBSTRING, FUZZY = range(4)
+
+
+def levenshtein(a: str, b: str, limit: int = None):
+    """Расстояние Левенштейна, больше limit - сразу limit + 1"""
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def max_distance(word: str):
+    """Допустимое число опечаток в слове запроса"""
+    if len(word) < 3:
+        return 0
+    if len(word) < 5:
+        return 1
+    return 2
+
+
+class BKTree:
+    def __init__(self):
+        # Узел: [слово, {расстояние: дочерний узел}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = [word, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word: str, radius: int):
+        """Слова в радиусе radius: [(слово, расстояние)]"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            distance = levenshtein(word, node_word)
+            if distance <= radius:
+                found.append((node_word, distance))
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class FuzzyIndex:
+    """Словарь слов названий продуктов, обновляется по одному продукту
+
+    Дерево слов общее, а продукты слова хранятся по домохозяйствам: поиск
+    не перебирает продукты чужих списков с тем же словом.
+
+    Из BK-дерева слова не удаляются: слово без продуктов пропускается при
+    поиске, а дерево пересобирается, когда таких слов становится больше
+    половины.
+
+    Полная загрузка строит новое дерево без блокировки (в пуле потоков),
+    изменения за это время запоминаются и повторяются перед заменой.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.households = {}
+        # (домохозяйство, слово) -> id продуктов
+        self.postings = defaultdict(set)
+        # Слово -> число домохозяйств, в продуктах которых оно есть
+        self.words = defaultdict(int)
+        self.tree = BKTree()
+        self.loaded = False
+        # (id, clear_name или None при удалении, домохозяйство) во время загрузки
+        self._pending = None
+        # Номер загрузки, invalidate() отменяет начатую
+        self._generation = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def loading(self):
+        return self._pending is not None
+
+    def load(self, rows):
+        """Замена содержимого на (id, clear_name, household_id) всех продуктов"""
+        self.finish_load(rows, self.start_load())
+
+    def start_load(self):
+        """Начало загрузки, возвращает ее номер для finish_load
+
+        Строки для загрузки читаются после вызова: изменение, сделанное
+        между чтением и заменой, повторится поверх прочитанного.
+        """
+        with self.lock:
+            self._generation += 1
+            self._pending = []
+            return self._generation
+
+    def finish_load(self, rows, generation: int):
+        """Построение словаря и замена содержимого, False - загрузка отменена"""
+        fresh = FuzzyIndex()
+        for product_id, clear_name, household_id in rows:
+            fresh._add(product_id, clear_name, household_id)
+        with self.lock:
+            if not self.loading or generation != self._generation:
+                return False
+            for product_id, clear_name, household_id in self._pending:
+                fresh._remove(product_id)
+                if clear_name is not None:
+                    fresh._add(product_id, clear_name, household_id)
+            self.names, self.households = fresh.names, fresh.households
+            self.postings, self.words = fresh.postings, fresh.words
+            self.tree = fresh.tree
+            self._pending = None
+            self.loaded = True
+            return True
+
+    def cancel_load(self, generation: int):
+        """Отмена загрузки, которая не будет завершена"""
+        with self.lock:
+            if generation == self._generation:
+                self._pending = None
+
+    def add(self, product_id: int, clear_name: str, household_id: int = 0):
+        """Добавление или переименование продукта"""
+        with self.lock:
+            if self.loading:
+                self._pending.append((product_id, clear_name, household_id))
+            if self.names.get(product_id) == clear_name:
+                return
+            self._remove(product_id)
+            self._add(product_id, clear_name, household_id)
+
+    def remove(self, product_id: int):
+        with self.lock:
+            if self.loading:
+                self._pending.append((product_id, None, None))
+            self._remove(product_id)
+            if len(self.tree) > 2 * len(self.words) + 1000:
+                self.tree = BKTree()
+                for word in self.words:
+                    self.tree.add(word)
+
+    def _add(self, product_id: int, clear_name: str, household_id: int):
+        self.names[product_id] = clear_name
+        self.households[product_id] = household_id
+        for word in clear_name.split():
+            ids = self.postings[household_id, word]
+            if not ids:
+                if word not in self.words:
+                    self.tree.add(word)
+                self.words[word] += 1
+            ids.add(product_id)
+
+    def _remove(self, product_id: int):
+        clear_name = self.names.pop(product_id, None)
+        if clear_name is None:
+            return
+        household_id = self.households.pop(product_id)
+        for word in clear_name.split():
+            ids = self.postings.get((household_id, word))
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self.postings[household_id, word]
+                    self.words[word] -= 1
+                    if not self.words[word]:
+                        del self.words[word]
+
+    def invalidate(self):
+        """Полное перечитывание при следующем поиске, начатая загрузка отменяется"""
+        with self.lock:
+            self.loaded = False
+            self._generation += 1
+            self._pending = None
+
+    def match(self, query: str, household_id: int = 0, limit: int = None):
+        """Продукты домохозяйства, у которых каждое слово запроса есть с опечатками
+
+        Возвращает {id продукта: сумма расстояний по словам запроса}, не
+        больше limit лучших по rank(): остальные не попадут в первые limit
+        результатов поиска.
+        """
+        words = query.split()
+        if not words or all(max_distance(word) == 0 for word in words):
+            return {}
+        with self.lock:
+            matched = None
+            for word in words:
+                distances = {}
+                for found, distance in self.tree.search(word, max_distance(word)):
+                    for product_id in self.postings.get((household_id, found), ()):
+                        if distance < distances.get(product_id, distance + 1):
+                            distances[product_id] = distance
+                if matched is None:
+                    matched = distances
+                else:
+                    matched = {
+                        product_id: total + distances[product_id]
+                        for product_id, total in matched.items()
+                        if product_id in distances
+                    }
+                if not matched:
+                    return {}
+            if limit is not None and len(matched) > limit:
+                best = heapq.nsmallest(
+                    limit,
+                    matched,
+                    key=lambda product_id: rank(
+                        query, self.names[product_id], matched[product_id]
+                    ),
+                )
+                matched = {product_id: matched[product_id] for product_id in best}
+        return matched
+
+
+def rank(query: str, clear_name: str, distance: int = None):
+    """Ключ сортировки результата поиска, меньше - выше"""
+    if clear_name == query:
+        tier = EXACT
+    elif clear_name.startswith(query):
+        tier = PREFIX
+    elif query in clear_name:
+        tier = SUBSTRING
+    else:
+        tier = FUZZY
+    if tier != FUZZY:
+        return tier, 0, 0, clear_name
+    # Среди опечаток выше меньше опечаток и меньше лишних слов
+    return tier, distance or 0, len(clear_name), clear_name
+
+
+def top_k(query: str, candidates, distances: dict, limit: int):
+    """id лучших limit кандидатов (id, clear_name) по порядку"""
+    keys = (
+        (*rank(query, clear_name, distances.get(product_id)), product_id)
+        for product_id, clear_name in candidates
+    )
+    return [key[-1] for key in heapq.nsmallest(limit, keys)]
@@ -1,40 +1,254 @@
+import asyncio
+import functools
+import hashlib
+import logging
 import os
-import re
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from urllib.parse import urlencode
 
-from fastapi import Depends, FastAPI, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
-from sqlmodel import Field, Relationship, SQLModel, Session, create_engine, select
+from jinja2 import FileSystemBytecodeCache
+from starlette.background import BackgroundTask
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    case,
+    delete,
+    event,
+    exists,
+    func,
+    insert,
+    literal_column,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Field, Relationship, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-DATABASE_URL = "sqlite:///./app.db"
-# FIX: Исправить работу с переменными БД и шаблонов
-#DATABASE_URL = os.getenv("DATABASE_URL")
+from .assets import Assets, choose_encoding
+from .auth import SessionCache, new_token, token_hash
+from .cancel import Cancelled, Canceller, interruptible
+from .coalesce import ToggleCoalescer
+from .eventlog import WriteBehind
+from .events import Broadcaster, format_sse
+from .formats import (
+    MEDIA_TYPES,
+    detect_format,
+    format_header,
+    format_row,
+    iter_lines,
+    read_rows,
+)
+from .fragments import FragmentCache
+from .fuzzy import FuzzyIndex, top_k
+from .metrics import Metrics, MetricsMiddleware, TimedTemplate, instrument_engine
+from .names import clear
+from .recommend import Recommender
+from .store import HttpStoreCatalogue, OfferCache, create_client
+from .versions import ALL, ChangeCursor, DataVersion
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+DATABASE_LOG_LEVEL = os.getenv("DATABASE_LOG_LEVEL", "WARNING")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+
+# Выполняются на каждом новом соединении с SQLite
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # Отрицательное значение - размер в KiB, а не в страницах
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),
+}
+
+PRODUCTS_PAGE_SIZE = int(os.getenv("PRODUCTS_PAGE_SIZE", "100"))
+# Размер кусков, которыми отдается потоковый HTML
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "8192"))
+# Домохозяйство запросов без cookie сессии, если авторизация не обязательна
+DEFAULT_HOUSEHOLD = 0
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "").lower() in ("1", "true", "yes")
+SESSION_COOKIE = "session"
+SESSION_DAYS = int(os.getenv("SESSION_DAYS", "180"))
+INVITE_HOURS = int(os.getenv("INVITE_HOURS", "24"))
+SESSION_CACHE_SECONDS = float(os.getenv("SESSION_CACHE_SECONDS", "60"))
+# Интернет-магазин для предложений к продуктам, пусто - выключен
+STORE_URL = os.getenv("STORE_URL", "")
+STORE_TIMEOUT = float(os.getenv("STORE_TIMEOUT", "5"))
+STORE_CONNECTIONS = int(os.getenv("STORE_CONNECTIONS", "20"))
+STORE_CACHE_SECONDS = float(os.getenv("STORE_CACHE_SECONDS", "3600"))
+STORE_STALE_SECONDS = float(os.getenv("STORE_STALE_SECONDS", "86400"))
+# Сколько ответ с предложениями ждет магазин, остальное догрузится в кэш
+STORE_WAIT_SECONDS = float(os.getenv("STORE_WAIT_SECONDS", "1"))
+# Каталог байткода шаблонов Jinja, общий для воркеров и перезапусков
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR")
+# Иконки и манифест, по умолчанию из каталога static репозитория
+STATIC_DIR = os.getenv(
+    "STATIC_DIR", os.path.join(BASE_DIR, os.pardir, os.pardir, "static", "static")
+)
+
+# Порог в секундах для лога медленных запросов с их SQL, пусто - выключен
+SLOW_REQUEST_SECONDS = os.getenv("SLOW_REQUEST_SECONDS")
+
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "32"))
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "500"))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", "15"))
+# Журнал покупок: сброс буфера событий в БД и пересчет сводки, секунды
+PURCHASE_FLUSH_SECONDS = float(os.getenv("PURCHASE_FLUSH_SECONDS", "1"))
+PURCHASE_ROLLUP_SECONDS = float(os.getenv("PURCHASE_ROLLUP_SECONDS", "60"))
+PURCHASE_LOG_SIZE = int(os.getenv("PURCHASE_LOG_SIZE", "10000"))
+# Окно, за которое переключения продукта в списке сводятся к одной записи
+TOGGLE_FLUSH_SECONDS = float(os.getenv("TOGGLE_FLUSH_SECONDS", "0.3"))
+# Импорт и экспорт каталога: продуктов в одной транзакции и в одной пачке чтения
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+# Рекомендации на пустом списке: сколько показывать, период полураспада веса
+# покупки в днях и перерыв между покупками одной корзины в секундах
+RECOMMENDATIONS = int(os.getenv("RECOMMENDATIONS", "10"))
+RECOMMEND_HALF_LIFE_DAYS = float(os.getenv("RECOMMEND_HALF_LIFE_DAYS", "30"))
+RECOMMEND_BASKET_GAP = float(os.getenv("RECOMMEND_BASKET_GAP", "7200"))
+
+# Асинхронные драйверы для синхронных URL из окружения
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url: str):
+    """URL БД с асинхронным драйвером"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def data_version_path(url: str):
+    """Файл счетчика версии данных рядом с файлом SQLite"""
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
+    ):
+        return url.database + ".version"
+    return None
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record, pragmas: dict):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def create_db_engine(url: str, pragmas: Optional[dict] = SQLITE_PRAGMAS, **kwargs):
+    """Асинхронный движок БД с настройками пула и PRAGMA для SQLite"""
+    url = async_database_url(url)
+    sqlite = url.get_backend_name() == "sqlite"
+    options = {}
+    if sqlite and url.database in (None, "", ":memory:"):
+        # In-memory БД живет, пока открыто соединение, пул из одного соединения
+        options["poolclass"] = StaticPool
+    elif "poolclass" not in kwargs:
+        options.update(
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_timeout=DATABASE_POOL_TIMEOUT,
+            pool_pre_ping=not sqlite,
+        )
+    options.update(kwargs)
+
+    engine = create_async_engine(url, **options)
+    instrument_engine(engine.sync_engine)
+    if sqlite and pragmas:
+        event.listen(
+            engine.sync_engine,
+            "connect",
+            functools.partial(set_sqlite_pragmas, pragmas=pragmas),
+        )
+    return engine
+
+
+logging.getLogger("sqlalchemy.engine").setLevel(DATABASE_LOG_LEVEL)
+logger = logging.getLogger("app")
+
+metrics = Metrics(float(SLOW_REQUEST_SECONDS) if SLOW_REQUEST_SECONDS else None)
 app = FastAPI()
-engine = create_engine(DATABASE_URL, echo=True)
-templates = Jinja2Templates(directory="templates")
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+engine = create_db_engine(DATABASE_URL)
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+templates.env.template_class = TimedTemplate
+# Скомпилированный шаблон берется из файла, если исходник не менялся
+templates.env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+assets = Assets(STATIC_DIR)
+templates.env.globals["static_url"] = assets.url
+data_version = DataVersion(
+    os.getenv("DATA_VERSION_PATH") or data_version_path(DATABASE_URL)
+)
+# Изменения других воркеров, уже примененные к кэшам этого процесса
+cache_cursor = ChangeCursor(data_version.get())
+broadcaster = Broadcaster(SSE_QUEUE_SIZE, SSE_MAX_SUBSCRIBERS)
+fragments = FragmentCache(
+    templates.env, maxsize=int(os.getenv("FRAGMENT_CACHE_SIZE", "4096"))
+)
+recommender = Recommender(
+    RECOMMENDATIONS, RECOMMEND_HALF_LIFE_DAYS, RECOMMEND_BASKET_GAP
+)
+fuzzy_index = FuzzyIndex()
+# Задача фоновой загрузки fuzzy_index
+fuzzy_loader = None
+toggles = ToggleCoalescer()
+canceller = Canceller()
+session_cache = SessionCache(SESSION_CACHE_SECONDS)
+store = None
+if STORE_URL:
+    store = OfferCache(
+        HttpStoreCatalogue(create_client(STORE_URL, STORE_TIMEOUT, STORE_CONNECTIONS)),
+        STORE_CACHE_SECONDS,
+        STORE_STALE_SECONDS,
+    )
 # TODO: Написать makefile
 
 
 # TODO: Написать unit-тесты
 # TODO: Написать end-to-end тесты
-# TODO: Отправлять с бэка событие обновить список если добавлен item
-# TODO: Добавить в очистку имени замену ё на е
 # TODO: Продумать индексы в таблицы
 # TODO: Сделать переходы между / и /products/
 # - [ ] Добавить тесты на GET /
 # - [ ] Добавить тесты на GET /products/
 
 # FEATURE: Категории
-# - [ ] Ограничить добавление товаров с одним названием + категорией
-# - [ ] Реализовать добавление категории к продукту
-# - [ ] Реализовать добавление категорий
-# - [ ] Добавить фильтрацию по категории
-# - [ ] Добавить на главную филтр по категориям
-# - [ ] Сделать сортировку по категории и имени
+# - [X] Ограничить добавление товаров с одним названием + категорией
+# - [X] Реализовать добавление категории к продукту
+# - [X] Реализовать добавление категорий
+# - [X] Добавить фильтрацию по категории
+# - [X] Добавить на главную филтр по категориям
+# - [X] Сделать сортировку по категории и имени
 # - [?] Сделать чтобы смайлки выделялись в отдельное поле
-# - [ ] Если выбран фильтр категории, то продукт добавляем в эту категорию
+# - [X] Если выбран фильтр категории, то продукт добавляем в эту категорию
 # FEATURE: Логирование покупок
 # FEATURE: Заготовки для добавления нескольких товаров (рецепт, мероприятие и пр.)
 # FEATURE: Отзывы о товарах
@@ -56,13 +270,53 @@ templates = Jinja2Templates(directory="templates")
 #
 
 
+class Household(SQLModel, table=True):
+    """Домохозяйство: свой каталог продуктов и свой список покупок"""
+
+    id: int = Field(default=None, primary_key=True)
+    name: str
+
+
+class HouseholdSession(SQLModel, table=True):
+    """Сессия устройства домохозяйства, токен хранится только хешем"""
+
+    __tablename__ = "household_session"
+
+    token_hash: str = Field(primary_key=True)
+    household_id: int = Field(foreign_key="household.id", index=True)
+    expires_at: datetime
+
+
+class HouseholdInvite(SQLModel, table=True):
+    """Приглашение в домохозяйство: по нему устройство получает свою сессию
+
+    Ссылка остается в истории браузера и журналах доступа, поэтому живет
+    INVITE_HOURS, а не как сессия.
+    """
+
+    __tablename__ = "household_invite"
+
+    token_hash: str = Field(primary_key=True)
+    household_id: int = Field(foreign_key="household.id", index=True)
+    expires_at: datetime
+
+
 class Category(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
+    household_id: int = Field(default=DEFAULT_HOUSEHOLD)
     name: str
 
 
+# Названия категорий уникальны в пределах домохозяйства
+Index("ix_category_household_name", Category.household_id, Category.name, unique=True)
+
+
+# Индексы продуктов и элементов начинаются с household_id: запрос любого
+# домохозяйства читает только свой диапазон индекса
 class Product(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
+    # DEFAULT_HOUSEHOLD - без авторизации, строки в household нет
+    household_id: int = Field(default=DEFAULT_HOUSEHOLD)
     name: str
     clear_name: str
     categoty_id: Optional[int] = Field(default=None, foreign_key="category.id")
@@ -72,27 +326,976 @@ class Product(SQLModel, table=True):
 
 class Item(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
+    # Копия household_id продукта: список читается без соединения с product
+    household_id: int = Field(default=DEFAULT_HOUSEHOLD)
     description: Optional[str]
-    product_id: int = Field(default=None, foreign_key="product.id")
+    # Продукт в списке не больше одного раза
+    product_id: int = Field(
+        default=None, foreign_key="product.id", index=True, unique=True
+    )
     product: Product = Relationship(back_populates="items")
 
 
+Index("ix_product_household_clear_name", Product.household_id, Product.clear_name)
+Index("ix_item_household_product", Item.household_id, Item.product_id)
+
+# Категория продукта для фильтрации и сортировки, 0 - без категории.
+# NULL в уникальном индексе не равен NULL, поэтому индекс по выражению:
+# он же запрещает одинаковые имена в одной категории и без категории.
+# 0 - литерал, а не параметр, иначе выражение в запросе не совпадет с индексом.
+product_category = func.coalesce(Product.categoty_id, literal_column("0"))
+Index(
+    "ix_product_household_category_clear_name",
+    Product.household_id,
+    product_category,
+    Product.clear_name,
+    unique=True,
+)
+
+
+class Preset(SQLModel, table=True):
+    """Заготовка: набор продуктов для добавления в список разом"""
+
+    id: int = Field(default=None, primary_key=True)
+    household_id: int = Field(default=DEFAULT_HOUSEHOLD, index=True)
+    name: str
+
+
+class PresetProduct(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    preset_id: int = Field(foreign_key="preset.id", index=True)
+    product_id: int = Field(foreign_key="product.id")
+    description: Optional[str] = None
+
+
+class ProductToggle(SQLModel, table=True):
+    """Версия последнего записанного переключения продукта в списке
+
+    Переключения из разных воркеров записываются каждым воркером в свое
+    время, запись с версией меньше уже записанной пропускается.
+    """
+
+    __tablename__ = "product_toggle"
+
+    product_id: int = Field(primary_key=True)
+    version: int
+
+
+class PurchaseEvent(SQLModel, table=True):
+    """Журнал списка покупок, только добавление строк
+
+    kind: add - в список, buy - куплен, remove - убран без покупки.
+    Без внешнего ключа: история остается после удаления продукта.
+    """
+
+    id: int = Field(default=None, primary_key=True)
+    # Корзины и популярность в рекомендациях - по домохозяйству
+    household_id: int = Field(default=DEFAULT_HOUSEHOLD)
+    product_id: int
+    kind: str
+    created_at: datetime
+
+
+class PurchaseStats(SQLModel, table=True):
+    """Сводка журнала по продукту, пересчитывается rollup_purchases"""
+
+    product_id: int = Field(primary_key=True)
+    adds: int = 0
+    purchases: int = 0
+    removes: int = 0
+    first_bought_at: Optional[datetime] = None
+    last_bought_at: Optional[datetime] = None
+    # Последнее учтенное событие журнала
+    last_event_id: int = Field(default=0, index=True)
+
+    @property
+    def interval_days(self):
+        """Средний интервал между покупками в днях"""
+        if self.purchases < 2:
+            return None
+        interval = self.last_bought_at - self.first_bought_at
+        return interval.total_seconds() / 86400 / (self.purchases - 1)
+
+
+purchase_log = WriteBehind(PurchaseEvent.__table__, PURCHASE_LOG_SIZE)
+
+
+#
+# Поисковый индекс
+#
+
+# Триграммный FTS5 индекс по Product.clear_name. Таблица external content,
+# синхронизируется с product триггерами, поэтому в SQLModel.metadata её нет.
+product_fts = Table(
+    "product_fts", MetaData(), Column("rowid", Integer), Column("clear_name", String)
+)
+
+PRODUCT_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+    "clear_name, content='product', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, clear_name) VALUES (new.id, new.clear_name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, clear_name) "
+    "VALUES ('delete', old.id, old.clear_name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF clear_name "
+    "ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, clear_name) "
+    "VALUES ('delete', old.id, old.clear_name); "
+    "INSERT INTO product_fts(rowid, clear_name) VALUES (new.id, new.clear_name); "
+    "END",
+)
+
+
+def create_search_index(connection):
+    """Создание FTS5 индекса продуктов, если SQLite его поддерживает
+
+    Существующий индекс перестраивается, если число строк в нем не
+    совпадает с product: например, продукты добавлены до триггеров.
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'")
+    ).first()
+    if not exists:
+        try:
+            for ddl in PRODUCT_FTS_DDL:
+                connection.execute(text(ddl))
+        except OperationalError:
+            # Сборка SQLite без FTS5 или без trigram токенизатора
+            return False
+    else:
+        # Индекс мог остаться без триггеров после прерванного создания
+        for ddl in PRODUCT_FTS_DDL[1:]:
+            connection.execute(text(ddl))
+    # product_fts_docsize - строка на каждый проиндексированный продукт
+    indexed, products = connection.execute(
+        text(
+            "SELECT (SELECT count(*) FROM product_fts_docsize), "
+            "(SELECT count(*) FROM product)"
+        )
+    ).one()
+    if not exists or indexed != products:
+        connection.execute(
+            text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+        )
+    return True
+
+
+@event.listens_for(Product.__table__, "after_create")
+def product_after_create(target, connection, **kw):
+    create_search_index(connection)
+
+
+async def has_search_index(session: AsyncSession):
+    """Есть ли FTS5 индекс в БД, результат кэшируется на соединении"""
+    connection = await session.connection()
+    if "product_fts" not in connection.info:
+        connection.info["product_fts"] = connection.dialect.name == "sqlite" and bool(
+            (
+                await connection.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'")
+                )
+            ).first()
+        )
+    return connection.info["product_fts"]
+
+
+async def search_filter(session: AsyncSession, clear_name: str):
+    """Условие поиска продуктов по подстроке в clear_name"""
+    # clear() оставляет только буквы, цифры и пробелы, экранировать % и _ не нужно
+    pattern = "%{}%".format(clear_name)
+    if await has_search_index(session):
+        ids = select(product_fts.c.rowid).where(product_fts.c.clear_name.like(pattern))
+        return Product.id.in_(ids)
+    return Product.clear_name.like(pattern)
+
+
+async def load_fuzzy_index(engine, generation: int):
+    """Чтение всех продуктов и построение словаря опечаток в пуле потоков"""
+    try:
+        query = select(Product.id, Product.clear_name, Product.household_id)
+        async with engine.connect() as connection:
+            rows = (await connection.execute(query)).all()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, fuzzy_index.finish_load, rows, generation)
+    except BaseException:
+        fuzzy_index.cancel_load(generation)
+        raise
+
+
+def start_fuzzy_loader(engine):
+    """Фоновая загрузка словаря опечаток, если он не загружен и не загружается"""
+    global fuzzy_loader
+    if fuzzy_index.loaded or fuzzy_index.loading:
+        return
+    fuzzy_loader = asyncio.ensure_future(
+        load_fuzzy_index(engine, fuzzy_index.start_load())
+    )
+
+
+def fuzzy_matches(session: AsyncSession, clear_name: str, household_id: int, limit):
+    """Продукты со словами запроса с опечатками: {id: число опечаток}
+
+    Словарь слов в памяти процесса читается из БД целиком в фоне, дальше
+    изменения вносятся по одному продукту. Пока он не загружен, поиск
+    идет только по подстроке: построение дерева на 100 тысяч продуктов
+    занимает секунды.
+    """
+    if not fuzzy_index.loaded:
+        start_fuzzy_loader(session.bind)
+        return {}
+    return fuzzy_index.match(clear_name, household_id, limit)
+
+
+async def search_products(
+    session: AsyncSession,
+    household_id: int,
+    name: str,
+    category_id: Optional[int],
+    limit: int,
+):
+    """id найденных продуктов по рангу: точное, префикс, подстрока, опечатки
+
+    Опечатки ранжируются после подстрок, поэтому словарь опечаток не
+    нужен, если подстрокой найдено не меньше limit продуктов.
+    """
+    clear_name = clear(name)
+    query = select(Product.id, Product.clear_name).where(
+        Product.household_id == household_id
+    )
+    if category_id is not None:
+        query = query.where(product_category == category_id)
+    condition = await search_filter(session, clear_name)
+    candidates = (await session.exec(query.where(condition))).all()
+    distances = {}
+    if len(candidates) < limit:
+        distances = fuzzy_matches(session, clear_name, household_id, limit)
+        found = {product_id for product_id, _ in candidates}
+        extra = [product_id for product_id in distances if product_id not in found]
+        if extra:
+            candidates += (await session.exec(query.where(Product.id.in_(extra)))).all()
+    return top_k(clear_name, candidates, distances, limit)
+
+
+#
+# Журнал покупок
+#
+
+
+def log_purchases(kind: str, household_id: int, *product_ids: int):
+    """Событие журнала, в БД его запишет purchase_worker"""
+    now = datetime.utcnow()
+    for product_id in product_ids:
+        purchase_log.add(
+            household_id=household_id, product_id=product_id, kind=kind, created_at=now
+        )
+
+
+async def rollup_purchases(engine):
+    """Добавление в сводку событий журнала после последнего учтенного
+
+    Один INSERT ... SELECT ... ON CONFLICT: чтение отметки, агрегация и
+    запись атомарны, параллельный rollup из другого воркера не учтет
+    события дважды.
+    """
+    event = PurchaseEvent
+    bought_at = case((event.kind == "buy", event.created_at))
+    watermark = select(
+        func.coalesce(func.max(PurchaseStats.last_event_id), 0)
+    ).scalar_subquery()
+    query = (
+        select(
+            event.product_id,
+            func.sum(event.kind == "add"),
+            func.sum(event.kind == "buy"),
+            func.sum(event.kind == "remove"),
+            func.min(bought_at),
+            func.max(bought_at),
+            func.max(event.id),
+        )
+        .where(event.id > watermark)
+        .group_by(event.product_id)
+    )
+    stats = PurchaseStats
+    statement = sqlite_insert(stats).from_select(
+        [
+            stats.product_id,
+            stats.adds,
+            stats.purchases,
+            stats.removes,
+            stats.first_bought_at,
+            stats.last_bought_at,
+            stats.last_event_id,
+        ],
+        query,
+    )
+    excluded = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[stats.product_id],
+        set_={
+            "adds": stats.adds + excluded.adds,
+            "purchases": stats.purchases + excluded.purchases,
+            "removes": stats.removes + excluded.removes,
+            "first_bought_at": func.coalesce(
+                stats.first_bought_at, excluded.first_bought_at
+            ),
+            "last_bought_at": func.coalesce(
+                excluded.last_bought_at, stats.last_bought_at
+            ),
+            "last_event_id": excluded.last_event_id,
+        },
+    )
+    async with engine.begin() as connection:
+        result = await connection.execute(statement)
+    return result.rowcount
+
+
+async def refresh_recommendations(engine, batch_size: int = 10000):
+    """Учет в рекомендациях покупок из журнала после уже учтенных
+
+    Журнал общий для всех воркеров, поэтому каждый видит все покупки.
+    """
+    touched = 0
+    while True:
+        query = (
+            select(
+                PurchaseEvent.id,
+                PurchaseEvent.household_id,
+                PurchaseEvent.product_id,
+                PurchaseEvent.created_at,
+            )
+            .where(
+                PurchaseEvent.id > recommender.last_event_id,
+                PurchaseEvent.kind == "buy",
+            )
+            .order_by(PurchaseEvent.id)
+            .limit(batch_size)
+        )
+        async with engine.connect() as connection:
+            rows = (await connection.execute(query)).all()
+        touched += recommender.update(
+            (
+                event_id,
+                household_id,
+                product_id,
+                created_at.replace(tzinfo=timezone.utc).timestamp(),
+            )
+            for event_id, household_id, product_id, created_at in rows
+        )
+        if len(rows) < batch_size:
+            break
+    if touched:
+        # Рекомендации на пустом списке изменились, ETag главной тоже
+        data_changed()
+    return touched
+
+
+async def purchase_worker():
+    """Периодический сброс журнала в БД, пересчет сводки и рекомендаций"""
+    loop = asyncio.get_running_loop()
+    next_rollup = loop.time() + PURCHASE_ROLLUP_SECONDS
+    while True:
+        try:
+            await refresh_recommendations(engine)
+        except OperationalError:
+            logger.exception("Recommendations refresh failed")
+        await asyncio.sleep(PURCHASE_FLUSH_SECONDS)
+        try:
+            await purchase_log.flush(engine)
+            if loop.time() >= next_rollup:
+                next_rollup = loop.time() + PURCHASE_ROLLUP_SECONDS
+                await rollup_purchases(engine)
+        except OperationalError:
+            # БД занята, попробуем в следующий раз
+            logger.exception("Purchase log flush failed")
+
+
+async def flush_toggles(engine):
+    """Запись накопленных переключений продуктов одной транзакцией"""
+    states = toggles.take()
+    if not states:
+        return
+    try:
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            # Опубликованные фрагменты не должны отставать от других воркеров
+            await sync_caches(session)
+            # Применяются только переключения новее записанных другими воркерами
+            query = sqlite_insert(ProductToggle).values(
+                [
+                    {"product_id": product_id, "version": version}
+                    for product_id, (_, version) in states.items()
+                ]
+            )
+            query = query.on_conflict_do_update(
+                index_elements=[ProductToggle.product_id],
+                set_={"version": query.excluded.version},
+                where=ProductToggle.version < query.excluded.version,
+            ).returning(ProductToggle.product_id)
+            applied = set((await session.execute(query)).scalars())
+            needed = [id for id in applied if states[id][0]]
+            removed = [id for id in applied if not states[id][0]]
+            removed_items = []
+            if removed:
+                query = select(Item.id, Item.product_id, Item.household_id).where(
+                    Item.product_id.in_(removed)
+                )
+                removed_items = (await session.exec(query)).all()
+                await session.execute(delete(Item).where(Item.product_id.in_(removed)))
+            added_ids = []
+            if needed:
+                # Продукт уже в списке - строка пропускается по уникальному индексу
+                products = select(Product.id, Product.household_id).where(
+                    Product.id.in_(needed)
+                )
+                query = (
+                    insert(Item.__table__)
+                    .prefix_with("OR IGNORE")
+                    .from_select(["product_id", "household_id"], products)
+                    .returning(Item.__table__.c.id)
+                )
+                added_ids = (await session.execute(query)).scalars().all()
+            await session.commit()
+
+            items = []
+            if added_ids:
+                query = (
+                    select(Item)
+                    .join(Item.product)
+                    .options(contains_eager(Item.product))
+                    .where(Item.id.in_(added_ids))
+                    .order_by(Product.clear_name)
+                )
+                items = (await session.exec(query)).all()
+    except BaseException:
+        toggles.restore()
+        raise
+    toggles.done()
+
+    changed = [item.product_id for item in items]
+    changed += [product_id for _, product_id, _ in removed_items]
+    if not changed:
+        return
+    data_changed(*changed)
+    for item in items:
+        log_purchases("add", item.household_id, item.product_id)
+    for _, product_id, household_id in removed_items:
+        log_purchases("remove", household_id, product_id)
+    for item_id, _, household_id in removed_items:
+        publish_item_removed(item_id, household_id)
+    if items:
+        publish_item_added(*items)
+
+
+async def toggle_worker():
+    """Периодическая запись переключений продуктов в списке"""
+    while True:
+        await asyncio.sleep(TOGGLE_FLUSH_SECONDS)
+        try:
+            await flush_toggles(engine)
+        except OperationalError:
+            # БД занята, состояния возвращены в буфер
+            logger.exception("Toggles flush failed")
+
+
+def load_templates():
+    """Компиляция всех шаблонов до первого запроса, из байткода - без разбора"""
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.get_template(name)
+
+
 @app.on_event("startup")
 async def startup():
-    SQLModel.metadata.create_all(engine)
+    # Миграции зависят от моделей этого модуля
+    from .migrations import check
 
+    # Отпечатки и сжатие статических файлов, шаблоны - до первого запроса
+    assets.load()
+    load_templates()
+    # Схему создает python -m app.migrations при развертывании
+    async with engine.connect() as connection:
+        await connection.run_sync(check)
+    start_fuzzy_loader(engine)
+    app.state.purchase_worker = asyncio.create_task(purchase_worker())
+    app.state.toggle_worker = asyncio.create_task(toggle_worker())
 
-def get_db():
-    session = Session(engine)
-    try:
+
+@app.on_event("shutdown")
+async def shutdown():
+    if fuzzy_loader is not None:
+        fuzzy_loader.cancel()
+    app.state.toggle_worker.cancel()
+    app.state.purchase_worker.cancel()
+    await flush_toggles(engine)
+    await purchase_log.flush(engine)
+    if store is not None:
+        await store.aclose()
+
+
+async def get_db():
+    # Без expire_on_commit, иначе обращение к атрибутам после commit
+    # потребует ленивой загрузки, которая в AsyncSession недоступна
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        await sync_caches(session)
         yield session
-    finally:
-        session.close()
 
 
-def clear(name: str):
-    """Очистка имени от смайликов и не нужных символов"""
-    return re.sub("[^A-Za-zА-Яа-я0-9 ]+", "", name).lower().strip()
+async def get_household(
+    request: Request, session: AsyncSession = Depends(get_db)
+) -> int:
+    """id домохозяйства по cookie сессии
+
+    Сессия берется из кэша воркера, в БД - только при промахе, поэтому
+    частые запросы htmx не платят за авторизацию запросом к БД. Без
+    AUTH_REQUIRED неизвестная cookie не мешает работать без домохозяйства.
+    """
+    token = request.cookies.get(SESSION_COOKIE)
+    if not token:
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        return DEFAULT_HOUSEHOLD
+
+    key = token_hash(token)
+    found, household_id = session_cache.get(key)
+    if not found:
+        query = select(
+            HouseholdSession.household_id, HouseholdSession.expires_at
+        ).where(
+            HouseholdSession.token_hash == key,
+            HouseholdSession.expires_at > datetime.utcnow(),
+        )
+        row = (await session.exec(query)).first()
+        if row is None:
+            session_cache.put(key, None)
+        else:
+            household_id, expires_at = row
+            expires_in = (expires_at - datetime.utcnow()).total_seconds()
+            session_cache.put(key, household_id, expires_in)
+    if household_id is None:
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="Session expired")
+        return DEFAULT_HOUSEHOLD
+    return household_id
+
+
+async def sync_caches(session: AsyncSession):
+    """Применение к кэшам процесса изменений, сделанных другими воркерами
+
+    Без изменений стоит одного чтения счетчика из общей памяти.
+    """
+    product_ids = cache_cursor.poll(data_version)
+    if product_ids is None:
+        # Изменения вытеснены из кольца или изменено все
+        fragments.invalidate()
+        fuzzy_index.invalidate()
+        return
+    if not product_ids:
+        return
+    product_ids = set(product_ids)
+    for product_id in product_ids:
+        fragments.bump(product_id)
+    # Во время загрузки изменения повторятся поверх прочитанных строк
+    if fuzzy_index.loaded or fuzzy_index.loading:
+        query = select(Product.id, Product.clear_name, Product.household_id).where(
+            Product.id.in_(product_ids)
+        )
+        names = {row[0]: row[1:] for row in await session.exec(query)}
+        for product_id in product_ids:
+            if product_id in names:
+                fuzzy_index.add(product_id, *names[product_id])
+            else:
+                fuzzy_index.remove(product_id)
+
+
+def is_htmx(request: Request):
+    """Запрос от htmx, которому достаточно фрагмента страницы"""
+    # При восстановлении истории htmx ожидает полную страницу
+    return (
+        request.headers.get("HX-Request") == "true"
+        and request.headers.get("HX-History-Restore-Request") != "true"
+    )
+
+
+def make_etag(request: Request, household_id: int = DEFAULT_HOUSEHOLD):
+    """ETag страницы из версии данных, параметров запроса и домохозяйства"""
+    key = "{}?{}|{}|{}".format(
+        request.url.path, request.url.query, is_htmx(request), household_id
+    )
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    return 'W/"{}-{}"'.format(data_version.get(), digest)
+
+
+def etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [
+        tag.strip() for tag in if_none_match.split(",")
+    ]
+
+
+def not_modified(request: Request, etag: str):
+    """Ответ 304, если у клиента актуальная версия страницы"""
+    if not etag_matches(request, etag):
+        return None
+    return Response(status_code=304, headers=cache_headers(etag))
+
+
+def cache_headers(etag: str):
+    # no-cache: браузер хранит страницу, но каждый раз проверяет ETag.
+    # private: страница своя у каждого домохозяйства
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "HX-Request"}
+
+
+def data_changed(*product_ids: int):
+    """Инвалидация кэшей после commit изменений продуктов или их элементов
+
+    Новые названия к этому моменту уже должны быть в fuzzy_index.
+    Возвращает новую версию данных, общую для всех воркеров.
+    """
+    for product_id in product_ids:
+        fragments.bump(product_id)
+    version = data_version.bump(*product_ids)
+    cache_cursor.seen(version, *product_ids)
+    return version
+
+
+def stream_template(name: str, context: dict, token=None):
+    """Потоковый рендеринг шаблона кусками не меньше STREAM_CHUNK_SIZE
+
+    После отмены token рендеринг останавливается на следующем куске.
+    """
+    buffer = []
+    size = 0
+    for chunk in templates.get_template(name).generate(context):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            if token is not None and token.cancelled:
+                canceller.count("skipped_renders")
+                return
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def render_products(
+    request: Request,
+    context: dict,
+    etag: Optional[str] = None,
+    token=None,
+    background: Optional[BackgroundTask] = None,
+):
+    """Страница поиска, список продуктов или его следующая страница для htmx"""
+    if not is_htmx(request):
+        template = "search.html"
+    elif context.get("page"):
+        template = "partials/products_page.html"
+    else:
+        template = "partials/products.html"
+    headers = {"Vary": "HX-Request"}
+    if etag:
+        headers.update(cache_headers(etag))
+    return StreamingResponse(
+        stream_template(template, context, token),
+        media_type="text/html",
+        headers=headers,
+        background=background,
+    )
+
+
+def search_client(request: Request):
+    """Ключ поиска клиента: новый запрос с тем же ключом отменяет предыдущий
+
+    Только запросы htmx от поля ввода, подгрузка страниц не отменяется.
+    Ключ - сессия и вкладка браузера: у телефонов одной сети и у всех
+    клиентов за прокси один адрес, поэтому адрес в ключ не входит.
+    """
+    trigger = request.headers.get("HX-Trigger")
+    tab = request.headers.get("X-Tab-Id")
+    if not is_htmx(request) or not trigger or not tab:
+        return None
+    return request.cookies.get(SESSION_COOKIE), tab, trigger
+
+
+async def products_page(
+    session: AsyncSession,
+    household_id: int,
+    name: str,
+    category_id: Optional[int] = None,
+    sort: Optional[str] = None,
+    after_category: Optional[int] = None,
+    after_name: Optional[str] = None,
+    after_id: Optional[int] = None,
+    offset: int = 0,
+):
+    """Страница продуктов по ключу сортировки и ссылка на следующую
+
+    Ключ - (clear_name, id) или (категория, clear_name, id) при sort=category.
+    """
+    if name:
+        return await search_page(session, household_id, name, category_id, offset)
+
+    query = (
+        select(Product, Item)
+        .join(Item, isouter=True)
+        .where(Product.household_id == household_id)
+    )
+    if category_id is not None:
+        query = query.where(product_category == category_id)
+
+    # С фильтром категория постоянна, SQLite не сортирует по ней без B-дерева
+    by_category = sort == "category" and category_id is None
+    keys = [Product.clear_name, Product.id]
+    cursor = [after_name or "", after_id]
+    if by_category:
+        keys.insert(0, product_category)
+        cursor.insert(0, after_category or 0)
+    if after_id is not None:
+        query = query.where(tuple_(*keys) > tuple_(*cursor))
+    query = query.order_by(*keys).limit(PRODUCTS_PAGE_SIZE + 1)
+    rows = (await session.exec(query)).all()
+
+    next_page = None
+    if len(rows) > PRODUCTS_PAGE_SIZE:
+        rows = rows[:PRODUCTS_PAGE_SIZE]
+        last, _ = rows[-1]
+        params = {"name": name, "after_name": last.clear_name, "after_id": last.id}
+        if category_id is not None:
+            params["category_id"] = category_id
+        if by_category:
+            params.update(sort=sort, after_category=last.categoty_id or 0)
+        next_page = "/products/?" + urlencode(params)
+    # Фрагменты рендерятся по мере отдачи ответа
+    products = (render_product(product, item) for product, item in rows)
+    return products, next_page, offers_url([product.id for product, _ in rows])
+
+
+async def search_page(
+    session: AsyncSession,
+    household_id: int,
+    name: str,
+    category_id: Optional[int],
+    offset: int,
+):
+    """Страница результатов поиска по рангу, страницы - по смещению"""
+    ranked = await search_products(
+        session, household_id, name, category_id, offset + PRODUCTS_PAGE_SIZE + 1
+    )
+    product_ids = ranked[offset : offset + PRODUCTS_PAGE_SIZE]
+    query = (
+        select(Product, Item)
+        .join(Item, isouter=True)
+        .where(Product.id.in_(product_ids))
+    )
+    rows = {product.id: (product, item) for product, item in await session.exec(query)}
+
+    next_page = None
+    if len(ranked) > offset + PRODUCTS_PAGE_SIZE:
+        params = {"name": name, "offset": offset + PRODUCTS_PAGE_SIZE}
+        if category_id is not None:
+            params["category_id"] = category_id
+        next_page = "/products/?" + urlencode(params)
+    products = (
+        render_product(*rows[product_id])
+        for product_id in product_ids
+        if product_id in rows
+    )
+    return products, next_page, offers_url(list(rows))
+
+
+def offers_url(product_ids: List[int]):
+    """Ссылка на предложения магазина для страницы, ее загрузит браузер
+
+    Страница не ждет магазин: предложения приходят отдельным запросом.
+    """
+    if store is None or not product_ids:
+        return None
+    return "/store/offers?" + urlencode({"product_id": product_ids}, doseq=True)
+
+
+async def recommended_products(
+    session: AsyncSession, household_id: int, product_ids: List[int]
+):
+    """Рекомендованные продукты по порядку, кроме уже добавленных в список
+
+    Не больше K выборок по первичному ключу, размер истории не важен.
+    Продукты других домохозяйств отбрасываются.
+    """
+    if not product_ids:
+        return []
+    query = (
+        select(Product)
+        .where(Product.id.in_(product_ids), Product.household_id == household_id)
+        .where(~exists().where(Item.product_id == Product.id))
+    )
+    products = {product.id: product for product in await session.exec(query)}
+    return [products[id] for id in product_ids if id in products]
+
+
+def render_product(product: Product, item: Optional[Item]):
+    """Фрагмент продукта, версия фрагмента меняется при изменении продукта
+
+    Еще не записанное переключение продукта важнее состояния из БД.
+    """
+    needed = toggles.state(product.id)
+    if needed is False:
+        item = None
+    elif needed and not item:
+        item = Item(product_id=product.id)
+    return fragments.render(
+        "partials/product.html",
+        (product.id, bool(item)),
+        fragments.version(product.id),
+        product=product,
+        item=item,
+    )
+
+
+def render_item(item: Item, oob: bool = False):
+    """Фрагмент элемента списка, версия общая с его продуктом
+
+    SQLite выдает id удаленного элемента повторно, поэтому продукт - в ключе.
+    """
+    return fragments.render(
+        "partials/item.html",
+        (item.id, item.product_id, oob),
+        fragments.version(item.product_id),
+        item=item,
+        oob=oob,
+    )
+
+
+def publish_item_added(*items: Item):
+    """События для подписчиков домохозяйств, которым добавлены элементы"""
+    households = {}
+    for item in items:
+        households.setdefault(item.household_id, []).append(item)
+    for household_id, household_items in households.items():
+        fragment = '<ul hx-swap-oob="beforeend:#items">{}</ul>'.format(
+            "".join(render_item(item) for item in household_items)
+        )
+        broadcaster.publish("items", fragment, household_id)
+
+
+def publish_item_updated(item: Item):
+    broadcaster.publish("items", render_item(item, oob=True), item.household_id)
+
+
+def publish_item_removed(item_id: int, household_id: int):
+    fragment = '<li id="item-{}" hx-swap-oob="delete"></li>'.format(item_id)
+    broadcaster.publish("items", fragment, household_id)
+
+
+#
+# Импорт и экспорт
+#
+
+
+async def category_id_by_name(
+    session: AsyncSession, name: str, household_id: int, cache: dict
+):
+    """id категории домохозяйства по названию, новая категория создается"""
+    if name not in cache:
+        await session.execute(
+            insert(Category)
+            .prefix_with("OR IGNORE")
+            .values(household_id=household_id, name=name)
+        )
+        query = select(Category.id).where(
+            Category.household_id == household_id, Category.name == name
+        )
+        cache[name] = (await session.exec(query)).one()
+    return cache[name]
+
+
+async def import_products(session: AsyncSession, rows, household_id: int):
+    """Добавление продуктов из потока записей {name, category} пачками
+
+    Дубли clear_name в категории, и в файле, и с уже существующими,
+    пропускает уникальный индекс (INSERT OR IGNORE), поэтому память
+    не зависит от размера файла.
+    """
+    # Без кэша: разовые имена вытеснили бы из него поисковые запросы
+    normalize = clear.__wrapped__
+    statement = insert(Product.__table__).prefix_with("OR IGNORE")
+    stats = {"read": 0, "inserted": 0, "invalid": 0}
+    categories = {}
+    chunk = []
+
+    async def write():
+        result = await session.execute(statement, chunk)
+        await session.commit()
+        stats["inserted"] += result.rowcount
+        chunk.clear()
+
+    async for row in rows:
+        stats["read"] += 1
+        name = row.get("name") if row else None
+        clear_name = normalize(name) if isinstance(name, str) else ""
+        if not clear_name:
+            stats["invalid"] += 1
+            continue
+        category = row.get("category")
+        category_id = None
+        if isinstance(category, str) and category.strip():
+            category_id = await category_id_by_name(
+                session, category.strip(), household_id, categories
+            )
+        chunk.append(
+            {
+                "household_id": household_id,
+                "name": name.strip(),
+                "clear_name": clear_name,
+                "categoty_id": category_id,
+            }
+        )
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await write()
+    if chunk:
+        await write()
+    await session.commit()
+    stats["skipped"] = stats["read"] - stats["inserted"] - stats["invalid"]
+    return stats
+
+
+async def export_products(engine, format: str, household_id: int):
+    """Строки файла каталога, продукты читаются серверным курсором пачками"""
+    query = (
+        select(Product.name, Category.name.label("category"))
+        .join(Category, isouter=True)
+        .where(Product.household_id == household_id)
+        .order_by(Product.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    yield format_header(format)
+    async with engine.connect() as connection:
+        result = await connection.stream(query)
+        async for rows in result.partitions():
+            yield "".join(format_row(name, category, format) for name, category in rows)
+
+
+async def own_category(session: AsyncSession, category_id: int, household_id: int):
+    """Категория домохозяйства, чужая категория - как несуществующая"""
+    category = await session.get(Category, category_id)
+    if not category or category.household_id != household_id:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return category
+
+
+async def own_product(
+    session: AsyncSession, product_id: int, household_id: int, options=()
+):
+    """Продукт домохозяйства, чужой продукт - как несуществующий"""
+    product = await session.get(Product, product_id, options=list(options))
+    if not product or product.household_id != household_id:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product
 
 
 #
@@ -101,19 +1304,148 @@ def clear(name: str):
 
 
 # INDEX
-# TODO: Сортировать по Product.clear_name
 @app.get("/", response_class=HTMLResponse)
-async def index(request: Request, session: Session = Depends((get_db))):
-    items = session.exec(select(Item)).all()
+async def index(
+    request: Request,
+    category_id: Optional[int] = None,
+    sort: Optional[str] = None,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    etag = make_etag(request, household_id)
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    query = (
+        select(Item)
+        .join(Item.product)
+        .options(contains_eager(Item.product))
+        # По продукту: фильтр и сортировка идут по индексу каталога домохозяйства
+        .where(Product.household_id == household_id)
+    )
+    if category_id is not None:
+        query = query.where(product_category == category_id)
+    if sort == "category" and category_id is None:
+        query = query.order_by(product_category, Product.clear_name)
+    else:
+        query = query.order_by(Product.clear_name)
+    items = (await session.exec(query)).all()
+
+    context = {"request": request, "items": [render_item(item) for item in items]}
+    if not items and category_id is None:
+        context["recommendations"] = await recommended_products(
+            session, household_id, recommender.popular(household_id)
+        )
+    return templates.TemplateResponse(
+        "index.html", context, headers=cache_headers(etag)
+    )
 
-    context = {"request": request, "items": items}
-    return templates.TemplateResponse("index.html", context)
+
+# GET recommendations
+@app.get("/recommendations/", response_class=HTMLResponse)
+async def get_recommendations(
+    request: Request,
+    product_id: Optional[int] = None,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Продукты, покупаемые вместе с product_id, без него - для пустого списка"""
+    if product_id is None:
+        product_ids = recommender.popular(household_id)
+    else:
+        product_ids = recommender.related(product_id)
+    context = {
+        "request": request,
+        "recommendations": await recommended_products(
+            session, household_id, product_ids
+        ),
+    }
+    return templates.TemplateResponse("partials/recommendations.html", context)
 
 
 #
 # Categories
 #
 
+
+# GET categories
+@app.get("/categories/")
+async def get_categories(
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    query = (
+        select(Category)
+        .where(Category.household_id == household_id)
+        .order_by(Category.name)
+    )
+    return (await session.exec(query)).all()
+
+
+# POST category
+@app.post("/categories/")
+async def create_category(
+    name: str = Form(...),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    category = Category(household_id=household_id, name=name)
+    session.add(category)
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Category already exists")
+    data_changed()
+    return category
+
+
+# PUT category
+@app.patch("/categories/{category_id}")
+async def update_category(
+    category_id: int,
+    name: str = Form(...),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    category = await own_category(session, category_id, household_id)
+    category.name = name
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Category already exists")
+    data_changed()
+    return category
+
+
+# DELETE category
+@app.delete("/categories/{category_id}")
+async def delete_category(
+    category_id: int,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Удаление категории, ее продукты остаются без категории"""
+    category = await own_category(session, category_id, household_id)
+    try:
+        await session.execute(
+            update(Product)
+            .where(Product.household_id == household_id)
+            .where(Product.categoty_id == category_id)
+            .values(categoty_id=None)
+        )
+        await session.delete(category)
+        await session.commit()
+    except IntegrityError:
+        # Без категории уже есть продукт с тем же именем
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Product already exists")
+    data_changed()
+    return category
+
+
 #
 # Products
 #
@@ -121,60 +1453,171 @@ async def index(request: Request, session: Session = Depends((get_db))):
 
 @app.get("/products/")
 async def get_products(
-    request: Request, name: Optional[str] = "", session: Session = Depends((get_db))
+    request: Request,
+    name: Optional[str] = "",
+    category_id: Optional[int] = None,
+    sort: Optional[str] = None,
+    after_category: Optional[int] = None,
+    after_name: Optional[str] = None,
+    after_id: Optional[int] = None,
+    offset: int = 0,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    """Список продуктов с поиском"""
-    # TODO: prefetch данных по item
-    if name:
-        query = (
-            select(Product, Item)
-            .join(Item, isouter=True)
-            .where(Product.clear_name.like("%{}%".format(clear(name))))
-            .order_by(Product.clear_name)
-        )
-    else:
-        query = (
-            select(Product, Item).join(Item, isouter=True).order_by(Product.clear_name)
-        )
-    products = session.exec(query).all()
-    product_exists = session.exec(select(Product).where(Product.name == name)).first()
+    """Список продуктов с поиском и фильтром по категории, постранично"""
+    etag = make_etag(request, household_id)
+    response = not_modified(request, etag)
+    if response:
+        return response
 
-    context = {
-        "request": request,
-        "products": products,
-        "name": name,
-        "exists": product_exists,
-    }
-    return templates.TemplateResponse("search.html", context)
+    page = after_id is not None or offset > 0
+    key = None if page else search_client(request)
+    token = canceller.start(key)
+    try:
+        async with interruptible(session, token, request.receive):
+            products, next_page, offers = await products_page(
+                session,
+                household_id,
+                name,
+                category_id,
+                sort,
+                after_category,
+                after_name,
+                after_id,
+                offset,
+            )
+            context = {
+                "request": request,
+                "products": products,
+                "next_page": next_page,
+                "offers_url": offers,
+                "name": name,
+                "category_id": category_id,
+                "page": page,
+            }
+            if not page:
+                # Тот же ключ, что у уникального индекса: добавить такой продукт нельзя
+                query = select(Product.id).where(
+                    Product.household_id == household_id,
+                    product_category == (category_id or 0),
+                    Product.clear_name == clear(name),
+                )
+                context["exists"] = (await session.exec(query)).first()
+            token.check()
+    except (Cancelled, OperationalError) as error:
+        canceller.finish(key, token)
+        if not token.cancelled:
+            raise
+        # Ответ никто не прочитает: без рендеринга, htmx ничего не заменит
+        canceller.count(token.reason)
+        if isinstance(error, OperationalError):
+            canceller.count("interrupted")
+        canceller.count("skipped_renders")
+        return Response(status_code=204)
+
+    # Новый запрос клиента прерывает и рендеринг, ключ освобождается после ответа
+    background = BackgroundTask(canceller.finish, key, token)
+    return render_products(request, context, etag, token, background)
+
+
+# POST products import
+@app.post("/products/import")
+async def import_catalogue(
+    request: Request,
+    format: Optional[str] = None,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Импорт CSV (name,category) или JSON Lines из тела запроса потоком"""
+    format = format or detect_format(request.headers.get("content-type"))
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown format")
+
+    rows = read_rows(iter_lines(request.stream()), format)
+    stats = await import_products(session, rows, household_id)
+    if stats["inserted"]:
+        # id новых продуктов не собраны: все воркеры перечитают кэши целиком
+        data_version.bump(ALL)
+    return stats
+
+
+# GET products export
+@app.get("/products/export")
+async def export_catalogue(
+    format: str = "csv",
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown format")
+    # Свое соединение: сессия запроса закрывается до отдачи ответа
+    headers = {"Content-Disposition": f'attachment; filename="products.{format}"'}
+    return StreamingResponse(
+        export_products(session.bind, format, household_id),
+        media_type=MEDIA_TYPES[format],
+        headers=headers,
+    )
 
 
 # GET product
 @app.get("/products/{product_id}")
 async def get_product(
-    product_id: int, request: Request, session: Session = Depends((get_db))
+    product_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    product = session.get(Product, product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    product = await own_product(
+        session, product_id, household_id, [joinedload(Product.items)]
+    )
 
-    context = {"request": request, "product": product, "item": product.items}
-    return templates.TemplateResponse("partials/product.html", context)
+    return HTMLResponse(render_product(product, product.items))
 
 
 # GET product form
 # TODO: Добавить класс inlist который будет содержать классы Tailwind
 @app.get("/products/{product_id}/edit")
 async def edit_product(
-    product_id: int, request: Request, session: Session = Depends((get_db))
+    product_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    product = session.get(Product, product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    product = await own_product(
+        session, product_id, household_id, [joinedload(Product.items)]
+    )
 
-    context = {"request": request, "product": product}
+    query = (
+        select(Category)
+        .where(Category.household_id == household_id)
+        .order_by(Category.name)
+    )
+    categories = (await session.exec(query)).all()
+    context = {"request": request, "product": product, "categories": categories}
     return templates.TemplateResponse("partials/product_form.html", context)
 
 
+# GET product history
+@app.get("/products/{product_id}/history", response_class=HTMLResponse)
+async def get_product_history(
+    product_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Сводка покупок продукта, журнал не читается"""
+    # Чужой продукт - как продукт без покупок
+    query = (
+        select(PurchaseStats)
+        .join(Product, Product.id == PurchaseStats.product_id)
+        .where(PurchaseStats.product_id == product_id)
+        .where(Product.household_id == household_id)
+    )
+    stats = (await session.exec(query)).first()
+    context = {"request": request, "stats": stats}
+    return templates.TemplateResponse("partials/product_history.html", context)
+
+
 # PUT product
 @app.patch("/products/{product_id}", response_class=HTMLResponse)
 async def update_product(
@@ -182,23 +1625,36 @@ async def update_product(
     request: Request,
     name: str = Form(...),
     description: str = Form(None),
-    session: Session = Depends((get_db)),
+    category_id: Optional[int] = Form(None),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    product = session.get(Product, product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    product = await own_product(
+        session, product_id, household_id, [joinedload(Product.items)]
+    )
 
     product.clear_name = clear(name)
     product.name = name
+    # Поле не передано - категория не меняется, 0 - без категории
+    if category_id:
+        await own_category(session, category_id, household_id)
+    if category_id is not None:
+        product.categoty_id = category_id or None
     if product.items:
         product.items.description = description
 
     session.add(product)
-    session.commit()
-    session.refresh(product)
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Product already exists")
+    fuzzy_index.add(product.id, product.clear_name, household_id)
+    data_changed(product.id)
+    if product.items:
+        publish_item_updated(product.items)
 
-    context = {"request": request, "product": product, "item": product.items}
-    return templates.TemplateResponse("partials/product.html", context)
+    return HTMLResponse(render_product(product, product.items))
 
 
 # POST product
@@ -206,70 +1662,92 @@ async def update_product(
 # TODO: Добавить вывод ошибки 400 при пустом названии товара
 @app.post("/products/quick_add", response_class=HTMLResponse)
 async def quick_add_product(
-    request: Request, name: str = Form(...), session: Session = Depends((get_db))
+    request: Request,
+    name: str = Form(...),
+    category_id: Optional[int] = Form(None),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
+    if category_id:
+        await own_category(session, category_id, household_id)
     clear_name = clear(name)
-    product = Product(name=name, clear_name=clear_name)
+    product = Product(
+        household_id=household_id,
+        name=name,
+        clear_name=clear_name,
+        categoty_id=category_id or None,
+    )
     session.add(product)
-    session.commit()
-    session.refresh(product)
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Продукт с таким именем в категории уже есть, покажем его
+        await session.rollback()
+    else:
+        fuzzy_index.add(product.id, product.clear_name, household_id)
+        # id удаленного продукта может быть выдан повторно
+        data_changed(product.id)
 
-    query = (
-        select(Product, Item)
-        .join(Item, isouter=True)
-        .where(Product.clear_name.like("%{}%".format(clear_name)))
-        .order_by(Product.clear_name)
+    products, next_page, offers = await products_page(
+        session, household_id, name, category_id
     )
-    products = session.exec(query).all()
-    context = {"request": request, "products": products}
-    return templates.TemplateResponse("search.html", context)
+    context = {
+        "request": request,
+        "products": products,
+        "next_page": next_page,
+        "offers_url": offers,
+    }
+    return render_products(request, context)
 
 
 # DELETE product
 @app.delete("/products/{product_id}")
 async def delete_product(
-    product_id: int, request: Request, session: Session = Depends((get_db))
+    product_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    query = select(Product).where(Product.id == product_id)
-    product = session.exec(query).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    session.delete(product)
-    session.commit()
+    product = await own_product(session, product_id, household_id)
+    await session.delete(product)
+    await session.commit()
+    fuzzy_index.remove(product.id)
+    data_changed(product.id)
     return product  # TODO: Отдавать HTML в ответе
 
 
+async def toggle_product(
+    session: AsyncSession, household_id: int, product_id: int, needed: bool
+):
+    """Переключение продукта в списке, в БД его запишет toggle_worker"""
+    product = await own_product(session, product_id, household_id)
+    # Фрагмент зависит от переключения, ETag страниц тоже. Версия данных
+    # упорядочивает переключения, попавшие в разные воркеры
+    toggles.set(product_id, needed, data_changed())
+    return HTMLResponse(render_product(product, None))
+
+
 # POST products
 # TODO: Добавить класс inlist который будет содержать классы Tailwind
 @app.post("/products/needs", response_class=HTMLResponse)
 async def product_needed(
-    request: Request, product_id: int = Form(...), session: Session = Depends((get_db))
+    request: Request,
+    product_id: int = Form(...),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    item = Item(product_id=product_id)
-    session.add(item)
-    session.commit()
-    session.refresh(item)
-
-    product = session.get(Product, product_id)
-    context = {"request": request, "product": product, "item": item}
-    return templates.TemplateResponse("partials/product.html", context)
+    return await toggle_product(session, household_id, product_id, True)
 
 
 # POST products
 @app.post("/products/notneed", response_class=HTMLResponse)
 async def product_notneed(
-    request: Request, product_id: int = Form(...), session: Session = Depends((get_db))
+    request: Request,
+    product_id: int = Form(...),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    query = select(Item).where(Item.product_id == product_id)
-    item = session.exec(query).first()
-    session.delete(item)
-    session.commit()
-    if not item:
-        raise HTTPException(status_code=404, detail="Product not found")
-
-    product = session.get(Product, product_id)
-    context = {"request": request, "product": product}
-    return templates.TemplateResponse("partials/product.html", context)
+    return await toggle_product(session, household_id, product_id, False)
 
 
 #
@@ -280,26 +1758,407 @@ async def product_notneed(
 # GET item
 @app.get("/items/{item_id}")
 async def get_item(
-    item_id: int, request: Request, session: Session = Depends((get_db))
+    item_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    query = select(Item).where(Item.id == item_id)
-    item = session.exec(query).first()
+    query = (
+        select(Item)
+        .where(Item.id == item_id, Item.household_id == household_id)
+        .options(joinedload(Item.product))
+    )
+    item = (await session.exec(query)).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    context = {"request": request, "item": item}
-    return templates.TemplateResponse("partials/item.html", context)
+    return HTMLResponse(render_item(item))
 
 
 # DELETE item
 @app.delete("/items/{item_id}")
 async def delete_item(
-    item_id: int, request: Request, session: Session = Depends((get_db))
+    item_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
 ):
-    query = select(Item).where(Item.id == item_id)
-    item = session.exec(query).first()
+    query = select(Item).where(Item.id == item_id, Item.household_id == household_id)
+    item = (await session.exec(query)).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
-    session.delete(item)
-    session.commit()
+    await session.delete(item)
+    await session.commit()
+    data_changed(item.product_id)
+    log_purchases("buy", household_id, item.product_id)
+    publish_item_removed(item.id, household_id)
     return item  # TODO: Отдавать HTML в ответе
+
+
+#
+# History
+#
+
+
+# GET history
+@app.get("/history/")
+async def get_history(
+    limit: int = 100,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Самые покупаемые продукты по сводке журнала"""
+    query = (
+        select(Product.id, Product.name, PurchaseStats)
+        .join(PurchaseStats, PurchaseStats.product_id == Product.id)
+        .where(Product.household_id == household_id, PurchaseStats.purchases > 0)
+        .order_by(PurchaseStats.purchases.desc(), Product.clear_name)
+        .limit(limit)
+    )
+    return [
+        {
+            "product_id": product_id,
+            "name": name,
+            "purchases": stats.purchases,
+            "last_bought_at": stats.last_bought_at,
+            "interval_days": stats.interval_days,
+        }
+        for product_id, name, stats in await session.exec(query)
+    ]
+
+
+#
+# Presets
+#
+
+
+# POST preset
+@app.post("/presets/")
+async def create_preset(
+    name: str = Form(...),
+    product_id: List[int] = Form(...),
+    description: List[str] = Form([]),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Создание заготовки, description - заметки к продуктам по порядку"""
+    query = select(func.count()).where(
+        Product.id.in_(product_id), Product.household_id == household_id
+    )
+    if (await session.exec(query)).one() != len(set(product_id)):
+        raise HTTPException(status_code=404, detail="Product not found")
+    preset = Preset(household_id=household_id, name=name)
+    session.add(preset)
+    await session.flush()
+    descriptions = description + [None] * (len(product_id) - len(description))
+    session.add_all(
+        PresetProduct(preset_id=preset.id, product_id=product, description=note or None)
+        for product, note in zip(product_id, descriptions)
+    )
+    await session.commit()
+    return preset
+
+
+# POST preset items
+@app.post("/presets/{preset_id}/items", response_class=HTMLResponse)
+async def add_preset_items(
+    preset_id: int,
+    request: Request,
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Добавление в список всех продуктов заготовки, которых в нем еще нет"""
+    preset = await session.get(Preset, preset_id)
+    if not preset or preset.household_id != household_id:
+        raise HTTPException(status_code=404, detail="Preset not found")
+
+    query = select(PresetProduct.product_id, PresetProduct.description).where(
+        PresetProduct.preset_id == preset_id,
+        ~exists().where(Item.product_id == PresetProduct.product_id),
+    )
+    rows = [
+        {
+            "household_id": household_id,
+            "product_id": product_id,
+            "description": description,
+        }
+        for product_id, description in await session.exec(query)
+    ]
+    if not rows:
+        return HTMLResponse("")
+
+    # Один INSERT на все строки в одной транзакции, продукт, добавленный
+    # параллельно, пропускается по уникальному индексу
+    await session.execute(insert(Item.__table__).prefix_with("OR IGNORE").values(rows))
+    await session.commit()
+
+    product_ids = [row["product_id"] for row in rows]
+    query = (
+        select(Item)
+        .join(Item.product)
+        .options(contains_eager(Item.product))
+        .where(Item.product_id.in_(product_ids))
+        .order_by(Product.clear_name)
+    )
+    items = (await session.exec(query)).all()
+    data_changed(*product_ids)
+    log_purchases("add", household_id, *product_ids)
+    publish_item_added(*items)
+    return HTMLResponse("".join(render_item(item) for item in items))
+
+
+#
+# События
+#
+
+
+@app.get("/events")
+async def events(request: Request, household_id: int = Depends(get_household)):
+    """Поток изменений списка покупок домохозяйства (Server-Sent Events)"""
+    subscription = broadcaster.subscribe(household_id)
+    if subscription is None:
+        raise HTTPException(status_code=503, detail="Too many subscribers")
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                message = await subscription.get(timeout=SSE_KEEPALIVE)
+                # Комментарий раз в SSE_KEEPALIVE секунд держит соединение
+                # и позволяет заметить отключение клиента
+                yield format_sse(*message) if message else ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+
+#
+# Статические файлы
+#
+
+
+@app.get("/static/{path:path}")
+async def static_file(path: str, request: Request):
+    """Файл со сжатием, подготовленным при запуске
+
+    URL с отпечатком содержимого кэшируется браузером навсегда, по имени
+    без отпечатка - с проверкой ETag.
+    """
+    asset, immutable = assets.find(path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    headers = {
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": (
+            "public, max-age=31536000, immutable" if immutable else "no-cache"
+        ),
+    }
+    if etag_matches(request, asset.etag):
+        return Response(status_code=304, headers=headers)
+    encoding = choose_encoding(asset, request.headers.get("Accept-Encoding"))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        asset.bodies[encoding], media_type=asset.media_type, headers=headers
+    )
+
+
+#
+# Магазин
+#
+
+
+# GET store offers
+@app.get("/store/offers", response_class=HTMLResponse)
+async def get_store_offers(
+    request: Request,
+    product_id: List[int] = Query([]),
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Предложения магазина к продуктам страницы, вставляются через hx-swap-oob"""
+    if store is None:
+        raise HTTPException(status_code=404, detail="Store is not configured")
+    query = select(Product.id, Product.clear_name).where(
+        Product.id.in_(product_id), Product.household_id == household_id
+    )
+    products = (await session.exec(query)).all()
+    # Соединение с БД не держится, пока ждем магазин
+    await session.close()
+    found = await store.get(
+        [clear_name for _, clear_name in products], STORE_WAIT_SECONDS
+    )
+    offers = [
+        (id, found[clear_name]) for id, clear_name in products if found.get(clear_name)
+    ]
+    context = {"request": request, "offers": offers}
+    return templates.TemplateResponse("partials/offers.html", context)
+
+
+#
+# Домохозяйства
+#
+
+
+async def create_session(session: AsyncSession, household_id: int):
+    """Новая сессия домохозяйства, возвращается токен для cookie"""
+    token = new_token()
+    expires_at = datetime.utcnow() + timedelta(days=SESSION_DAYS)
+    session.add(
+        HouseholdSession(
+            token_hash=token_hash(token),
+            household_id=household_id,
+            expires_at=expires_at,
+        )
+    )
+    await session.commit()
+    return token
+
+
+def set_session_cookie(response: Response, token: str):
+    response.set_cookie(
+        SESSION_COOKIE,
+        token,
+        max_age=SESSION_DAYS * 24 * 60 * 60,
+        httponly=True,
+        samesite="lax",
+    )
+
+
+# POST household
+@app.post("/households/")
+async def create_household(
+    name: str = Form(...), session: AsyncSession = Depends((get_db))
+):
+    """Новое домохозяйство, устройство сразу входит в него"""
+    household = Household(name=name)
+    session.add(household)
+    await session.commit()
+    token = await create_session(session, household.id)
+    response = JSONResponse({"id": household.id, "name": household.name})
+    set_session_cookie(response, token)
+    return response
+
+
+# POST household invite
+@app.post("/households/invite")
+async def invite_to_household(
+    session: AsyncSession = Depends((get_db)),
+    household_id: int = Depends(get_household),
+):
+    """Ссылка для входа других устройств в домохозяйство"""
+    if household_id == DEFAULT_HOUSEHOLD:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    token = new_token()
+    session.add(
+        HouseholdInvite(
+            token_hash=token_hash(token),
+            household_id=household_id,
+            expires_at=datetime.utcnow() + timedelta(hours=INVITE_HOURS),
+        )
+    )
+    await session.commit()
+    return {"url": "/invites/{}".format(token)}
+
+
+# GET invite
+@app.get("/invites/{token}")
+async def join_household(token: str, session: AsyncSession = Depends((get_db))):
+    """Вход по ссылке приглашения: каждое устройство получает свою сессию"""
+    query = select(HouseholdInvite.household_id).where(
+        HouseholdInvite.token_hash == token_hash(token),
+        HouseholdInvite.expires_at > datetime.utcnow(),
+    )
+    household_id = (await session.exec(query)).first()
+    if household_id is None:
+        raise HTTPException(status_code=404, detail="Invite not found")
+    response = RedirectResponse("/", status_code=303)
+    set_session_cookie(response, await create_session(session, household_id))
+    return response
+
+
+# DELETE session
+@app.delete("/sessions/")
+async def delete_session(request: Request, session: AsyncSession = Depends((get_db))):
+    """Выход устройства, в других воркерах сессия живет еще не дольше TTL кэша"""
+    token = request.cookies.get(SESSION_COOKIE)
+    if token:
+        key = token_hash(token)
+        await session.exec(
+            delete(HouseholdSession).where(HouseholdSession.token_hash == key)
+        )
+        await session.commit()
+        session_cache.discard(key)
+    response = Response(status_code=204)
+    response.delete_cookie(SESSION_COOKIE)
+    return response
+
+
+#
+# Служебное
+#
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    fragments_stats = fragments.stats()
+    extra = [
+        "# TYPE fragment_cache_hits_total counter",
+        "fragment_cache_hits_total {}".format(fragments_stats["hits"]),
+        "# TYPE fragment_cache_misses_total counter",
+        "fragment_cache_misses_total {}".format(fragments_stats["misses"]),
+        "# TYPE fragment_cache_size gauge",
+        "fragment_cache_size {}".format(fragments_stats["size"]),
+        "# TYPE sse_subscribers gauge",
+        "sse_subscribers {}".format(len(broadcaster)),
+        "# TYPE data_version gauge",
+        "data_version {}".format(data_version.get()),
+    ]
+    sessions = session_cache.stats()
+    extra += [
+        "# TYPE session_cache_hits_total counter",
+        "session_cache_hits_total {}".format(sessions["hits"]),
+        "# TYPE session_cache_misses_total counter",
+        "session_cache_misses_total {}".format(sessions["misses"]),
+    ]
+    if store is not None:
+        for name, value in store.counters.items():
+            extra.append("# TYPE store_{}_total counter".format(name))
+            extra.append("store_{}_total {}".format(name, value))
+    for name, value in canceller.counters.items():
+        extra.append("# TYPE search_{}_total counter".format(name))
+        extra.append("search_{}_total {}".format(name, value))
+    return metrics.expose(extra)
+
+
+@app.get("/stats/fragments")
+async def fragments_stats():
+    """Счетчики кэша отрендеренных фрагментов"""
+    return fragments.stats()
+
+
+@app.get("/stats/toggles")
+async def toggles_stats():
+    """Счетчики отложенных переключений продуктов в списке"""
+    return toggles.stats()
+
+
+@app.get("/stats/cancelled")
+async def cancelled_stats():
+    """Счетчики отмененных запросов поиска и сэкономленной работы"""
+    return canceller.stats()
+
+
+@app.get("/stats/store")
+async def store_stats():
+    """Счетчики кэша предложений магазина"""
+    return store.stats() if store is not None else {}
+
+
+@app.get("/stats/sessions")
+async def sessions_stats():
+    """Счетчики кэша сессий домохозяйств"""
+    return session_cache.stats()
@@ -0,0 +1,248 @@
+import contextlib
+import contextvars
+import logging
+import time
+from bisect import bisect_left
+from typing import Optional, Sequence
+
+import jinja2
+from sqlalchemy import event
+
+logger = logging.getLogger("app.slow")
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с метками"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            # Счетчики по корзинам, затем сумма и количество
+            series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def expose(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        for labels, series in sorted(self._series.items()):
+            pairs = ['{}="{}"'.format(k, v) for k, v in zip(self.labels, labels)]
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series):
+                cumulative += count
+                le = ",".join(pairs + ['le="{}"'.format(bucket)])
+                yield "{}_bucket{{{}}} {}".format(self.name, le, cumulative)
+            le = ",".join(pairs + ['le="+Inf"'])
+            yield "{}_bucket{{{}}} {}".format(self.name, le, series[-1])
+            yield "{}_sum{{{}}} {}".format(self.name, ",".join(pairs), series[-2])
+            yield "{}_count{{{}}} {}".format(self.name, ",".join(pairs), series[-1])
+
+
+class RequestStats:
+    """Статистика текущего запроса, накапливается хуками SQLAlchemy и Jinja"""
+
+    def __init__(self, collect_statements: bool = False):
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.render_time = 0.0
+        self.rendering = False
+        self.statements = [] if collect_statements else None
+
+
+current_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_stats", default=None
+)
+
+
+def instrument_engine(engine):
+    """Хуки SQLAlchemy, считающие запросы и их время в статистику запроса"""
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_stats.get()
+    if stats is None:
+        return
+    stats.sql_time += elapsed
+    stats.sql_count += 1
+    if stats.statements is not None:
+        stats.statements.append((elapsed, statement))
+
+
+class TimedTemplate(jinja2.Template):
+    """Шаблон, время рендеринга которого попадает в статистику запроса"""
+
+    def render(self, *args, **kwargs):
+        with rendering():
+            return super().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        chunks = super().generate(*args, **kwargs)
+        while True:
+            with rendering():
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+@contextlib.contextmanager
+def rendering():
+    """Учет времени рендеринга, вложенные шаблоны не считаются повторно"""
+    stats = current_stats.get()
+    if stats is None or stats.rendering:
+        yield
+        return
+    stats.rendering = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.rendering = False
+        stats.render_time += time.perf_counter() - start
+
+
+class Metrics:
+    """Метрики запросов, slow_request - порог в секундах для лога медленных"""
+
+    def __init__(self, slow_request: Optional[float] = None):
+        self.slow_request = slow_request
+        labels = ("method", "route")
+        self.duration = Histogram(
+            "http_request_duration_seconds",
+            "Request wall time.",
+            labels + ("status",),
+            DURATION_BUCKETS,
+        )
+        self.sql_duration = Histogram(
+            "http_request_sql_duration_seconds",
+            "Time spent executing SQL per request.",
+            labels,
+            DURATION_BUCKETS,
+        )
+        self.sql_statements = Histogram(
+            "http_request_sql_statements",
+            "SQL statements executed per request.",
+            labels,
+            COUNT_BUCKETS,
+        )
+        self.render_duration = Histogram(
+            "http_request_render_duration_seconds",
+            "Time spent rendering Jinja templates per request.",
+            labels,
+            DURATION_BUCKETS,
+        )
+        self.response_size = Histogram(
+            "http_response_size_bytes",
+            "Response body size.",
+            labels,
+            SIZE_BUCKETS,
+        )
+        self.histograms = [
+            self.duration,
+            self.sql_duration,
+            self.sql_statements,
+            self.render_duration,
+            self.response_size,
+        ]
+
+    def observe(self, method, route, status, duration, size, stats: RequestStats):
+        self.duration.observe(duration, method, route, str(status))
+        self.sql_duration.observe(stats.sql_time, method, route)
+        self.sql_statements.observe(stats.sql_count, method, route)
+        self.render_duration.observe(stats.render_time, method, route)
+        self.response_size.observe(size, method, route)
+
+    def expose(self, extra: Sequence[str] = ()):
+        lines = [line for histogram in self.histograms for line in histogram.expose()]
+        return "\n".join(lines + list(extra)) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware, замеряющее каждый HTTP запрос
+
+    Время запроса считается до последнего куска тела ответа, поэтому для
+    потоковых ответов включает генерацию всего тела.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+        self._routes = None
+
+    def route_path(self, scope):
+        if self._routes is None:
+            self._routes = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint")
+            }
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        slow_request = self.metrics.slow_request
+        stats = RequestStats(collect_statements=slow_request is not None)
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_stats.reset(token)
+            duration = time.perf_counter() - start
+            route = self.route_path(scope)
+            self.metrics.observe(scope["method"], route, status, duration, size, stats)
+            if slow_request is not None and duration >= slow_request:
+                self.log_slow(scope, route, status, duration, stats)
+
+    def log_slow(self, scope, route, status, duration, stats: RequestStats):
+        statements = "\n".join(
+            "  {:.1f} ms: {}".format(elapsed * 1000, " ".join(statement.split()))
+            for elapsed, statement in stats.statements
+        )
+        logger.warning(
+            "Slow request %s %s (%s) %d: %.1f ms, SQL %d statements %.1f ms, "
+            "render %.1f ms\n%s",
+            scope["method"],
+            scope["path"],
+            route,
+            status,
+            duration * 1000,
+            stats.sql_count,
+            stats.sql_time * 1000,
+            stats.render_time * 1000,
+            statements,
+        )
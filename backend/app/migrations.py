@@ -0,0 +1,343 @@
+"""Версионные миграции схемы БД
+
+python -m app.migrations
+python -m app.migrations --database-url sqlite:///./app.db
+
+Запускаются один раз при развертывании (prestart.sh), а не при старте
+каждого воркера: воркер только сверяет номер версии. Каждый шаг выполняется
+в своей транзакции вместе с записью номера версии, поэтому прерванная
+миграция откатывается до последнего завершенного шага и продолжается с него
+повторным запуском. БД, созданные до миграций через create_all, доводятся
+до текущей схемы, дубли продуктов и категорий в них сливаются.
+"""
+
+import argparse
+import asyncio
+import json
+from contextlib import contextmanager
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    inspect,
+    literal,
+    select,
+    text,
+)
+from sqlalchemy.schema import CreateTable
+from sqlmodel import SQLModel
+
+from . import main
+
+version_table = Table(
+    "schema_version", MetaData(), Column("version", Integer, nullable=False)
+)
+
+
+def add_missing_columns(connection, table_name: str):
+    """Столбцы модели, которых нет в таблице, с DEFAULT для старых строк"""
+    table = SQLModel.metadata.tables[table_name]
+    existing = {
+        column["name"] for column in inspect(connection).get_columns(table_name)
+    }
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+            table_name, column.name, column.type.compile(connection.dialect)
+        )
+        if column.default is not None:
+            default = literal(column.default.arg).compile(
+                dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+            )
+            ddl += " NOT NULL DEFAULT {}".format(default)
+        connection.execute(text(ddl))
+
+
+def index_list(connection, table_name: str):
+    """Индексы таблицы: имя -> уникальный ли
+
+    Инспектор SQLAlchemy пропускает индексы по выражению, PRAGMA - нет.
+    """
+    rows = connection.execute(text("PRAGMA index_list({})".format(table_name)))
+    return {row.name: bool(row.unique) for row in rows}
+
+
+def drop_index(connection, table_name: str, name: str, unique=None):
+    """Удаление индекса, unique - только если уникальность другая"""
+    indexes = index_list(connection, table_name)
+    if name in indexes and (unique is None or indexes[name] != unique):
+        connection.execute(text("DROP INDEX {}".format(name)))
+
+
+def create_indexes(connection, *names: str):
+    """Индексы моделей, которых еще нет, по умолчанию все"""
+    for table in SQLModel.metadata.sorted_tables:
+        existing = index_list(connection, table.name)
+        for index in table.indexes:
+            if index.name not in existing and (not names or index.name in names):
+                index.create(connection)
+
+
+def rebuild_table(connection, table_name: str):
+    """Пересоздание таблицы по модели с сохранением строк
+
+    ALTER TABLE в SQLite не удаляет ограничения столбцов. Новая таблица
+    создается под другим именем и переименовывается после удаления старой,
+    чтобы внешние ключи других таблиц остались на прежнем имени.
+    """
+    table = SQLModel.metadata.tables[table_name]
+    new = table.to_metadata(MetaData(), name=table_name + "_new")
+    columns = ", ".join(column.name for column in table.columns)
+    connection.execute(CreateTable(new))
+    connection.execute(
+        text(
+            "INSERT INTO {}_new ({}) SELECT {} FROM {}".format(
+                table_name, columns, columns, table_name
+            )
+        )
+    )
+    connection.execute(text("DROP TABLE {}".format(table_name)))
+    connection.execute(text("ALTER TABLE {0}_new RENAME TO {0}".format(table_name)))
+
+
+def merge_products(connection):
+    """Слияние продуктов с одинаковым ключом уникального индекса
+
+    Остается продукт с меньшим id, ссылки на остальные переводятся на него.
+    Элемент списка у продукта один, лишние удаляются. Сводка покупок
+    слитых продуктов пересчитывается по журналу до уже учтенного события.
+    """
+    # Удаление строки из рассинхронизированного FTS индекса - ошибка malformed
+    main.create_search_index(connection)
+    connection.execute(
+        text(
+            "CREATE TEMP TABLE product_merge AS "
+            "SELECT id AS old_id, new_id FROM ("
+            "SELECT id, MIN(id) OVER (PARTITION BY household_id, "
+            "COALESCE(categoty_id, 0), clear_name) AS new_id FROM product"
+            ") WHERE id != new_id"
+        )
+    )
+    new_id = "(SELECT new_id FROM product_merge WHERE old_id = {0}.product_id)"
+    merged = "product_id IN (SELECT old_id FROM product_merge)"
+    connection.execute(
+        text(
+            "DELETE FROM item WHERE id NOT IN (SELECT MIN(item.id) FROM item "
+            "LEFT JOIN product_merge ON old_id = item.product_id "
+            "GROUP BY COALESCE(new_id, item.product_id))"
+        )
+    )
+    for table_name in ("item", "presetproduct", "purchaseevent"):
+        connection.execute(
+            text(
+                "UPDATE {0} SET product_id = {1} WHERE {2}".format(
+                    table_name, new_id.format(table_name), merged
+                )
+            )
+        )
+    if inspect(connection).has_table("product_toggle"):
+        connection.execute(text("DELETE FROM product_toggle WHERE " + merged))
+    watermark = connection.execute(
+        text("SELECT COALESCE(MAX(last_event_id), 0) FROM purchasestats")
+    ).scalar()
+    touched = (
+        "product_id IN (SELECT old_id FROM product_merge "
+        "UNION SELECT new_id FROM product_merge)"
+    )
+    connection.execute(text("DELETE FROM purchasestats WHERE " + touched))
+    connection.execute(
+        text(
+            "INSERT INTO purchasestats (product_id, adds, purchases, removes, "
+            "first_bought_at, last_bought_at, last_event_id) "
+            "SELECT product_id, SUM(kind = 'add'), SUM(kind = 'buy'), "
+            "SUM(kind = 'remove'), MIN(CASE WHEN kind = 'buy' THEN created_at END), "
+            "MAX(CASE WHEN kind = 'buy' THEN created_at END), MAX(id) "
+            "FROM purchaseevent WHERE id <= :watermark AND {} "
+            "GROUP BY product_id".format(touched)
+        ),
+        {"watermark": watermark},
+    )
+    connection.execute(
+        text("DELETE FROM product WHERE id IN (SELECT old_id FROM product_merge)")
+    )
+    connection.execute(text("DROP TABLE product_merge"))
+
+
+def initial(connection):
+    """Таблицы текущей схемы, которых еще нет, и FTS индекс"""
+    SQLModel.metadata.create_all(connection)
+    main.create_search_index(connection)
+
+
+def unique_items(connection):
+    """Продукт в списке не больше одного раза: дубли удаляются"""
+    connection.execute(
+        text(
+            "DELETE FROM item WHERE id NOT IN "
+            "(SELECT MIN(id) FROM item GROUP BY product_id)"
+        )
+    )
+    drop_index(connection, "item", "ix_item_product_id", unique=True)
+    create_indexes(connection, "ix_item_product_id")
+
+
+def households(connection):
+    """household_id продуктов, элементов и заготовок, индексы с ним"""
+    for table_name in ("product", "item", "preset"):
+        add_missing_columns(connection, table_name)
+    drop_index(connection, "product", "ix_product_clear_name")
+    drop_index(connection, "product", "ix_product_category_clear_name")
+    # Дубли из БД без уникального индекса
+    merge_products(connection)
+    create_indexes(
+        connection,
+        "ix_product_household_clear_name",
+        "ix_product_household_category_clear_name",
+        "ix_item_household_product",
+        "ix_preset_household_id",
+    )
+
+
+def household_categories(connection):
+    """Категории домохозяйств и household_id журнала покупок
+
+    Категория, которой пользуются продукты нескольких домохозяйств,
+    копируется в каждое из них. Одноименные категории домохозяйства
+    сливаются, а вместе с ними - ставшие одинаковыми продукты.
+    """
+    for table_name in ("category", "purchaseevent"):
+        add_missing_columns(connection, table_name)
+    # Уникальное имя категории на всю БД, из Field(unique=True)
+    if any(
+        name.startswith("sqlite_autoindex_category")
+        for name in index_list(connection, "category")
+    ):
+        rebuild_table(connection, "category")
+    connection.execute(
+        text(
+            "INSERT INTO category (household_id, name) "
+            "SELECT DISTINCT product.household_id, category.name FROM product "
+            "JOIN category ON category.id = product.categoty_id "
+            "WHERE product.household_id != category.household_id"
+        )
+    )
+    drop_index(connection, "product", "ix_product_household_category_clear_name")
+    connection.execute(
+        text(
+            "UPDATE product SET categoty_id = ("
+            "SELECT MIN(own.id) FROM category JOIN category AS own "
+            "ON own.name = category.name "
+            "WHERE category.id = product.categoty_id "
+            "AND own.household_id = product.household_id"
+            ") WHERE categoty_id IS NOT NULL"
+        )
+    )
+    connection.execute(
+        text(
+            "DELETE FROM category WHERE id NOT IN "
+            "(SELECT MIN(id) FROM category GROUP BY household_id, name)"
+        )
+    )
+    merge_products(connection)
+    create_indexes(
+        connection,
+        "ix_category_household_name",
+        "ix_product_household_category_clear_name",
+    )
+
+
+def product_toggles(connection):
+    """Версии переключений продуктов для порядка между воркерами"""
+    main.ProductToggle.__table__.create(connection, checkfirst=True)
+
+
+def household_invites(connection):
+    """Приглашения в домохозяйства отдельно от сессий устройств"""
+    main.HouseholdInvite.__table__.create(connection, checkfirst=True)
+
+
+# Номер версии - число примененных шагов, новые шаги только дописываются
+MIGRATIONS = [
+    initial,
+    unique_items,
+    households,
+    household_categories,
+    product_toggles,
+    household_invites,
+]
+
+
+def current_version(connection):
+    if not inspect(connection).has_table(version_table.name):
+        return 0
+    return connection.execute(select(version_table.c.version)).scalar() or 0
+
+
+@contextmanager
+def transaction(connection):
+    """Явная транзакция: pysqlite сам не начинает ее перед DDL
+
+    IMMEDIATE сразу берет блокировку записи, поэтому параллельный запуск
+    ждет завершения шага, а не применяет его второй раз.
+    """
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.exec_driver_sql("ROLLBACK")
+        raise
+    connection.exec_driver_sql("COMMIT")
+
+
+def upgrade(connection):
+    """Применение недостающих шагов, возвращает (было, стало)
+
+    Соединение без начатой транзакции, каждый шаг - своя транзакция.
+    """
+    connection.execution_options(isolation_level="AUTOCOMMIT")
+    start = current_version(connection)
+    while True:
+        with transaction(connection):
+            version = current_version(connection)
+            if version >= len(MIGRATIONS):
+                break
+            version_table.create(connection, checkfirst=True)
+            MIGRATIONS[version](connection)
+            connection.execute(version_table.delete())
+            connection.execute(version_table.insert().values(version=version + 1))
+    return start, len(MIGRATIONS)
+
+
+def check(connection):
+    """Проверка при старте воркера: один запрос вместо create_all"""
+    version = current_version(connection)
+    if version < len(MIGRATIONS):
+        raise RuntimeError(
+            "Database schema version {} < {}, run python -m app.migrations".format(
+                version, len(MIGRATIONS)
+            )
+        )
+
+
+async def run(database_url: str):
+    engine = main.create_db_engine(database_url)
+    try:
+        async with engine.connect() as connection:
+            return await connection.run_sync(upgrade)
+    finally:
+        await engine.dispose()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=main.DATABASE_URL)
+    args = parser.parse_args()
+    start, version = asyncio.run(run(args.database_url))
+    print(json.dumps({"from": start, "to": version}))
+
+
+if __name__ == "__main__":
+    cli()
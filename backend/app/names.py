@@ -0,0 +1,48 @@
+"""Нормализация названий продуктов для поиска и уникальности
+
+Правила - данные с версией: при изменении RULES увеличивается RULES_VERSION,
+а сохраненные clear_name пересчитываются командой app.backfill.
+"""
+
+import functools
+import re
+import unicodedata
+
+RULES_VERSION = 2
+
+# Шаги по порядку: ("normalize", форма), ("casefold",), ("sub", шаблон, замена)
+RULES = (
+    # Совместимые формы: лигатуры, полноширинные символы, индексы
+    ("normalize", "NFKC"),
+    ("casefold",),
+    # Все, кроме букв и цифр любых алфавитов, становится одним пробелом
+    ("sub", r"[\W_]+", " "),
+    ("sub", "ё", "е"),
+)
+
+
+def compile_rules(rules):
+    """Шаги правил в список функций от строки"""
+    steps = []
+    for rule, *args in rules:
+        if rule == "normalize":
+            steps.append(functools.partial(unicodedata.normalize, *args))
+        elif rule == "casefold":
+            steps.append(str.casefold)
+        elif rule == "sub":
+            pattern, replacement = args
+            steps.append(functools.partial(re.compile(pattern).sub, replacement))
+        else:
+            raise ValueError(f"Unknown rule: {rule}")
+    return steps
+
+
+STEPS = compile_rules(RULES)
+
+
+@functools.lru_cache(maxsize=4096)
+def clear(name: str) -> str:
+    """Очистка имени от смайликов и не нужных символов"""
+    for step in STEPS:
+        name = step(name)
+    return name.strip()
@@ -0,0 +1,120 @@
+"""Рекомендации продуктов по совместным покупкам
+
+Покупки одного домохозяйства, сделанные с перерывом не больше basket_gap,
+считаются одной корзиной. Для каждой пары продуктов корзины растет вес в матрице
+совместных покупок, для каждого продукта - вес популярности. Вес покупки
+растет со временем (forward decay): exp((t - t0) / tau), поэтому старые
+покупки относительно теряют вес без пересчета всей матрицы. Продукт
+принадлежит одному домохозяйству, поэтому строки матрицы общие, а
+популярность и корзины - свои у каждого домохозяйства.
+
+Матрица обновляется по новым покупкам, топ-K пересчитывается только для
+затронутых строк, а чтение готовых топ-K стоит O(K).
+"""
+
+import heapq
+import math
+import threading
+from collections import defaultdict
+
+# Порог показателя экспоненты, после которого веса приводятся к новому t0
+MAX_EXPONENT = 50.0
+
+
+class Recommender:
+    def __init__(
+        self,
+        top_k: int = 10,
+        half_life_days: float = 30,
+        basket_gap: float = 2 * 3600,
+    ):
+        self.top_k = top_k
+        self.tau = half_life_days * 86400 / math.log(2)
+        self.basket_gap = basket_gap
+        self.t0 = None
+        # Разреженная матрица: product_id -> {product_id: вес}, память
+        # растет с числом пар, купленных вместе, а не с квадратом каталога
+        self.cooccurrence = defaultdict(dict)
+        # household_id -> {product_id: вес}
+        self.popularity = defaultdict(dict)
+        # Открытые корзины: household_id -> (продукты, время последней покупки)
+        self.baskets = {}
+        # Последнее учтенное событие журнала покупок
+        self.last_event_id = 0
+        self.related_cache = {}
+        self.popular_cache = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(map(len, self.popularity.values()))
+
+    def _weight(self, timestamp: float):
+        if self.t0 is None:
+            self.t0 = timestamp
+        exponent = (timestamp - self.t0) / self.tau
+        if exponent > MAX_EXPONENT:
+            # Сдвиг t0 делит все накопленные веса на одно число, порядок сохраняется
+            scale = math.exp(-exponent)
+            for row in self.cooccurrence.values():
+                for product_id in row:
+                    row[product_id] *= scale
+            for popularity in self.popularity.values():
+                for product_id in popularity:
+                    popularity[product_id] *= scale
+            self.t0 = timestamp
+            exponent = 0.0
+        return math.exp(exponent)
+
+    def _top(self, scores: dict):
+        # При равном весе раньше идет продукт, купленный впервые раньше
+        top = heapq.nlargest(self.top_k, scores.items(), key=lambda item: item[1])
+        return [product_id for product_id, score in top if score > 0]
+
+    def update(self, purchases):
+        """Учет покупок (event_id, household_id, product_id, timestamp)
+
+        Покупки передаются в порядке event_id.
+        """
+        with self.lock:
+            touched = set()
+            households = set()
+            for event_id, household_id, product_id, timestamp in purchases:
+                self.last_event_id = max(self.last_event_id, event_id)
+                weight = self._weight(timestamp)
+                basket, basket_time = self.baskets.get(household_id, ([], None))
+                if basket_time is None or timestamp - basket_time > self.basket_gap:
+                    basket = []
+                self.baskets[household_id] = (basket, timestamp)
+                popularity = self.popularity[household_id]
+                popularity[product_id] = popularity.get(product_id, 0.0) + weight
+                households.add(household_id)
+                if product_id in basket:
+                    continue
+                row = self.cooccurrence[product_id]
+                for other in basket:
+                    row[other] = row.get(other, 0.0) + weight
+                    other_row = self.cooccurrence[other]
+                    other_row[product_id] = other_row.get(product_id, 0.0) + weight
+                    touched.add(other)
+                basket.append(product_id)
+                touched.add(product_id)
+
+            if not touched:
+                return 0
+            for product_id in touched:
+                self.related_cache[product_id] = self._top(
+                    self.cooccurrence[product_id]
+                )
+            for household_id in households:
+                self.popular_cache[household_id] = self._top(
+                    self.popularity[household_id]
+                )
+            return len(touched)
+
+    def related(self, product_id: int):
+        """Продукты, которые чаще покупают вместе с product_id"""
+        return self.related_cache.get(product_id, [])
+
+    def popular(self, household_id: int):
+        """Рекомендации для пустого списка: часто и недавно покупаемые"""
+        return self.popular_cache.get(household_id, [])
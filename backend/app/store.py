@@ -0,0 +1,202 @@
+"""Предложения интернет-магазина для продуктов каталога
+
+Магазин спрашивается пачками названий через общий пул соединений,
+ответы кэшируются в воркере. Устаревшее предложение отдается сразу и
+обновляется в фоне, одновременные запросы одного названия ждут один
+и тот же запрос к магазину. Продукты связаны с магазином по очищенному
+названию, поэтому одинаковые продукты разных домохозяйств - одна запись.
+"""
+
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+
+logger = logging.getLogger("app.store")
+
+
+class Offer(NamedTuple):
+    title: str
+    price: float
+    url: str
+
+
+class StoreCatalogue(ABC):
+    """Каталог магазина: названия -> предложение или None, если не найдено"""
+
+    @abstractmethod
+    async def lookup(self, names: List[str]) -> Dict[str, Optional[Offer]]:
+        """Предложения по названиям, каждое название есть в ответе"""
+
+    async def aclose(self):
+        pass
+
+
+def create_client(
+    base_url: str, timeout: float = 5, max_connections: int = 20
+) -> httpx.AsyncClient:
+    """Общий клиент воркера: соединения с магазином переиспользуются"""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        timeout=httpx.Timeout(timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+        headers={"Accept": "application/json"},
+    )
+
+
+class HttpStoreCatalogue(StoreCatalogue):
+    """POST /lookup {"names": [...]} -> {"название": {title, price, url} | null}"""
+
+    def __init__(self, client: httpx.AsyncClient, batch_size: int = 100):
+        self.client = client
+        self.batch_size = batch_size
+
+    async def lookup(self, names):
+        batches = [
+            names[i : i + self.batch_size]
+            for i in range(0, len(names), self.batch_size)
+        ]
+        offers = {}
+        for found in await asyncio.gather(*map(self._lookup, batches)):
+            offers.update(found)
+        return offers
+
+    async def _lookup(self, names):
+        response = await self.client.post("/lookup", json={"names": names})
+        response.raise_for_status()
+        found = response.json()
+        offers = dict.fromkeys(names)
+        for name in names:
+            offer = found.get(name)
+            # Ссылка попадает в страницу: только http(s)
+            if offer and offer["url"].startswith(("http://", "https://")):
+                offers[name] = Offer(
+                    offer["title"], float(offer["price"]), offer["url"]
+                )
+        return offers
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class OfferCache:
+    """TTL+LRU кэш предложений с отдачей устаревших и объединением запросов
+
+    Запись свежая ttl секунд, еще stale_ttl секунд она отдается как есть,
+    но запускает обновление в фоне. Ошибка магазина не стирает запись.
+    """
+
+    def __init__(
+        self,
+        catalogue: StoreCatalogue,
+        ttl: float = 3600,
+        stale_ttl: float = 86400,
+        maxsize: int = 50000,
+    ):
+        self.catalogue = catalogue
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        self.counters = {
+            "hits": 0,
+            "stale": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "lookups": 0,
+            "errors": 0,
+        }
+        # Название -> (предложение, время получения)
+        self._offers = OrderedDict()
+        # Название -> задача запроса к магазину, в который оно входит
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._offers)
+
+    def peek(self, names: List[str]):
+        """Предложения из кэша без ожидания, остальные запрашиваются в фоне"""
+        now = time.monotonic()
+        offers = {}
+        refresh = []
+        for name in dict.fromkeys(names):
+            entry = self._offers.get(name)
+            age = now - entry[1] if entry is not None else None
+            if age is not None and age < self.ttl + self.stale_ttl:
+                self._offers.move_to_end(name)
+                offers[name] = entry[0]
+                if age < self.ttl:
+                    self.counters["hits"] += 1
+                    continue
+                self.counters["stale"] += 1
+            else:
+                self.counters["misses"] += 1
+            refresh.append(name)
+        if refresh:
+            self._refresh(refresh)
+        return offers
+
+    async def get(self, names: List[str], timeout: Optional[float] = None):
+        """Предложения, отсутствующих в кэше ждем не дольше timeout
+
+        Не дождавшийся запрос продолжается и заполнит кэш для следующих.
+        """
+        offers = self.peek(names)
+        tasks = {
+            self._inflight[name]
+            for name in names
+            if name not in offers and name in self._inflight
+        }
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+            offers.update(
+                (name, self._offers[name][0])
+                for name in names
+                if name not in offers and name in self._offers
+            )
+        return offers
+
+    def _refresh(self, names: List[str]):
+        missing = [name for name in names if name not in self._inflight]
+        self.counters["coalesced"] += len(names) - len(missing)
+        if not missing:
+            return
+        task = asyncio.ensure_future(self._lookup(missing))
+        for name in missing:
+            self._inflight[name] = task
+
+    async def _lookup(self, names: List[str]):
+        self.counters["lookups"] += 1
+        try:
+            offers = await self.catalogue.lookup(names)
+        except Exception:
+            self.counters["errors"] += 1
+            logger.warning("Store lookup failed", exc_info=True)
+            return
+        finally:
+            for name in names:
+                self._inflight.pop(name, None)
+        now = time.monotonic()
+        for name in names:
+            self._offers[name] = (offers.get(name), now)
+            self._offers.move_to_end(name)
+        while len(self._offers) > self.maxsize:
+            self._offers.popitem(last=False)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "size": len(self._offers),
+            "inflight": len(self._inflight),
+        }
+
+    async def aclose(self):
+        for task in set(self._inflight.values()):
+            task.cancel()
+        await self.catalogue.aclose()
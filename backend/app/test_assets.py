@@ -0,0 +1,56 @@
+import gzip
+
+import brotli
+
+from .assets import Assets, accepted_encodings, choose_encoding
+
+
+def make_assets(tmp_path):
+    (tmp_path / "icon.png").write_bytes(b"\x89PNG" + bytes(range(256)))
+    (tmp_path / "site.webmanifest").write_text(
+        '{"icons": [{"src": "/icon.png"}, {"src": "/static/icon.png"},'
+        ' {"src": "https://example.com/icon.png"}], "name": "' + "x" * 200 + '"}'
+    )
+    assets = Assets(str(tmp_path))
+    assets.load()
+    return assets
+
+
+def test_fingerprint(tmp_path):
+    assets = make_assets(tmp_path)
+
+    url = assets.url("icon.png")
+    assert url.startswith("/static/icon.") and url.endswith(".png")
+    assert assets.find(url[len("/static/"):]) == (assets.by_name["icon.png"], True)
+    assert assets.find("icon.png") == (assets.by_name["icon.png"], False)
+    assert assets.find("missing.png") == (None, False)
+    assert assets.url("missing.png") == "/static/missing.png"
+
+    # Новое содержимое - новый URL
+    (tmp_path / "icon.png").write_bytes(b"\x89PNG")
+    assert Assets(str(tmp_path)).url("icon.png") != url
+
+
+def test_rewrite_and_compress(tmp_path):
+    assets = make_assets(tmp_path)
+
+    manifest = assets.by_name["site.webmanifest"]
+    icon_url = assets.url("icon.png")
+    content = manifest.bodies["identity"].decode()
+    assert content.count(icon_url) == 2
+    assert "https://example.com/icon.png" in content
+    assert manifest.media_type == "application/manifest+json; charset=utf-8"
+    assert gzip.decompress(manifest.bodies["gzip"]) == manifest.bodies["identity"]
+    assert brotli.decompress(manifest.bodies["br"]) == manifest.bodies["identity"]
+    # PNG уже сжат
+    assert list(assets.by_name["icon.png"].bodies) == ["identity"]
+
+
+def test_choose_encoding(tmp_path):
+    manifest = make_assets(tmp_path).by_name["site.webmanifest"]
+
+    assert accepted_encodings("gzip, deflate;q=0.5, br;q=0") == {"gzip", "deflate"}
+    assert choose_encoding(manifest, "gzip, deflate, br") == "br"
+    assert choose_encoding(manifest, "gzip, br;q=0") == "gzip"
+    assert choose_encoding(manifest, "deflate") == "identity"
+    assert choose_encoding(manifest, None) == "identity"
@@ -0,0 +1,52 @@
+import time
+
+from .auth import SessionCache, new_token, token_hash
+
+
+def test_session_cache_hit():
+    cache = SessionCache(ttl=60)
+
+    cache.put(token_hash("token"), 1)
+
+    assert cache.get(token_hash("token")) == (True, 1)
+    assert cache.get(token_hash("other")) == (False, None)
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1, "maxsize": 100000}
+
+
+def test_session_cache_expired(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache = SessionCache(ttl=60, negative_ttl=5)
+    cache.put("a", 1, expires_in=10)
+    cache.put("b", None)
+
+    # Запись живет не дольше сессии, отсутствие сессии - negative_ttl
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") == (False, None)
+    assert len(cache) == 0
+
+
+def test_session_cache_lru():
+    cache = SessionCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    cache.get("a")
+    cache.put("c", 3)
+    cache.discard("c")
+
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+    assert cache.get("c") == (False, None)
+
+
+def test_session_cache_disabled():
+    cache = SessionCache(ttl=0)
+
+    cache.put("a", 1)
+
+    assert cache.get("a") == (False, None)
+    assert new_token() != new_token()
@@ -0,0 +1,73 @@
+import asyncio
+from argparse import Namespace
+
+import pytest
+
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from . import main
+from .backfill import run
+from .main import Product, data_version_path
+from .versions import DataVersion
+
+
+@pytest.fixture(name="database_url")
+def database_url_fixture(tmp_path):
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+
+@pytest.fixture(name="session")
+def session_fixture(database_url: str):
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def run_backfill(database_url: str, batch_size: int = 1000):
+    args = Namespace(database_url=database_url, batch_size=batch_size, pause=0)
+    return asyncio.run(run(args))
+
+
+def test_backfill(session: Session, database_url: str):
+    # Добавление тестовых данных, clear_name по старым правилам
+    names = {"Ёжевика": "жевика", "Кока-Кола": "кокакола", "Сок": "сок",
+             "Чай 🍵": "чай", "Straße": "strae"}
+    for name, clear_name in names.items():
+        session.add(Product(name=name, clear_name=clear_name))
+    session.commit()
+
+    # Запрос
+    stats = run_backfill(database_url, batch_size=2)
+
+    # Проверка
+    assert stats == {"rules_version": 2, "scanned": 5, "updated": 3, "conflicts": []}
+    session.expunge_all()
+    clear_names = session.exec(select(Product.clear_name).order_by(Product.id)).all()
+    assert clear_names == ["ежевика", "кока кола", "сок", "чай", "strasse"]
+    # Изменения продуктов видны воркерам приложения этой БД, а не DATABASE_URL
+    data_version = DataVersion(data_version_path(database_url))
+    assert data_version.get() == 3
+    assert sorted(data_version.changes(0, 3)) == [1, 2, 5]
+    data_version.close()
+    assert main.data_version.path != data_version.path
+    assert run_backfill(database_url)["updated"] == 0
+
+
+def test_backfill_conflicts(session: Session, database_url: str):
+    # Добавление тестовых данных, после пересчета имена совпадут
+    session.add(Product(name="Ежевика", clear_name="ежевика"))
+    session.add(Product(name="Ёжевика", clear_name="жевика"))
+    session.add(Product(name="Кока-Кола", clear_name="кокакола"))
+    session.commit()
+    product_id = session.exec(select(Product.id).where(Product.name == "Ёжевика")).one()
+
+    # Запрос
+    stats = run_backfill(database_url, batch_size=10)
+
+    # Проверка: остальные строки пачки записаны
+    assert stats["conflicts"] == [product_id]
+    assert stats["updated"] == 1
+    session.expunge_all()
+    assert session.get(Product, product_id).clear_name == "жевика"
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .cancel import Cancelled, Canceller, interruptible
+from .main import create_db_engine
+
+# Счет до 10^9 рекурсивным CTE, без прерывания работает минуты
+SLOW_QUERY = text(
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 1000000000)"
+    " SELECT count(*) FROM c"
+)
+
+
+def test_start_supersedes_same_key():
+    canceller = Canceller()
+
+    first = canceller.start("a")
+    other = canceller.start("b")
+    second = canceller.start("a")
+
+    assert first.cancelled and first.reason == "superseded"
+    assert not other.cancelled
+    assert not second.cancelled
+    with pytest.raises(Cancelled):
+        first.check()
+    second.check()
+
+
+def test_finish_keeps_newer_request():
+    canceller = Canceller()
+    first = canceller.start("a")
+    second = canceller.start("a")
+
+    canceller.finish("a", first)
+    assert canceller.active == {"a": second}
+    canceller.finish("a", second)
+    assert len(canceller) == 0
+
+    # Без ключа запрос не регистрируется
+    canceller.start()
+    assert len(canceller) == 0
+
+
+def test_interruptible_query(tmp_path):
+    engine = create_db_engine("sqlite+aiosqlite:///{}".format(tmp_path / "test.db"))
+    canceller = Canceller()
+
+    async def run():
+        async with AsyncSession(engine) as session:
+            token = canceller.start("a")
+            asyncio.get_running_loop().call_later(0.05, canceller.start, "a")
+            with pytest.raises(OperationalError, match="interrupted"):
+                async with interruptible(session, token):
+                    await session.execute(SLOW_QUERY)
+            await session.rollback()
+
+            # Обработчик снят, соединение работает дальше
+            assert (await session.execute(text("SELECT 1"))).scalar() == 1
+        await engine.dispose()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+
+
+def test_interruptible_disconnect(tmp_path):
+    engine = create_db_engine("sqlite+aiosqlite:///{}".format(tmp_path / "test.db"))
+
+    async def run():
+        messages = asyncio.Queue()
+        messages.put_nowait({"type": "http.request", "body": b""})
+        asyncio.get_running_loop().call_later(
+            0.05, messages.put_nowait, {"type": "http.disconnect"}
+        )
+        token = Canceller().start()
+        async with AsyncSession(engine) as session:
+            with pytest.raises(OperationalError):
+                async with interruptible(session, token, messages.get):
+                    await session.execute(SLOW_QUERY)
+        await engine.dispose()
+        return token
+
+    token = asyncio.run(asyncio.wait_for(run(), 10))
+    assert token.reason == "disconnected"
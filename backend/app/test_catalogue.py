@@ -0,0 +1,42 @@
+import asyncio
+from argparse import Namespace
+
+from sqlmodel import Session, create_engine, select
+
+from . import catalogue, main
+from .main import Category, Product
+from .versions import DataVersion
+
+
+def run(database_url: str, command: str, path: str):
+    args = Namespace(command=command, path=str(path), format=None,
+                     household=main.DEFAULT_HOUSEHOLD, database_url=database_url)
+    return asyncio.run(catalogue.run(args))
+
+
+def test_import_export(tmp_path):
+    # Добавление тестовых данных
+    database_url = f"sqlite:///{tmp_path / 'test.db'}"
+    source = tmp_path / "products.csv"
+    source.write_text("name,category\nМолоко,Молочное\nХлеб,\n", encoding="utf-8")
+
+    # Запрос: новая БД мигрируется, повторный импорт в мигрированную
+    stats = run(database_url, "import", source)
+    repeated = run(database_url, "import", source)
+    run(database_url, "export", tmp_path / "products.jsonl")
+
+    # Проверка
+    assert stats == {"read": 2, "inserted": 2, "invalid": 0, "skipped": 0}
+    assert repeated["skipped"] == 2
+    engine = create_engine(database_url)
+    with Session(engine) as session:
+        products = session.exec(select(Product.name, Category.name)
+                                .join(Category, isouter=True).order_by(Product.id)).all()
+    engine.dispose()
+    assert products == [("Молоко", "Молочное"), ("Хлеб", None)]
+    lines = (tmp_path / "products.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    # Версия данных импортированной БД, а не DATABASE_URL
+    data_version = DataVersion(main.data_version_path(database_url))
+    assert data_version.get() == 1
+    data_version.close()
@@ -0,0 +1,45 @@
+from .coalesce import ToggleCoalescer
+
+
+def test_last_state_wins():
+    toggles = ToggleCoalescer()
+
+    toggles.set(1, True, 1)
+    toggles.set(1, False, 2)
+    toggles.set(2, False, 3)
+    toggles.set(2, True, 4)
+
+    assert toggles.state(1) is False
+    assert toggles.state(2) is True
+    assert toggles.state(3) is None
+    assert toggles.take() == {1: (False, 2), 2: (True, 4)}
+    assert toggles.stats() == {"pending": 0, "toggles": 4, "flushed": 0}
+
+
+def test_state_while_flushing():
+    toggles = ToggleCoalescer()
+    toggles.set(1, True, 1)
+    toggles.set(2, True, 2)
+
+    toggles.take()
+    toggles.set(2, False, 3)
+
+    # Взятое на запись состояние видно до конца записи
+    assert toggles.state(1) is True
+    assert toggles.state(2) is False
+    toggles.done()
+    assert toggles.state(1) is None
+    assert toggles.stats()["flushed"] == 2
+
+
+def test_restore_after_failed_flush():
+    toggles = ToggleCoalescer()
+    toggles.set(1, True, 1)
+    toggles.set(2, True, 2)
+
+    toggles.take()
+    toggles.set(2, False, 3)
+    toggles.restore()
+
+    # Новое переключение важнее возвращенного
+    assert toggles.take() == {1: (True, 1), 2: (False, 3)}
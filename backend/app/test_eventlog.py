@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from sqlalchemy import Column, Integer, MetaData, Table, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from .eventlog import WriteBehind
+
+event = Table("event", MetaData(), Column("id", Integer, primary_key=True),
+              Column("value", Integer))
+
+
+def test_flush():
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as connection:
+            await connection.run_sync(event.metadata.create_all)
+        log = WriteBehind(event)
+        log.add(value=1)
+        log.add(value=2)
+
+        assert await log.flush(engine) == 2
+        assert await log.flush(engine) == 0
+        async with engine.connect() as connection:
+            values = (await connection.execute(select(event.c.value))).scalars().all()
+        await engine.dispose()
+        return values, log.stats()
+
+    values, stats = asyncio.run(run())
+
+    assert values == [1, 2]
+    assert stats == {"pending": 0, "written": 2, "dropped": 0}
+
+
+def test_overflow():
+    log = WriteBehind(event, max_pending=2)
+
+    for value in range(3):
+        log.add(value=value)
+
+    assert list(log.pending) == [{"value": 1}, {"value": 2}]
+    assert log.stats()["dropped"] == 1
+
+
+def test_flush_error():
+    async def run():
+        # Таблицы нет: запись не удастся
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        log = WriteBehind(event, max_pending=3)
+        log.add(value=1)
+        log.add(value=2)
+        with pytest.raises(OperationalError):
+            await log.flush(engine)
+        await engine.dispose()
+        return log
+
+    log = asyncio.run(run())
+
+    # Строки вернулись в буфер в прежнем порядке
+    assert list(log.pending) == [{"value": 1}, {"value": 2}]
+    assert log.stats()["written"] == 0
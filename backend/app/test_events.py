@@ -0,0 +1,70 @@
+import asyncio
+
+from .events import RELOAD, Broadcaster, format_sse
+
+
+def test_publish():
+    async def run():
+        broadcaster = Broadcaster()
+        subscription_1 = broadcaster.subscribe()
+        subscription_2 = broadcaster.subscribe()
+
+        broadcaster.publish("items", "<li>Сок</li>")
+
+        assert await subscription_1.get(timeout=1) == ("items", "<li>Сок</li>")
+        assert await subscription_2.get(timeout=1) == ("items", "<li>Сок</li>")
+        assert await subscription_1.get(timeout=0.01) is None
+
+    asyncio.run(run())
+
+
+def test_unsubscribe():
+    broadcaster = Broadcaster()
+    subscription = broadcaster.subscribe()
+
+    broadcaster.unsubscribe(subscription)
+    broadcaster.publish("items", "<li>Сок</li>")
+
+    assert len(broadcaster) == 0
+    assert subscription.queue.empty()
+
+
+def test_max_subscribers():
+    broadcaster = Broadcaster(max_subscribers=2)
+
+    assert broadcaster.subscribe()
+    assert broadcaster.subscribe()
+    assert broadcaster.subscribe() is None
+
+
+def test_slow_subscriber():
+    broadcaster = Broadcaster(queue_size=2)
+    slow = broadcaster.subscribe()
+
+    for i in range(10):
+        broadcaster.publish("items", str(i))
+
+    # Очередь не растет, отставший клиент получит команду перечитать список
+    assert slow.queue.qsize() <= 2
+    events = [slow.queue.get_nowait() for _ in range(slow.queue.qsize())]
+    assert RELOAD in events
+    assert broadcaster.lagged
+
+
+def test_format_sse():
+    assert format_sse("items", "<li>\n</li>") == "event: items\ndata: <li>\ndata: </li>\n\n"
+    assert format_sse("reload", "") == "event: reload\ndata: \n\n"
+
+
+def test_publish_topic():
+    broadcaster = Broadcaster()
+    household_1 = broadcaster.subscribe(1)
+    household_2 = broadcaster.subscribe(2)
+
+    broadcaster.publish("items", "<li></li>", 1)
+
+    assert household_1.queue.get_nowait() == ("items", "<li></li>")
+    assert household_2.queue.empty()
+    broadcaster.unsubscribe(household_1)
+    broadcaster.unsubscribe(household_1)
+    assert len(broadcaster) == 1
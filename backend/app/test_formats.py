@@ -0,0 +1,65 @@
+import asyncio
+
+from .formats import detect_format, format_header, format_row, iter_lines, read_rows
+
+
+async def chunks(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def chunks_of(lines):
+    for line in lines:
+        yield line
+
+
+def collect(lines):
+    async def run():
+        return [line async for line in lines]
+
+    return asyncio.run(run())
+
+
+def test_iter_lines():
+    data = "Молоко\nСок\r\nХлеб".encode()
+
+    # Куски режут и строки, и многобайтовые символы
+    for size in [1, 3, 100]:
+        assert collect(iter_lines(chunks(data, size))) == ["Молоко\n", "Сок\r\n", "Хлеб"]
+
+
+def test_read_rows_csv():
+    lines = ["\ufeffName,Category\n", "Молоко,Молочное\n", "\n", '"Сок, яблочный",\n']
+
+    rows = collect(read_rows(chunks_of(lines), "csv"))
+
+    assert rows == [{"name": "Молоко", "category": "Молочное"},
+                    {"name": "Сок, яблочный", "category": ""}]
+
+
+def test_read_rows_csv_without_header():
+    rows = collect(read_rows(chunks_of(["Молоко\n", "Хлеб\n"]), "csv"))
+
+    assert rows == [{"name": "Молоко"}, {"name": "Хлеб"}]
+
+
+def test_read_rows_jsonl():
+    lines = ['{"name": "Молоко"}\n', "не json\n", "[1]\n", '{"name": "Хлеб"}']
+
+    rows = collect(read_rows(chunks_of(lines), "jsonl"))
+
+    assert rows == [{"name": "Молоко"}, None, None, {"name": "Хлеб"}]
+
+
+def test_format_row():
+    assert format_header("csv") == "name,category\n"
+    assert format_header("jsonl") == ""
+    assert format_row("Сок, яблочный", None, "csv") == '"Сок, яблочный",\n'
+    assert format_row("Молоко", "Молочное", "jsonl") == (
+        '{"name": "Молоко", "category": "Молочное"}\n')
+
+
+def test_detect_format():
+    assert detect_format("application/x-ndjson") == "jsonl"
+    assert detect_format("text/csv; charset=utf-8") == "csv"
+    assert detect_format(None) == "csv"
@@ -0,0 +1,59 @@
+from jinja2 import DictLoader, Environment
+
+from .fragments import FragmentCache
+
+
+def make_cache(maxsize: int = 4096):
+    env = Environment(loader=DictLoader({"row.html": "<li>{{ name }}</li>"}),
+                      autoescape=True)
+    return FragmentCache(env, maxsize=maxsize)
+
+
+def test_render_hit():
+    cache = make_cache()
+
+    assert cache.render("row.html", 1, 0, name="Сок") == "<li>Сок</li>"
+    assert cache.render("row.html", 1, 0, name="Другое имя") == "<li>Сок</li>"
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1, "maxsize": 4096}
+
+
+def test_bump():
+    cache = make_cache()
+    cache.render("row.html", 1, cache.version(1), name="Сок")
+
+    cache.bump(1)
+
+    assert cache.version(1) == 1
+    assert cache.render("row.html", 1, cache.version(1), name="Морс") == "<li>Морс</li>"
+    assert cache.misses == 2
+
+
+def test_lru_eviction():
+    cache = make_cache(maxsize=2)
+    cache.render("row.html", 1, 0, name="Сок")
+    cache.render("row.html", 2, 0, name="Хлеб")
+    cache.render("row.html", 1, 0, name="Сок")
+    cache.render("row.html", 3, 0, name="Молоко")
+
+    # Вытеснен давно не использованный фрагмент 2
+    assert cache.stats()["size"] == 2
+    cache.render("row.html", 1, 0, name="Сок")
+    assert cache.hits == 2
+    cache.render("row.html", 2, 0, name="Хлеб")
+    assert cache.misses == 4
+
+
+def test_render_escape():
+    cache = make_cache()
+
+    assert cache.render("row.html", 1, 0, name="<b>") == "<li>&lt;b&gt;</li>"
+
+
+def test_invalidate():
+    cache = make_cache()
+    cache.render("row.html", 1, 0, name="Сок")
+
+    cache.invalidate()
+
+    assert cache.render("row.html", 1, 0, name="Морс") == "<li>Морс</li>"
+    assert cache.stats()["misses"] == 2
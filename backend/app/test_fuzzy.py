@@ -0,0 +1,120 @@
+from .fuzzy import BKTree, FuzzyIndex, levenshtein, rank, top_k
+
+
+def test_levenshtein():
+    assert levenshtein("молоко", "малако") == 2
+    assert levenshtein("сок", "сок") == 0
+    assert levenshtein("", "чай") == 3
+    assert levenshtein("кефир", "кофе", limit=1) == 2
+
+
+def test_bk_tree():
+    tree = BKTree()
+    for word in ["молоко", "молот", "сок", "кефир", "молоко"]:
+        tree.add(word)
+
+    assert len(tree) == 4
+    assert sorted(tree.search("малоко", 1)) == [("молоко", 1)]
+    assert sorted(tree.search("молоко", 2)) == [("молоко", 0), ("молот", 2)]
+    assert BKTree().search("сок", 1) == []
+
+
+def test_fuzzy_index_match():
+    index = FuzzyIndex()
+    index.add(1, "молоко домик в деревне")
+    index.add(2, "молоко простоквашино")
+    index.add(3, "кефир")
+
+    assert index.match("малако") == {1: 2, 2: 2}
+    assert index.match("малоко домек") == {1: 2}
+    # Короткие слова - только без опечаток
+    assert index.match("в") == {}
+    assert index.match("кифир") == {3: 1}
+    assert index.match("кифирр") == {3: 2}
+
+
+def test_fuzzy_index_update():
+    index = FuzzyIndex()
+    index.load([(1, "молоко", 0), (2, "кефир", 0)])
+
+    index.add(1, "ряженка")
+    index.remove(2)
+
+    assert index.match("малоко") == {}
+    assert index.match("ряжэнка") == {1: 1}
+    assert index.match("кифир") == {}
+    assert len(index) == 1
+
+
+def test_fuzzy_index_invalidate():
+    index = FuzzyIndex()
+    assert not index.loaded
+
+    index.load([(1, "молоко", 0)])
+    assert index.loaded
+    index.invalidate()
+    assert not index.loaded
+
+
+def test_rank():
+    assert rank("сок", "сок") < rank("сок", "сок яблочный")
+    assert rank("сок", "сок яблочный") < rank("сок", "томатный сок")
+    assert rank("сок", "томатный сок") < rank("сок", "сак", 1)
+    assert rank("сок", "сак", 1) < rank("сок", "сук", 2)
+
+
+def test_top_k():
+    candidates = [(1, "томатный сок"), (2, "сок"), (3, "сок яблочный"),
+                  (4, "сак"), (5, "сок вишневый")]
+
+    assert top_k("сок", candidates, {4: 1}, 3) == [2, 5, 3]
+    assert top_k("сок", candidates, {4: 1}, 10) == [2, 5, 3, 1, 4]
+
+
+def test_fuzzy_index_households():
+    index = FuzzyIndex()
+    index.load([(1, "молоко", 1), (2, "молоко", 2), (3, "кефир", 2)])
+
+    assert index.match("малоко", 1) == {1: 1}
+    assert index.match("малоко", 2) == {2: 1}
+    assert index.match("кифир", 1) == {}
+    # Слово остается в дереве, пока оно есть в продуктах хотя бы одного списка
+    index.remove(1)
+    assert index.match("малоко", 2) == {2: 1}
+    assert index.words == {"молоко": 1, "кефир": 1}
+
+
+def test_fuzzy_index_background_load():
+    index = FuzzyIndex()
+    generation = index.start_load()
+    # Изменения между чтением строк и заменой содержимого
+    index.add(3, "ряженка")
+    index.remove(2)
+
+    assert index.loading and not index.loaded
+    assert index.finish_load([(1, "молоко", 0), (2, "кефир", 0)], generation)
+    assert index.loaded and not index.loading
+    assert index.match("ряжэнка") == {3: 1}
+    assert index.match("кифир") == {}
+    assert index.match("малоко") == {1: 1}
+
+
+def test_fuzzy_index_load_invalidated():
+    index = FuzzyIndex()
+    generation = index.start_load()
+    index.invalidate()
+
+    assert not index.finish_load([(1, "молоко", 0)], generation)
+    assert not index.loaded and not index.loading
+    generation = index.start_load()
+    index.cancel_load(generation)
+    assert not index.loading
+
+
+def test_fuzzy_index_match_limit():
+    index = FuzzyIndex()
+    index.load([(1, "малина", 0), (2, "молоко топленое", 0), (3, "молоко", 0),
+                (4, "молоко 3 2", 0)])
+
+    assert index.match("малако", limit=2) == {3: 2, 4: 2}
+    assert len(index.match("малако")) == 3
@@ -1,17 +1,40 @@
+import asyncio
+import logging
+from datetime import datetime
+
 import pytest
 
 from bs4 import BeautifulSoup as soup
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
-from sqlmodel.pool import StaticPool
-
-from .main import Item, Product, app, get_db, clear
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import main
+from .assets import Assets
+from .auth import SessionCache
+from .cancel import Canceller
+from .coalesce import ToggleCoalescer
+from .eventlog import WriteBehind
+from .events import Broadcaster
+from .fuzzy import FuzzyIndex
+from .test_store import catalogue, stand_in_store
+from .main import (Category, HouseholdInvite, Item, Product, PurchaseEvent,
+                   PurchaseStats, rollup_purchases)
+from .main import app, refresh_recommendations, get_db, clear, create_db_engine, fragments
+from .recommend import Recommender
+from .store import OfferCache, StoreCatalogue
+from .versions import ALL, ChangeCursor, DataVersion
 
 client = TestClient(app)
 
 # TODO: Написать тесты
 # - [ ] POST /products/quick_add return many
-# - [ ] POST /products/needs повторный вызов
+# - [X] POST /products/needs повторный вызов
 # - [ ] POST /products/quick_add empty
 # - [X] PATCH /products/{product_id}
 # - [X] GET /items/{item_id}
@@ -28,29 +51,93 @@ client = TestClient(app)
 # Фикстуры
 #
 
+@pytest.fixture(name="database_url")
+def database_url_fixture(tmp_path):
+    # Файловая БД, чтобы тесты и приложение видели одни и те же данные
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+
 @pytest.fixture(name="session")
-def session_fixture():
-    engine = create_engine(
-        "sqlite://", connect_args={"check_same_thread": False},
-        poolclass=StaticPool
-    )
+def session_fixture(database_url: str):
+    engine = create_engine(database_url)
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
+    engine.dispose()
+
+
+@pytest.fixture(name="db_engine")
+def db_engine_fixture(database_url: str, session: Session):
+    # NullPool: TestClient выполняет каждый запрос в своем event loop
+    return create_db_engine(database_url, poolclass=NullPool)
 
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):  
-    def get_db_override():  
-        return session
+def client_fixture(db_engine: AsyncEngine, monkeypatch: pytest.MonkeyPatch):
+    async def get_db_override():
+        async with AsyncSession(db_engine, expire_on_commit=False) as session:
+            await main.sync_caches(session)
+            yield session
 
     app.dependency_overrides[get_db] = get_db_override  
+    # id строк в новой БД совпадают с предыдущими тестами
+    fragments.clear()
+    monkeypatch.setattr(main, "data_version", DataVersion())
+    monkeypatch.setattr(main, "cache_cursor", ChangeCursor())
+    monkeypatch.setattr(main, "broadcaster", Broadcaster())
+    monkeypatch.setattr(main, "purchase_log", WriteBehind(PurchaseEvent.__table__))
+    monkeypatch.setattr(main, "recommender", Recommender())
+    monkeypatch.setattr(main, "fuzzy_index", FuzzyIndex())
+    # TestClient закрывает event loop после запроса вместе с фоновыми задачами,
+    # словарь опечаток тесты загружают сами через load_fuzzy_index
+    monkeypatch.setattr(main, "start_fuzzy_loader", lambda engine: None)
+    monkeypatch.setattr(main, "toggles", ToggleCoalescer())
+    monkeypatch.setattr(main, "canceller", Canceller())
+    monkeypatch.setattr(main, "session_cache", SessionCache())
+    monkeypatch.setattr(main, "store", None)
 
     client = TestClient(app)  
     yield client  
     app.dependency_overrides.clear()
 
 
+@pytest.fixture(name="queries")
+def queries_fixture(db_engine: AsyncEngine):
+    """SQL запросы, выполненные приложением"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db_engine.sync_engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(name="query_plans")
+def query_plans_fixture(db_engine: AsyncEngine, session: Session):
+    """Планы SQL запросов (EXPLAIN QUERY PLAN), выполненных приложением"""
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            executed.append((statement, parameters))
+
+    def plans():
+        connection = session.connection()
+        return [
+            " ".join(row[-1] for row in connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters))
+            for statement, parameters in executed
+        ]
+
+    engine = db_engine.sync_engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield plans
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 #
 # Тесты
 #
@@ -103,6 +190,122 @@ def test_post_products_notneed_200(session: Session, client: TestClient):
     assert product_el.find("button", attrs={"hx-get": f"/products/{product_1.id}/edit"})
 
 
+def test_post_products_toggles_workers(session: Session, client: TestClient,
+                                      db_engine: AsyncEngine,
+                                      monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+    worker_a, worker_b = ToggleCoalescer(), ToggleCoalescer()
+
+    # Запрос: "нужен" попал в воркер A, позже "не нужен" - в воркер B
+    monkeypatch.setattr(main, "toggles", worker_a)
+    client.post("/products/needs", data={"product_id": product_1.id})
+    monkeypatch.setattr(main, "toggles", worker_b)
+    client.post("/products/notneed", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    monkeypatch.setattr(main, "toggles", worker_a)
+    asyncio.run(main.flush_toggles(db_engine))
+
+    # Проверка: запись воркера A старше и пропущена
+    assert session.exec(select(Item)).all() == []
+    assert worker_a.stats()["pending"] == 0
+
+
+def test_post_products_toggles_coalesced(session: Session, client: TestClient,
+                                        db_engine: AsyncEngine, queries: list):
+    # Добавление тестовых данных
+    products = [Product(name=name, clear_name=clear(name)) for name in ["Молоко", "Хлеб"]]
+    session.add_all(products)
+    session.commit()
+    product_1, product_2 = products
+
+    # Запрос: быстрые переключения до записи в БД
+    queries.clear()
+    client.post("/products/needs", data={"product_id": product_1.id})
+    client.post("/products/notneed", data={"product_id": product_1.id})
+    client.post("/products/needs", data={"product_id": product_1.id})
+    client.post("/products/needs", data={"product_id": product_2.id})
+    client.post("/products/notneed", data={"product_id": product_2.id})
+    responce = client.get("/products/", headers={"HX-Request": "true"})
+
+    # Проверка: запросы только читают, ответ уже с новым состоянием
+    assert not [query for query in queries if not query.startswith("SELECT")]
+    assert session.exec(select(Item)).all() == []
+    parser = soup(responce.text, 'html.parser')
+    assert "inlist" in parser.select(f"#product-{product_1.id}")[0].get("class")
+    assert "inlist" not in parser.select(f"#product-{product_2.id}")[0].get("class")
+    assert client.get("/stats/toggles").json() == {"pending": 2, "toggles": 5, "flushed": 0}
+
+    # Одна транзакция с итоговыми состояниями
+    queries.clear()
+    asyncio.run(main.flush_toggles(db_engine))
+    writes = [query for query in queries if not query.startswith("SELECT")]
+    assert [query.split()[0] for query in writes] == ["INSERT", "DELETE", "INSERT"]
+    assert session.exec(select(Item.product_id)).all() == [product_1.id]
+    assert asyncio.run(main.purchase_log.flush(db_engine)) == 1
+    assert main.toggles.stats()["pending"] == 0
+
+    # Нечего записывать - нет и транзакции
+    queries.clear()
+    asyncio.run(main.flush_toggles(db_engine))
+    assert not queries
+
+
+def test_post_products_needs_in_list(session: Session, client: TestClient,
+                                     db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+    item_1 = Item(product_id=product_1.id, description="2 литра")
+    session.add(item_1)
+    session.commit()
+
+    # Запрос
+    responce = client.post("/products/needs", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+
+    # Проверка: продукт в списке один раз, описание не потеряно
+    assert responce.status_code == 200
+    items = session.exec(select(Item)).all()
+    assert [(item.id, item.description) for item in items] == [(item_1.id, "2 литра")]
+    assert asyncio.run(main.purchase_log.flush(db_engine)) == 0
+
+
+def test_post_products_notneed_not_in_list(session: Session, client: TestClient,
+                                           db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+
+    # Запрос
+    responce = client.post("/products/notneed", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+
+    # Проверка
+    assert responce.status_code == 200
+    assert "inlist" not in soup(responce.text, 'html.parser').find("li").get("class")
+    assert client.post("/products/notneed", data={"product_id": 100}).status_code == 404
+    assert client.post("/products/needs", data={"product_id": 100}).status_code == 404
+
+
+def test_item_product_unique(session: Session):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+    session.add(Item(product_id=product_1.id))
+    session.commit()
+
+    # Проверка
+    session.add(Item(product_id=product_1.id))
+    with pytest.raises(IntegrityError):
+        session.commit()
+
+
 def test_post_products_quick_add_200(session: Session, client: TestClient):
     # Добавление тестовых данных
     product_1_name = "А Тестовый товар"
@@ -120,7 +323,8 @@ def test_post_products_quick_add_200(session: Session, client: TestClient):
     assert parser.select("#products")
     assert len(parser.select("#products li")) == 2
 
-    product_el = parser.select("#products li")[1]
+    # Точное совпадение выше совпадения по подстроке
+    product_el = parser.select("#products li")[0]
     id = product_el.get("id").split("-")[1]
     assert product_el.get("id") == f"product-{id}"
     assert product_el.find("span").get("hx-post") == "/products/needs"
@@ -172,6 +376,7 @@ def test_delete_product_200(session: Session, client: TestClient):
 
     # Проверка
     assert responce.status_code == 200
+    session.expunge_all()
     assert session.get(Product, product_1.id) is None
 
 
@@ -198,6 +403,7 @@ def test_delete_item_200(session: Session, client: TestClient):
 
     # Проверка
     assert responce.status_code == 200
+    session.expunge_all()
     assert session.get(Item, item_1.id) is None
 
 
@@ -343,3 +549,1360 @@ def test_patch_product_in_list_200(session: Session, client: TestClient):
     assert product_el.find("span").text == "Булочки"
     assert product_el.find("button", attrs={"hx-get": f"/products/{product_1.id}/edit"})
     assert item_1.description == "С маком"
+
+
+def test_get_products_search_200(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    for name in ["Молоко", "Молоко топлёное", "Сок", "Хлеб"]:
+        session.add(Product(name=name, clear_name=clear(name)))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "молок"})
+    parser = soup(responce.text, 'html.parser')
+
+    # Проверка
+    assert responce.status_code == 200
+    assert session.connection().exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'product_fts'").first()
+    names = [el.find("span").text for el in parser.select("#products li")]
+    assert names == ["Молоко", "Молоко топлёное"]
+
+
+def test_search_index_sync(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    product_1 = Product(name=product_1_name,
+                        clear_name=clear(product_1_name))
+    session.add(product_1)
+    session.commit()
+    session.refresh(product_1)
+
+    # Переименование и удаление должны обновлять индекс
+    client.patch(f"/products/{product_1.id}", data={"name": "Булочки"})
+    responce = client.get("/products/", params={"name": "тестов"})
+    assert not soup(responce.text, 'html.parser').select("#products li")
+    responce = client.get("/products/", params={"name": "булоч"})
+    assert len(soup(responce.text, 'html.parser').select("#products li")) == 1
+
+    client.delete(f"/products/{product_1.id}")
+    responce = client.get("/products/", params={"name": "булоч"})
+    assert not soup(responce.text, 'html.parser').select("#products li")
+
+
+def test_get_products_search_without_fts_200(session: Session, client: TestClient):
+    # БД без FTS5 индекса
+    for trigger in ["product_fts_ai", "product_fts_ad", "product_fts_au"]:
+        session.connection().exec_driver_sql(f"DROP TRIGGER {trigger}")
+    session.connection().exec_driver_sql("DROP TABLE product_fts")
+    product_1_name = "Тестовый товар"
+    session.add(Product(name=product_1_name, clear_name=clear(product_1_name)))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "товар"})
+    parser = soup(responce.text, 'html.parser')
+
+    # Проверка
+    assert responce.status_code == 200
+    assert len(parser.select("#products li")) == 1
+
+
+def test_get_products_htmx_fragment_200(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    session.add(Product(name=product_1_name, clear_name=clear(product_1_name)))
+    session.commit()
+
+    # Запрос
+    page = client.get("/products/", params={"name": "товар"})
+    fragment = client.get("/products/", params={"name": "товар"},
+                          headers={"HX-Request": "true"})
+    restore = client.get("/products/", params={"name": "товар"},
+                         headers={"HX-Request": "true",
+                                  "HX-History-Restore-Request": "true"})
+
+    # Проверка
+    assert page.status_code == 200
+    assert fragment.status_code == 200
+    assert "<html" in page.text
+    assert soup(page.text, 'html.parser').select("#products li")
+    assert "<html" not in fragment.text
+    assert not soup(fragment.text, 'html.parser').select("#products")
+    assert len(soup(fragment.text, 'html.parser').select("li")) == 1
+    assert len(fragment.content) * 3 < len(page.content)
+    assert fragment.headers["Vary"] == "HX-Request"
+    assert restore.text == page.text
+
+
+def test_post_products_quick_add_htmx_fragment_200(session: Session, client: TestClient):
+    # Запрос
+    page = client.post("/products/quick_add", data={"name": "Тестовый товар"})
+    fragment = client.post("/products/quick_add", data={"name": "Тестовый товар 2"},
+                           headers={"HX-Request": "true"})
+    parser = soup(fragment.text, 'html.parser')
+
+    # Проверка
+    assert page.status_code == 200
+    assert fragment.status_code == 200
+    assert "<html" in page.text
+    assert "<html" not in fragment.text
+    assert [el.find("span").text for el in parser.select("li")] == ["Тестовый товар 2"]
+    assert len(fragment.content) * 3 < len(page.content)
+
+
+def test_get_index_queries(session: Session, client: TestClient, queries: list):
+    # Добавление тестовых данных
+    for name in ["Хлеб", "Сок", "Молоко"]:
+        product = Product(name=name, clear_name=clear(name))
+        session.add(product)
+        session.commit()
+        session.add(Item(product_id=product.id))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/")
+    parser = soup(responce.text, 'html.parser')
+
+    # Проверка
+    assert responce.status_code == 200
+    assert len(queries) == 1
+    names = [el.text for el in parser.select("#items .item-name")]
+    assert names == ["Молоко", "Сок", "Хлеб"]
+
+
+def test_get_product_queries(session: Session, client: TestClient, queries: list):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    product_1 = Product(name=product_1_name,
+                        clear_name=clear(product_1_name))
+    session.add(product_1)
+    session.commit()
+    item_1 = Item(product_id=product_1.id, description="Тестовый комментарий")
+    session.add(item_1)
+    session.commit()
+    # Форма редактирования дополнительно загружает список категорий
+    urls = {f"/products/{product_1.id}": 1,
+            f"/products/{product_1.id}/edit": 2,
+            f"/items/{item_1.id}": 1}
+
+    # Проверка
+    for url, count in urls.items():
+        queries.clear()
+        responce = client.get(url)
+        assert responce.status_code == 200
+        assert len(queries) == count, url
+
+
+def test_create_db_engine_pragmas(database_url: str):
+    async def pragmas():
+        engine = create_db_engine(database_url)
+        async with engine.connect() as connection:
+            result = {
+                name: (await connection.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                for name in ["journal_mode", "synchronous", "busy_timeout"]
+            }
+        await engine.dispose()
+        return result
+
+    # Проверка
+    assert asyncio.run(pragmas()) == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "busy_timeout": 5000,
+    }
+
+
+def test_get_products_fragments_cache(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    for name in ["Молоко", "Сок", "Хлеб"]:
+        session.add(Product(name=name, clear_name=clear(name)))
+    session.commit()
+
+    # Запрос
+    first = client.get("/products/", headers={"HX-Request": "true"})
+    second = client.get("/products/", headers={"HX-Request": "true"})
+    stats = client.get("/stats/fragments").json()
+
+    # Проверка
+    assert first.text == second.text
+    assert stats["misses"] == 3
+    assert stats["hits"] == 3
+
+    # Изменение продукта инвалидирует только его фрагмент
+    product_id = soup(first.text, 'html.parser').select("li")[0].get("id").split("-")[1]
+    client.post("/products/needs", data={"product_id": product_id})
+    responce = client.get("/products/", headers={"HX-Request": "true"})
+    product_el = soup(responce.text, 'html.parser').select(f"#product-{product_id}")[0]
+    assert "inlist" in product_el.get("class")
+    assert client.get("/stats/fragments").json()["hits"] == 6
+
+
+def test_get_item_reused_id(session: Session, client: TestClient, db_engine: AsyncEngine):
+    # Добавление тестовых данных: купленный элемент, id которого получит новый
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    product_2 = Product(name="Хлеб", clear_name=clear("Хлеб"))
+    session.add_all([product_1, product_2])
+    session.commit()
+    client.post("/products/needs", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    item_1 = session.exec(select(Item)).one()
+    client.get("/")
+    client.get(f"/items/{item_1.id}")
+    client.delete(f"/items/{item_1.id}")
+    client.post("/products/needs", data={"product_id": product_2.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    session.expire_all()
+    item_2 = session.exec(select(Item)).one()
+
+    # Запрос
+    index = client.get("/")
+    responce = client.get(f"/items/{item_2.id}")
+
+    # Проверка
+    assert item_2.id == item_1.id
+    assert item_2.product_id == product_2.id
+    assert "Хлеб" in index.text and "Молоко" not in index.text
+    assert "Хлеб" in responce.text and "Молоко" not in responce.text
+
+
+def test_get_index_not_modified(session: Session, client: TestClient, queries: list,
+                                db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    product_1 = Product(name=product_1_name,
+                        clear_name=clear(product_1_name))
+    session.add(product_1)
+    session.commit()
+    session.refresh(product_1)
+
+    # Запрос
+    responce = client.get("/")
+    etag = responce.headers["ETag"]
+    queries.clear()
+    cached = client.get("/", headers={"If-None-Match": etag})
+
+    # Проверка
+    assert responce.status_code == 200
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+    assert not cached.content
+    assert not queries
+
+    # Изменение данных меняет ETag
+    client.post("/products/needs", data={"product_id": product_1.id})
+    etag = client.get("/").headers["ETag"]
+    asyncio.run(main.flush_toggles(db_engine))
+    responce = client.get("/", headers={"If-None-Match": etag})
+    assert responce.status_code == 200
+    assert responce.headers["ETag"] != etag
+    assert soup(responce.text, 'html.parser').select("#items li")
+
+
+def test_get_products_superseded(session: Session, client: TestClient,
+                                 monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    session.add(Product(name="Сок", clear_name=clear("Сок")))
+    session.commit()
+    products_page = main.products_page
+
+    async def superseded_products_page(session, *args):
+        # Пока выполняется запрос, клиент набрал следующую букву
+        main.canceller.start((None, "tab-1", "searchInput"))
+        return await products_page(session, *args)
+
+    monkeypatch.setattr(main, "products_page", superseded_products_page)
+    headers = {"HX-Request": "true", "HX-Trigger": "searchInput", "X-Tab-Id": "tab-1"}
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "со"}, headers=headers)
+    # Другая вкладка с того же адреса не отменяется
+    other_tab = client.get("/products/", params={"name": "со"},
+                           headers={**headers, "X-Tab-Id": "tab-2"})
+
+    # Проверка: ответ без рендеринга
+    assert responce.status_code == 204
+    assert not responce.content
+    assert other_tab.status_code == 200
+    stats = client.get("/stats/cancelled").json()
+    assert stats["superseded"] == 1
+    assert stats["skipped_renders"] == 1
+    assert "search_superseded_total 1" in client.get("/metrics").text
+
+    # Запросы без ключа клиента не отменяются
+    monkeypatch.setattr(main, "products_page", products_page)
+    responce = client.get("/products/", params={"name": "сок"}, headers=headers)
+    assert responce.status_code == 200
+    assert soup(responce.text, 'html.parser').select("li")
+    responce = client.get("/products/", params={"name": "сок"})
+    assert responce.status_code == 200
+    assert client.get("/stats/cancelled").json()["active"] == 0
+
+
+def test_get_products_not_modified(session: Session, client: TestClient):
+    # Запрос
+    page = client.get("/products/", params={"name": "сок"})
+    fragment = client.get("/products/", params={"name": "сок"},
+                          headers={"HX-Request": "true"})
+    other = client.get("/products/", params={"name": "хлеб"})
+
+    # Проверка
+    assert len({page.headers["ETag"], fragment.headers["ETag"], other.headers["ETag"]}) == 3
+    responce = client.get("/products/", params={"name": "сок"},
+                          headers={"If-None-Match": f'"x", {page.headers["ETag"]}'})
+    assert responce.status_code == 304
+    responce = client.get("/products/", params={"name": "сок"},
+                          headers={"If-None-Match": fragment.headers["ETag"]})
+    assert responce.status_code == 200
+
+
+def test_items_events(session: Session, client: TestClient, db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    product_1 = Product(name=product_1_name,
+                        clear_name=clear(product_1_name))
+    session.add(product_1)
+    session.commit()
+    session.refresh(product_1)
+    subscription = main.broadcaster.subscribe(main.DEFAULT_HOUSEHOLD)
+
+    # Запрос
+    client.post("/products/needs", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    client.patch(f"/products/{product_1.id}",
+                 data={"name": "Булочки", "description": "С маком"})
+    client.post("/products/notneed", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    events = [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+
+    # Проверка
+    assert [event for event, _ in events] == ["items", "items", "items"]
+    added, updated, removed = [soup(data, 'html.parser') for _, data in events]
+    item_id = added.select("li")[0].get("id")
+    assert added.find("ul").get("hx-swap-oob") == "beforeend:#items"
+    assert added.select(".item-name")[0].text == product_1_name
+    assert updated.find("li").get("id") == item_id
+    assert updated.find("li").get("hx-swap-oob") == "true"
+    assert updated.select(".item-description")[0].text == "С маком"
+    assert removed.find("li").get("id") == item_id
+    assert removed.find("li").get("hx-swap-oob") == "delete"
+
+
+def test_load_templates(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    env = main.templates.env
+    monkeypatch.setattr(env, "bytecode_cache", FileSystemBytecodeCache(str(tmp_path)))
+    monkeypatch.setattr(env, "cache", {})
+
+    # Запрос
+    main.load_templates()
+
+    # Проверка: все шаблоны скомпилированы и записаны в байткод
+    names = env.list_templates(extensions=["html"])
+    assert "partials/product.html" in names
+    assert len(env.cache) == len(names)
+    assert len(list(tmp_path.iterdir())) == len(names)
+
+
+def test_static_files(client: TestClient, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    (tmp_path / "favicon-32x32.png").write_bytes(b"\x89PNG")
+    (tmp_path / "site.webmanifest").write_text('{"icons": [{"src": "/favicon-32x32.png"}]}' * 10)
+    assets = Assets(str(tmp_path))
+    monkeypatch.setattr(main, "assets", assets)
+    monkeypatch.setitem(main.templates.env.globals, "static_url", assets.url)
+
+    # Запрос
+    page = soup(client.get("/").text, 'html.parser')
+    manifest_url = page.find("link", rel="manifest").get("href")
+    responce = client.get(manifest_url, headers={"Accept-Encoding": "gzip"})
+
+    # Проверка: сжатый заранее файл кэшируется навсегда
+    assert manifest_url == assets.url("site.webmanifest") != "/static/site.webmanifest"
+    assert page.find("link", sizes="32x32").get("href") == assets.url("favicon-32x32.png")
+    assert responce.status_code == 200
+    assert responce.headers["Content-Encoding"] == "gzip"
+    assert responce.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert responce.headers["Vary"] == "Accept-Encoding"
+    assert assets.url("favicon-32x32.png") in responce.text
+    cached = client.get(manifest_url, headers={"If-None-Match": responce.headers["ETag"]})
+    assert cached.status_code == 304
+    assert not cached.content
+
+    # Без отпечатка - с проверкой ETag, PNG не сжимается
+    responce = client.get("/static/favicon-32x32.png", headers={"Accept-Encoding": "br, gzip"})
+    assert responce.headers["Cache-Control"] == "no-cache"
+    assert "Content-Encoding" not in responce.headers
+    assert responce.content == b"\x89PNG"
+    assert client.get("/static/missing.png").status_code == 404
+
+
+def test_events_too_many_subscribers(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "broadcaster", Broadcaster(max_subscribers=0))
+
+    responce = client.get("/events")
+
+    assert responce.status_code == 503
+
+
+def test_post_preset_items_200(session: Session, client: TestClient, queries: list):
+    # Добавление тестовых данных
+    products = [Product(name=name, clear_name=clear(name))
+                for name in ["Мука", "Яйца", "Молоко", "Соль"]]
+    session.add_all(products)
+    session.commit()
+    product_ids = [product.id for product in products]
+    session.add(Item(product_id=product_ids[1], description="Десяток"))
+    session.commit()
+
+    responce = client.post("/presets/", data={"name": "Блины",
+                                              "product_id": product_ids[:3],
+                                              "description": ["", "", "2 литра"]})
+    preset_id = responce.json()["id"]
+
+    # Запрос
+    queries.clear()
+    responce = client.post(f"/presets/{preset_id}/items")
+    parser = soup(responce.text, 'html.parser')
+
+    # Проверка
+    assert responce.status_code == 200
+    assert [el.text for el in parser.select(".item-name")] == ["Молоко", "Мука"]
+    assert [el.text for el in parser.select(".item-description")] == ["2 литра"]
+    assert len([query for query in queries if query.startswith("INSERT")]) == 1
+    session.expunge_all()
+    items = session.exec(select(Item)).all()
+    assert sorted(item.product_id for item in items) == sorted(product_ids[:3])
+
+    # Повторное добавление ничего не меняет
+    responce = client.post(f"/presets/{preset_id}/items")
+    assert responce.status_code == 200
+    assert not responce.text
+    assert len(session.exec(select(Item)).all()) == 3
+
+
+def test_post_preset_items_404(session: Session, client: TestClient):
+    responce = client.post("/presets/123/items")
+    assert responce.status_code == 404
+
+
+def metric(text: str, name: str):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+def test_get_metrics(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    product_1_name = "Тестовый товар"
+    product_1 = Product(name=product_1_name,
+                        clear_name=clear(product_1_name))
+    session.add(product_1)
+    session.commit()
+    session.refresh(product_1)
+    route = 'method="GET",route="/products/{product_id}"'
+    before = client.get("/metrics").text
+
+    # Запрос
+    responce = client.get(f"/products/{product_1.id}")
+    after = client.get("/metrics").text
+
+    # Проверка
+    def delta(name):
+        return metric(after, name) - metric(before, name)
+
+    assert delta(f"http_request_sql_statements_sum{{{route}}}") == 1
+    assert delta(f"http_request_sql_statements_count{{{route}}}") == 1
+    assert delta(f"http_response_size_bytes_sum{{{route}}}") == len(responce.content)
+    assert delta(f"http_request_render_duration_seconds_count{{{route}}}") == 1
+    assert delta(f"http_request_render_duration_seconds_sum{{{route}}}") > 0
+    assert delta(f'http_request_duration_seconds_count{{{route},status="200"}}') == 1
+    assert "fragment_cache_misses_total 1" in after
+
+
+def test_slow_request_log(session: Session, client: TestClient,
+                          monkeypatch: pytest.MonkeyPatch, caplog):
+    monkeypatch.setattr(main.metrics, "slow_request", 0)
+
+    with caplog.at_level(logging.WARNING, logger="app.slow"):
+        client.get("/")
+
+    assert len(caplog.records) == 1
+    assert "GET / (/)" in caplog.text
+    assert "FROM item JOIN product" in caplog.text
+
+
+def test_get_products_pages(session: Session, client: TestClient,
+                            monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "PRODUCTS_PAGE_SIZE", 2)
+    # Добавление тестовых данных, одинаковые имена (в разных категориях)
+    # упорядочены по id
+    category_1 = Category(name="Напитки")
+    session.add(category_1)
+    session.commit()
+    names = ["Сок", "Молоко", "Сок", "Хлеб", "Мука"]
+    for i, name in enumerate(names):
+        category_id = category_1.id if i == 2 else None
+        session.add(Product(name=name, clear_name=clear(name), categoty_id=category_id))
+    session.commit()
+
+    # Запрос
+    pages = []
+    responce = client.get("/products/", headers={"HX-Request": "true"})
+    while True:
+        assert responce.status_code == 200
+        assert "content-length" not in responce.headers
+        parser = soup(responce.text, 'html.parser')
+        rows = parser.select("li[id^=product-]")
+        pages.append([(el.find("span").text, el.get("id")) for el in rows])
+        trigger = parser.find("li", attrs={"hx-trigger": "revealed"})
+        # Следующие страницы - только строки списка без обертки
+        assert bool(parser.find("ul")) == (len(pages) == 1)
+        if not trigger:
+            break
+        responce = client.get(trigger.get("hx-get"), headers={"HX-Request": "true"})
+
+    # Проверка
+    assert [len(page) for page in pages] == [2, 2, 1]
+    rows = [row for page in pages for row in page]
+    assert [name for name, _ in rows] == sorted(names)
+    assert len({id for _, id in rows}) == 5
+
+
+def test_get_products_pages_search(session: Session, client: TestClient,
+                                   monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "PRODUCTS_PAGE_SIZE", 2)
+    for name in ["Сок яблочный", "Сок вишневый", "Хлеб", "Сок томатный"]:
+        session.add(Product(name=name, clear_name=clear(name)))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "сок"})
+    parser = soup(responce.text, 'html.parser')
+    trigger = parser.find("li", attrs={"hx-trigger": "revealed"})
+    responce = client.get(trigger.get("hx-get"), headers={"HX-Request": "true"})
+
+    # Проверка
+    assert len(parser.select("#products li[id^=product-]")) == 2
+    assert "name=%D1%81%D0%BE%D0%BA" in trigger.get("hx-get")
+    names = [el.find("span").text for el in soup(responce.text, 'html.parser').select("li")]
+    assert names == ["Сок яблочный"]
+
+
+def test_categories_crud(session: Session, client: TestClient):
+    # Запрос
+    responce = client.post("/categories/", data={"name": "Овощи"})
+    category_id = responce.json()["id"]
+    duplicate = client.post("/categories/", data={"name": "Овощи"})
+    client.post("/categories/", data={"name": "Молочное"})
+    renamed = client.patch(f"/categories/{category_id}", data={"name": "Фрукты"})
+    conflict = client.patch(f"/categories/{category_id}", data={"name": "Молочное"})
+
+    # Проверка
+    assert responce.status_code == 200
+    assert duplicate.status_code == 409
+    assert renamed.json()["name"] == "Фрукты"
+    assert conflict.status_code == 409
+    names = [category["name"] for category in client.get("/categories/").json()]
+    assert names == ["Молочное", "Фрукты"]
+    assert client.patch("/categories/999", data={"name": "Нет"}).status_code == 404
+    assert client.delete("/categories/999").status_code == 404
+
+
+def test_delete_category_200(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    product_1 = Product(name="Морковь", clear_name=clear("Морковь"),
+                        categoty_id=category_1.id)
+    session.add(product_1)
+    session.commit()
+
+    category_id, product_id = category_1.id, product_1.id
+
+    # Запрос
+    responce = client.delete(f"/categories/{category_id}")
+
+    # Проверка
+    assert responce.status_code == 200
+    session.expunge_all()
+    assert session.get(Category, category_id) is None
+    assert session.get(Product, product_id).categoty_id is None
+
+
+def test_delete_category_409(session: Session, client: TestClient):
+    # Добавление тестовых данных, без категории уже есть продукт с тем же именем
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    session.add(Product(name="Морковь", clear_name=clear("Морковь")))
+    session.add(Product(name="Морковь", clear_name=clear("Морковь"),
+                        categoty_id=category_1.id))
+    session.commit()
+
+    # Запрос
+    responce = client.delete(f"/categories/{category_1.id}")
+
+    # Проверка
+    assert responce.status_code == 409
+    session.expire_all()
+    assert session.get(Category, category_1.id)
+
+
+def test_get_products_category_200(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    category_2 = Category(name="Молочное")
+    session.add_all([category_1, category_2])
+    session.commit()
+    products = [("Морковь", category_1.id), ("Молоко", category_2.id),
+                ("Капуста", category_1.id), ("Соль", None)]
+    for name, category_id in products:
+        session.add(Product(name=name, clear_name=clear(name), categoty_id=category_id))
+    session.commit()
+
+    # Запрос
+    def names(params):
+        responce = client.get("/products/", params=params,
+                              headers={"HX-Request": "true"})
+        assert responce.status_code == 200
+        return [el.find("span").text
+                for el in soup(responce.text, 'html.parser').select("li[id^=product-]")]
+
+    # Проверка
+    assert names({"category_id": category_1.id}) == ["Капуста", "Морковь"]
+    assert names({"category_id": 0}) == ["Соль"]
+    assert names({"category_id": category_1.id, "name": "мор"}) == ["Морковь"]
+    assert names({"sort": "category"}) == ["Соль", "Капуста", "Морковь", "Молоко"]
+
+
+def test_get_products_category_pages(session: Session, client: TestClient,
+                                     monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "PRODUCTS_PAGE_SIZE", 2)
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    products = [("Морковь", category_1.id), ("Молоко", None),
+                ("Капуста", category_1.id), ("Соль", None), ("Лук", category_1.id)]
+    for name, category_id in products:
+        session.add(Product(name=name, clear_name=clear(name), categoty_id=category_id))
+    session.commit()
+
+    # Запрос
+    rows = []
+    url = "/products/?sort=category"
+    while url:
+        responce = client.get(url, headers={"HX-Request": "true"})
+        parser = soup(responce.text, 'html.parser')
+        rows += [el.find("span").text for el in parser.select("li[id^=product-]")]
+        trigger = parser.find("li", attrs={"hx-trigger": "revealed"})
+        url = trigger and trigger.get("hx-get")
+
+    # Проверка
+    assert rows == ["Молоко", "Соль", "Капуста", "Лук", "Морковь"]
+
+
+def test_post_products_quick_add_category(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+
+    # Запрос
+    data = {"name": "Морковь", "category_id": category_1.id}
+    responce_1 = client.post("/products/quick_add", data=data)
+    responce_2 = client.post("/products/quick_add", data=data)
+    responce_3 = client.post("/products/quick_add", data={"name": "морковь"})
+
+    # Проверка
+    assert responce_1.status_code == 200
+    # Повторное добавление не создает дубль, а показывает найденный продукт
+    assert responce_2.status_code == 200
+    assert len(soup(responce_2.text, 'html.parser').select("li[id^=product-]")) == 1
+    assert responce_3.status_code == 200
+    products = session.exec(select(Product).order_by(Product.id)).all()
+    assert [product.categoty_id for product in products] == [category_1.id, None]
+
+
+def test_get_products_exists_in_category(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    session.add(Product(name="Морковь", clear_name=clear("Морковь"),
+                        categoty_id=category_1.id))
+    session.commit()
+
+    # Запрос
+    responce_1 = client.get("/products/", params={"name": "Морковь"})
+    responce_2 = client.get("/products/", params={"name": "морковь",
+                                                  "category_id": category_1.id})
+
+    # Проверка
+    assert soup(responce_1.text, 'html.parser').find("form", id="itemForm")
+    assert not soup(responce_2.text, 'html.parser').find("form", id="itemForm")
+
+
+def test_patch_product_category(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    product_1 = Product(name="Морковь", clear_name=clear("Морковь"))
+    product_2 = Product(name="Морковь", clear_name=clear("Морковь"),
+                        categoty_id=category_1.id)
+    session.add_all([product_1, product_2])
+    session.commit()
+
+    # Запрос
+    form = client.get(f"/products/{product_2.id}/edit")
+    kept = client.patch(f"/products/{product_2.id}", data={"name": "Морковка"})
+    conflict = client.patch(f"/products/{product_2.id}",
+                            data={"name": "Морковь", "category_id": 0})
+    moved = client.patch(f"/products/{product_1.id}",
+                         data={"name": "Морковь", "category_id": category_1.id})
+
+    # Проверка
+    option = soup(form.text, 'html.parser').find("option", selected=True)
+    assert option.get("value") == str(category_1.id)
+    assert kept.status_code == 200
+    assert conflict.status_code == 409
+    assert moved.status_code == 200
+    session.expire_all()
+    assert session.get(Product, product_2.id).categoty_id == category_1.id
+    assert session.get(Product, product_1.id).categoty_id == category_1.id
+
+
+def test_category_query_plans(session: Session, client: TestClient, query_plans):
+    # Добавление тестовых данных
+    category_1 = Category(name="Овощи")
+    session.add(category_1)
+    session.commit()
+    product_1 = Product(name="Морковь", clear_name=clear("Морковь"),
+                        categoty_id=category_1.id)
+    session.add(product_1)
+    session.commit()
+    session.add(Item(product_id=product_1.id))
+    session.commit()
+
+    # Запрос
+    client.get("/products/", params={"category_id": category_1.id})
+    client.get("/", params={"category_id": category_1.id})
+    client.get("/products/", params={"sort": "category"})
+
+    # Проверка: фильтр и сортировка по индексу, без временного B-дерева
+    plans = [plan for plan in query_plans() if "product" in plan.lower()]
+    assert plans
+    for plan in plans:
+        assert "ix_product_household_category_clear_name" in plan, plan
+        assert "TEMP B-TREE" not in plan, plan
+
+
+def test_purchase_log(session: Session, client: TestClient, db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+
+    # Запрос: добавлен и куплен, добавлен и убран без покупки
+    client.post("/products/needs", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    item_id = session.exec(select(Item.id)).one()
+    client.delete(f"/items/{item_id}")
+    client.post("/products/needs", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+    client.post("/products/notneed", data={"product_id": product_1.id})
+    asyncio.run(main.flush_toggles(db_engine))
+
+    # Проверка: до сброса буфера журнал в БД пуст
+    assert session.exec(select(PurchaseEvent)).all() == []
+    assert asyncio.run(main.purchase_log.flush(db_engine)) == 4
+    kinds = session.exec(select(PurchaseEvent.kind).order_by(PurchaseEvent.id)).all()
+    assert kinds == ["add", "buy", "add", "remove"]
+
+    assert asyncio.run(rollup_purchases(db_engine)) == 1
+    # Повторный rollup не учитывает события дважды
+    assert asyncio.run(rollup_purchases(db_engine)) == 0
+    stats = session.get(PurchaseStats, product_1.id)
+    assert (stats.adds, stats.purchases, stats.removes) == (2, 1, 1)
+    assert stats.interval_days is None
+
+
+def test_rollup_purchases_intervals(session: Session, db_engine: AsyncEngine):
+    # Добавление тестовых данных, две пачки событий между rollup
+    def buy(day):
+        session.add(PurchaseEvent(product_id=1, kind="buy",
+                                  created_at=datetime(2024, 1, day)))
+        session.commit()
+
+    buy(1)
+    buy(5)
+    asyncio.run(rollup_purchases(db_engine))
+    buy(9)
+    buy(13)
+    asyncio.run(rollup_purchases(db_engine))
+
+    # Проверка
+    stats = session.get(PurchaseStats, 1)
+    assert stats.purchases == 4
+    assert stats.first_bought_at == datetime(2024, 1, 1)
+    assert stats.last_bought_at == datetime(2024, 1, 13)
+    assert stats.interval_days == 4
+    assert stats.last_event_id == 4
+
+
+def test_get_history(session: Session, client: TestClient, queries: list):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    product_2 = Product(name="Хлеб", clear_name=clear("Хлеб"))
+    session.add_all([product_1, product_2])
+    session.commit()
+    session.add(PurchaseStats(product_id=product_1.id, purchases=1, adds=1,
+                              first_bought_at=datetime(2024, 1, 1),
+                              last_bought_at=datetime(2024, 1, 1)))
+    session.add(PurchaseStats(product_id=product_2.id, purchases=3, adds=3,
+                              first_bought_at=datetime(2024, 1, 1),
+                              last_bought_at=datetime(2024, 1, 15)))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/history/")
+    history = client.get(f"/products/{product_2.id}/history")
+
+    # Проверка: только сводка, журнал не читается
+    assert responce.status_code == 200
+    assert [row["name"] for row in responce.json()] == ["Хлеб", "Молоко"]
+    assert responce.json()[0]["interval_days"] == 7
+    assert not any("purchaseevent" in query for query in queries)
+    assert "Куплен 3 раз" in history.text
+    assert "15.01.2024" in history.text
+    assert client.get("/products/999/history").text.strip() == ""
+
+
+def test_get_index_recommendations(session: Session, client: TestClient,
+                                   db_engine: AsyncEngine, queries: list):
+    # Добавление тестовых данных: хлеб с молоком покупали дважды
+    products = {}
+    for name in ["Хлеб", "Молоко", "Сыр"]:
+        products[name] = Product(name=name, clear_name=clear(name))
+        session.add(products[name])
+    session.commit()
+    purchases = [("Хлеб", 1, 10), ("Молоко", 1, 11), ("Хлеб", 5, 10),
+                 ("Молоко", 5, 12), ("Сыр", 9, 10)]
+    for name, day, hour in purchases:
+        session.add(PurchaseEvent(product_id=products[name].id, kind="buy",
+                                  created_at=datetime(2024, 1, day, hour)))
+    session.commit()
+    version = main.data_version.get()
+
+    # Запрос
+    touched = asyncio.run(refresh_recommendations(db_engine))
+    queries.clear()
+    responce = client.get("/")
+    index_queries = len(queries)
+    related = client.get("/recommendations/",
+                         params={"product_id": products["Хлеб"].id})
+
+    # Проверка
+    assert touched == 3
+    assert main.data_version.get() == version + 1
+    assert asyncio.run(refresh_recommendations(db_engine)) == 0
+    assert responce.status_code == 200
+    # Список и рекомендованные продукты по первичному ключу
+    assert index_queries == 2
+    parser = soup(responce.text, 'html.parser')
+    names = [el.text for el in parser.select("#recommendations li")]
+    # Две покупки весят больше одной, при равенстве - свежая покупка
+    assert names == ["Молоко", "Хлеб", "Сыр"]
+    names = [el.text for el in soup(related.text, 'html.parser').select("li")]
+    assert names == ["Молоко"]
+
+
+def test_get_index_recommendations_not_in_list(session: Session, client: TestClient,
+                                              db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    product_1 = Product(name="Хлеб", clear_name=clear("Хлеб"))
+    product_2 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add_all([product_1, product_2])
+    session.commit()
+    for product in [product_1, product_2]:
+        session.add(PurchaseEvent(product_id=product.id, kind="buy",
+                                  created_at=datetime(2024, 1, 1)))
+    session.add(Item(product_id=product_1.id))
+    session.commit()
+    asyncio.run(refresh_recommendations(db_engine))
+
+    # Запрос
+    responce = client.get("/")
+    related = client.get("/recommendations/", params={"product_id": product_2.id})
+
+    # Проверка: список не пуст - рекомендаций на главной нет,
+    # уже добавленный продукт не рекомендуется
+    assert not soup(responce.text, 'html.parser').select("#recommendations")
+    assert not soup(related.text, 'html.parser').select("li")
+
+
+def load_fuzzy_index(db_engine: AsyncEngine):
+    """Загрузка словаря опечаток, которую приложение делает в фоне"""
+    asyncio.run(main.load_fuzzy_index(db_engine, main.fuzzy_index.start_load()))
+
+
+def test_get_products_fuzzy_ranking(session: Session, client: TestClient,
+                                    db_engine: AsyncEngine):
+    # Добавление тестовых данных
+    names = ["Молоко топленое", "Кокосовое молоко", "Молоко", "Мука", "Малина",
+             "Сгущенное молоко"]
+    for name in names:
+        session.add(Product(name=name, clear_name=clear(name)))
+    session.commit()
+    load_fuzzy_index(db_engine)
+
+    # Запрос
+    def search(name):
+        responce = client.get("/products/", params={"name": name},
+                              headers={"HX-Request": "true"})
+        assert responce.status_code == 200
+        return [el.find("span").text
+                for el in soup(responce.text, 'html.parser').select("li[id^=product-]")]
+
+    # Проверка: точное, префикс, подстрока, опечатки
+    assert search("молоко") == ["Молоко", "Молоко топленое", "Кокосовое молоко",
+                                "Сгущенное молоко"]
+    assert search("малако") == ["Молоко", "Молоко топленое", "Кокосовое молоко",
+                                "Сгущенное молоко"]
+    assert search("мука") == ["Мука"]
+    assert search("малако тапленое") == ["Молоко топленое"]
+
+
+def test_get_products_fuzzy_incremental(session: Session, client: TestClient,
+                                        db_engine: AsyncEngine, queries: list):
+    # Добавление тестовых данных
+    session.add(Product(name="Кефир", clear_name=clear("Кефир")))
+    session.commit()
+    load_fuzzy_index(db_engine)
+
+    # Запрос: продукты меняются через приложение
+    client.post("/products/quick_add", data={"name": "Ряженка"})
+    product_id = session.exec(select(Product.id).where(Product.name == "Ряженка")).one()
+    client.patch(f"/products/{product_id}", data={"name": "Творог"})
+    client.delete("/products/1")
+    queries.clear()
+    responce_1 = client.get("/products/", params={"name": "тварог"})
+    responce_2 = client.get("/products/", params={"name": "ряжэнка"})
+    responce_3 = client.get("/products/", params={"name": "кифир"})
+
+    # Проверка: словарь обновлен без перечитывания всех продуктов
+    assert not [query for query in queries if query.endswith("FROM product")]
+    assert len(soup(responce_1.text, 'html.parser').select("li[id^=product-]")) == 1
+    assert not soup(responce_2.text, 'html.parser').select("li[id^=product-]")
+    assert not soup(responce_3.text, 'html.parser').select("li[id^=product-]")
+
+
+def test_get_products_other_worker(session: Session, client: TestClient,
+                                   db_engine: AsyncEngine, queries: list):
+    # Добавление тестовых данных
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+    load_fuzzy_index(db_engine)
+    client.get("/products/")
+    # Продукты изменены другим воркером
+    product_2 = Product(name="Кефир", clear_name=clear("Кефир"))
+    session.add(product_2)
+    product_1.name = "Молоко 3,2%"
+    session.commit()
+    main.data_version.bump(product_1.id, product_2.id)
+    queries.clear()
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "кифир"})
+    page = client.get("/products/")
+
+    # Проверка: словарь опечаток дочитан по двум продуктам, без полной загрузки
+    assert not [query for query in queries if query.endswith("FROM product")]
+    names = [el.find("span").text
+             for el in soup(responce.text, 'html.parser').select("li[id^=product-]")]
+    assert names == ["Кефир"]
+    # Фрагмент переименованного продукта отрендерен заново
+    names = [el.find("span").text
+             for el in soup(page.text, 'html.parser').select("li[id^=product-]")]
+    assert names == ["Кефир", "Молоко 3,2%"]
+
+
+def test_get_products_fuzzy_reload(session: Session, client: TestClient,
+                                   db_engine: AsyncEngine, queries: list,
+                                   monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    load_fuzzy_index(db_engine)
+    queries.clear()
+    # Продукты добавлены импортом другого процесса
+    session.add(Product(name="Кефир", clear_name=clear("Кефир")))
+    session.add(Product(name="Кефир 1%", clear_name=clear("Кефир 1%")))
+    session.commit()
+    main.data_version.bump(ALL)
+    started = []
+    monkeypatch.setattr(main, "start_fuzzy_loader", started.append)
+
+    # Запрос: словарь перечитывается в фоне, до этого - поиск по подстроке
+    responce_1 = client.get("/products/", params={"name": "кифир"})
+    responce_2 = client.get("/products/", params={"name": "кефир"})
+    request_queries = list(queries)
+    load_fuzzy_index(db_engine)
+    responce_3 = client.get("/products/", params={"name": "кифир"})
+
+    # Проверка
+    assert len(started) == 2
+    assert not [query for query in request_queries if query.endswith("FROM product")]
+    assert not soup(responce_1.text, 'html.parser').select("li[id^=product-]")
+    assert len(soup(responce_2.text, 'html.parser').select("li[id^=product-]")) == 2
+    names = [el.find("span").text
+             for el in soup(responce_3.text, 'html.parser').select("li[id^=product-]")]
+    assert names == ["Кефир", "Кефир 1%"]
+
+
+def test_get_products_fuzzy_limit(session: Session, client: TestClient,
+                                  db_engine: AsyncEngine, queries: list,
+                                  monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "PRODUCTS_PAGE_SIZE", 2)
+    # Добавление тестовых данных: опечатка находит больше продуктов, чем на странице
+    for n in range(10):
+        session.add(Product(name=f"Молоко {n}", clear_name=clear(f"Молоко {n}")))
+    session.commit()
+    load_fuzzy_index(db_engine)
+    queries.clear()
+
+    # Запрос
+    responce = client.get("/products/", params={"name": "малако"},
+                          headers={"HX-Request": "true"})
+
+    # Проверка: в запрос к БД переданы только id, которые могут попасть на страницу
+    search = [query for query in queries if "product.id IN" in query][0]
+    assert search.count("?") <= 5
+    names = [el.find("span").text
+             for el in soup(responce.text, 'html.parser').select("li[id^=product-]")]
+    assert names == ["Молоко 0", "Молоко 1"]
+
+
+def test_import_products(session: Session, client: TestClient,
+                         monkeypatch: pytest.MonkeyPatch, queries: list):
+    monkeypatch.setattr(main, "IMPORT_CHUNK_SIZE", 2)
+    # Добавление тестовых данных
+    session.add(Product(name="Хлеб", clear_name=clear("Хлеб")))
+    session.commit()
+    body = ("name,category\n"
+            "Молоко,Молочное\n"
+            "Кефир,Молочное\n"
+            "молоко!,Молочное\n"
+            "хлеб,\n"
+            "🍏,\n"
+            "Молоко,\n")
+
+    # Запрос
+    responce = client.post("/products/import", content=body.encode(),
+                           headers={"Content-Type": "text/csv"})
+
+    # Проверка: дубли в файле и с существующими пропущены
+    assert responce.status_code == 200
+    assert responce.json() == {"read": 6, "inserted": 3, "invalid": 1, "skipped": 2}
+    products = session.exec(select(Product.name, Product.categoty_id)
+                            .order_by(Product.id)).all()
+    category_id = session.exec(select(Category.id)).one()
+    assert products == [("Хлеб", None), ("Молоко", category_id),
+                        ("Кефир", category_id), ("Молоко", None)]
+    # Пять продуктов пачками по два, пачка - один INSERT
+    inserts = [query for query in queries if query.startswith("INSERT OR IGNORE INTO product")]
+    assert len(inserts) == 3
+
+
+def test_import_products_jsonl(session: Session, client: TestClient):
+    body = '{"name": "Молоко", "category": "Молочное"}\n{"name": 1}\n'
+
+    responce = client.post("/products/import", params={"format": "jsonl"},
+                           content=body.encode())
+
+    assert responce.json() == {"read": 2, "inserted": 1, "invalid": 1, "skipped": 0}
+    assert client.post("/products/import", params={"format": "xml"}).status_code == 400
+
+
+def test_export_products(session: Session, client: TestClient,
+                         monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+    # Добавление тестовых данных
+    category_1 = Category(name="Молочное")
+    session.add(category_1)
+    session.commit()
+    for name in ["Молоко", "Сок, яблочный", "Хлеб"]:
+        category_id = category_1.id if name == "Молоко" else None
+        session.add(Product(name=name, clear_name=clear(name), categoty_id=category_id))
+    session.commit()
+
+    # Запрос
+    responce_csv = client.get("/products/export")
+    responce_jsonl = client.get("/products/export", params={"format": "jsonl"})
+
+    # Проверка
+    assert responce_csv.status_code == 200
+    assert responce_csv.headers["content-type"].startswith("text/csv")
+    assert "content-length" not in responce_csv.headers
+    assert responce_csv.text == ('name,category\n'
+                                 'Молоко,Молочное\n'
+                                 '"Сок, яблочный",\n'
+                                 'Хлеб,\n')
+    lines = responce_jsonl.text.splitlines()
+    assert lines[0] == '{"name": "Молоко", "category": "Молочное"}'
+    assert len(lines) == 3
+    # Экспорт импортируется обратно без дублей
+    responce = client.post("/products/import", content=responce_csv.content)
+    assert responce.json()["skipped"] == 3
+
+
+#
+# Домохозяйства
+#
+
+def test_households_isolated(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    session.add(Product(name="Молоко", clear_name=clear("Молоко")))
+    session.commit()
+    responce_1 = client.post("/households/", data={"name": "Первое"})
+    cookie_1 = client.cookies["session"]
+    client.post("/products/quick_add", data={"name": "Хлеб"})
+    client.cookies.clear()
+    client.post("/households/", data={"name": "Второе"})
+
+    # Запрос
+    products = client.get("/products/", params={"name": "хлеб"})
+    products_all = client.get("/products/")
+    product_1 = session.exec(select(Product).where(Product.name == "Хлеб")).one()
+    foreign = client.get(f"/products/{product_1.id}")
+    needs = client.post("/products/needs", data={"product_id": product_1.id})
+    client.cookies.set("session", cookie_1)
+    own = client.get(f"/products/{product_1.id}")
+
+    # Проверка
+    assert responce_1.status_code == 200
+    assert responce_1.json()["name"] == "Первое"
+    assert product_1.household_id == responce_1.json()["id"]
+    assert "Хлеб" not in products.text
+    assert "Молоко" not in products_all.text
+    assert foreign.status_code == 404
+    assert needs.status_code == 404
+    assert own.status_code == 200
+
+
+def test_household_recommendations(session: Session, client: TestClient,
+                                   db_engine: AsyncEngine):
+    # Добавление тестовых данных: покупки только в первом домохозяйстве
+    household_1 = client.post("/households/", data={"name": "Первое"}).json()["id"]
+    cookie_1 = client.cookies["session"]
+    client.post("/products/quick_add", data={"name": "Хлеб"})
+    product = session.exec(select(Product).where(Product.name == "Хлеб")).one()
+    item = Item(product_id=product.id, household_id=household_1)
+    session.add(item)
+    session.commit()
+    client.delete(f"/items/{item.id}")
+    client.cookies.clear()
+    client.post("/households/", data={"name": "Второе"})
+    asyncio.run(main.purchase_log.flush(db_engine))
+    asyncio.run(refresh_recommendations(db_engine))
+
+    # Запрос
+    responce_2 = client.get("/")
+    client.cookies.set("session", cookie_1)
+    responce_1 = client.get("/")
+
+    # Проверка
+    events = session.exec(select(PurchaseEvent)).all()
+    assert {event.household_id for event in events} == {household_1}
+    assert not soup(responce_2.text, 'html.parser').select("#recommendations")
+    names = [el.text for el in
+             soup(responce_1.text, 'html.parser').select("#recommendations li")]
+    assert names == ["Хлеб"]
+
+
+def test_household_categories(session: Session, client: TestClient):
+    # Добавление тестовых данных: одноименные категории двух домохозяйств
+    client.post("/households/", data={"name": "Первое"})
+    category_1 = client.post("/categories/", data={"name": "Овощи"}).json()["id"]
+    client.post("/products/quick_add", data={"name": "Морковь",
+                                             "category_id": category_1})
+    client.cookies.clear()
+    client.post("/households/", data={"name": "Второе"})
+
+    # Запрос
+    responce = client.post("/categories/", data={"name": "Овощи"})
+    categories = client.get("/categories/").json()
+    renamed = client.patch(f"/categories/{category_1}", data={"name": "Фрукты"})
+    deleted = client.delete(f"/categories/{category_1}")
+    quick_add = client.post("/products/quick_add", data={"name": "Лук",
+                                                         "category_id": category_1})
+    imported = client.post("/products/import", content="name,category\nСвекла,Овощи\n",
+                           headers={"Content-Type": "text/csv"})
+
+    # Проверка
+    assert responce.status_code == 200
+    assert [category["id"] for category in categories] == [responce.json()["id"]]
+    assert renamed.status_code == 404
+    assert deleted.status_code == 404
+    assert quick_add.status_code == 404
+    assert imported.json()["inserted"] == 1
+    product = session.exec(select(Product).where(Product.name == "Свекла")).one()
+    assert product.categoty_id == responce.json()["id"]
+    session.expire_all()
+    assert session.get(Category, category_1).name == "Овощи"
+    carrot = session.exec(select(Product).where(Product.name == "Морковь")).one()
+    assert carrot.categoty_id == category_1
+
+
+def test_household_invite(session: Session, client: TestClient):
+    # Добавление тестовых данных: два устройства входят по одной ссылке
+    client.post("/households/", data={"name": "Дом"})
+    client.post("/products/quick_add", data={"name": "Хлеб"})
+    url = client.post("/households/invite").json()["url"]
+    token = url.rsplit("/", 1)[1]
+    client.cookies.clear()
+    joined_1 = client.get(url, follow_redirects=False)
+    cookie_1 = client.cookies["session"]
+    client.cookies.clear()
+    joined_2 = client.get(url, follow_redirects=False)
+    cookie_2 = client.cookies["session"]
+
+    # Запрос: первое устройство выходит
+    client.cookies.set("session", cookie_1)
+    logout = client.delete("/sessions/")
+    client.cookies.set("session", cookie_2)
+    products = client.get("/products/")
+
+    # Проверка: у каждого устройства своя сессия, ссылка - не сессия
+    assert joined_1.status_code == joined_2.status_code == 303
+    assert len({token, cookie_1, cookie_2}) == 3
+    assert logout.status_code == 204
+    assert "Хлеб" in products.text
+    assert session.exec(select(HouseholdInvite)).one().token_hash != token
+    client.cookies.set("session", token)
+    assert "Хлеб" not in client.get("/products/").text
+    assert client.get("/invites/unknown").status_code == 404
+
+
+def test_household_invite_expired(session: Session, client: TestClient,
+                                  monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    monkeypatch.setattr(main, "INVITE_HOURS", 0)
+    client.post("/households/", data={"name": "Дом"})
+    url = client.post("/households/invite").json()["url"]
+    client.cookies.clear()
+
+    # Запрос
+    responce = client.get(url, follow_redirects=False)
+
+    # Проверка
+    assert responce.status_code == 404
+    assert "session" not in client.cookies
+
+
+def test_household_session_cached(session: Session, client: TestClient,
+                                  queries: list):
+    # Добавление тестовых данных
+    client.post("/households/", data={"name": "Дом"})
+    queries.clear()
+
+    # Запрос
+    client.get("/products/")
+    client.get("/products/", params={"name": "хлеб"})
+
+    # Проверка: сессия прочитана из БД только первым запросом
+    assert sum("household_session" in query for query in queries) == 1
+    assert main.session_cache.stats()["hits"] == 1
+
+
+def test_household_unauthorized(session: Session, client: TestClient,
+                                monkeypatch: pytest.MonkeyPatch):
+    # Запрос: неизвестная cookie без AUTH_REQUIRED не мешает работать
+    client.cookies.set("session", "unknown")
+    optional = client.get("/products/")
+    monkeypatch.setattr(main, "AUTH_REQUIRED", True)
+    responce = client.get("/products/")
+    client.cookies.clear()
+
+    # Проверка
+    assert optional.status_code == 200
+    assert responce.status_code == 401
+    assert responce.json()["detail"] == "Session expired"
+    assert client.get("/").status_code == 401
+    assert client.get("/categories/").status_code == 401
+
+
+#
+# Магазин
+#
+
+def test_store_offers(session: Session, client: TestClient,
+                      monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных
+    store = stand_in_store()
+    monkeypatch.setattr(main, "store", OfferCache(catalogue(store)))
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    product_2 = Product(name="Хлеб", clear_name=clear("Хлеб"), household_id=1)
+    product_3 = Product(name="Сыр", clear_name=clear("Сыр"))
+    session.add_all([product_1, product_2, product_3])
+    session.commit()
+
+    # Запрос
+    responce = client.get("/products/", headers={"HX-Request": "true"})
+    loader = soup(responce.text, 'html.parser').select_one("li[hx-trigger=load]")
+    requests_before = list(store.state.requests)
+    offers = client.get("/store/offers", params={
+        "product_id": [product_1.id, product_2.id, product_3.id]})
+
+    # Проверка: страница не ждет магазин, предложения - одним запросом
+    assert requests_before == []
+    assert loader["hx-get"] == (f"/store/offers?product_id={product_1.id}"
+                                f"&product_id={product_3.id}")
+    assert store.state.requests == [["молоко", "сыр"]]
+    swaps = soup(offers.text, 'html.parser').select("[hx-swap-oob]")
+    assert [swap["hx-swap-oob"] for swap in swaps] == [
+        f"beforeend:#product-{product_1.id}"]
+    assert "89.90" in offers.text
+    assert client.get("/stats/store").json()["lookups"] == 1
+
+
+def test_store_offers_release_connection(session: Session, client: TestClient,
+                                         db_engine: AsyncEngine,
+                                         monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных: магазин запоминает число занятых соединений
+    connections = []
+    event.listen(db_engine.sync_engine, "checkout", lambda *args: connections.append(1))
+    event.listen(db_engine.sync_engine, "checkin", lambda *args: connections.pop())
+    held = []
+
+    class Catalogue(StoreCatalogue):
+        async def lookup(self, names):
+            held.append(len(connections))
+            return {}
+
+    monkeypatch.setattr(main, "store", OfferCache(Catalogue()))
+    product_1 = Product(name="Молоко", clear_name=clear("Молоко"))
+    session.add(product_1)
+    session.commit()
+
+    # Запрос
+    responce = client.get("/store/offers", params={"product_id": product_1.id})
+
+    # Проверка
+    assert responce.status_code == 200
+    assert held == [0]
+
+
+def test_store_disabled(session: Session, client: TestClient):
+    # Добавление тестовых данных
+    session.add(Product(name="Молоко", clear_name=clear("Молоко")))
+    session.commit()
+
+    # Запрос
+    responce = client.get("/products/")
+
+    # Проверка
+    assert "/store/offers" not in responce.text
+    assert client.get("/store/offers").status_code == 404
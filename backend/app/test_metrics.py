@@ -0,0 +1,41 @@
+import time
+
+import jinja2
+
+from .metrics import Histogram, RequestStats, TimedTemplate, current_stats
+
+
+def test_histogram_expose():
+    histogram = Histogram("sql_statements", "SQL statements.", ["route"], [1, 5])
+    histogram.observe(1, "/")
+    histogram.observe(3, "/")
+    histogram.observe(10, "/")
+
+    assert list(histogram.expose()) == [
+        "# HELP sql_statements SQL statements.",
+        "# TYPE sql_statements histogram",
+        'sql_statements_bucket{route="/",le="1"} 1',
+        'sql_statements_bucket{route="/",le="5"} 2',
+        'sql_statements_bucket{route="/",le="+Inf"} 3',
+        'sql_statements_sum{route="/"} 14.0',
+        'sql_statements_count{route="/"} 3',
+    ]
+
+
+def test_timed_template():
+    env = jinja2.Environment()
+    env.template_class = TimedTemplate
+    template = env.from_string("{{ value }}")
+    stats = RequestStats()
+
+    token = current_stats.set(stats)
+    try:
+        start = time.perf_counter()
+        assert template.render(value="Сок") == "Сок"
+        elapsed = time.perf_counter() - start
+    finally:
+        current_stats.reset(token)
+
+    assert 0 < stats.render_time <= elapsed
+    # Вне запроса статистика не собирается
+    assert template.render(value="Сок") == "Сок"
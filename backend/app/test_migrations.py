@@ -0,0 +1,179 @@
+import pytest
+
+from sqlalchemy import create_engine, inspect, text
+
+from . import main, migrations
+
+# Исходная схема, созданная create_all до миграций: без уникальных индексов,
+# поэтому в ней бывают одинаковые продукты, категории и элементы списка
+BASELINE_SCHEMA = [
+    "CREATE TABLE category (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id))",
+    "CREATE TABLE product (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "clear_name VARCHAR NOT NULL, categoty_id INTEGER, PRIMARY KEY (id), "
+    "FOREIGN KEY(categoty_id) REFERENCES category (id))",
+    "CREATE TABLE item (id INTEGER NOT NULL, description VARCHAR, "
+    "product_id INTEGER, PRIMARY KEY (id), "
+    "FOREIGN KEY(product_id) REFERENCES product (id))",
+]
+BASELINE_DATA = [
+    "INSERT INTO category (name) VALUES ('Овощи'), ('Овощи'), ('Молочное')",
+    "INSERT INTO product (name, clear_name, categoty_id) VALUES "
+    "('Молоко', 'молоко', 3), ('молоко', 'молоко', 3), ('Морковь', 'морковь', 1), "
+    "('Морковь', 'морковь', 2), ('Хлеб', 'хлеб', NULL)",
+    "INSERT INTO item (product_id, description) VALUES "
+    "(1, NULL), (1, NULL), (2, '2 л'), (4, NULL)",
+]
+
+
+def search(connection, query: str):
+    return connection.execute(text(
+        "SELECT rowid FROM product_fts WHERE product_fts MATCH :query ORDER BY rowid"),
+        {"query": query}).scalars().all()
+
+
+@pytest.fixture(name="engine")
+def engine_fixture(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade_new_database(engine):
+    # Запрос
+    with engine.connect() as connection:
+        first = migrations.upgrade(connection)
+    with engine.connect() as connection:
+        second = migrations.upgrade(connection)
+        migrations.check(connection)
+        tables = inspect(connection).get_table_names()
+
+    # Проверка: второй запуск ничего не делает
+    assert first == (0, len(migrations.MIGRATIONS))
+    assert second == (len(migrations.MIGRATIONS), len(migrations.MIGRATIONS))
+    assert {"product", "item", "household_session", "product_fts"} <= set(tables)
+
+
+def test_upgrade_old_database(engine):
+    # Добавление тестовых данных
+    with engine.begin() as connection:
+        for ddl in BASELINE_SCHEMA + BASELINE_DATA:
+            connection.execute(text(ddl))
+
+    # Запрос
+    with engine.connect() as connection:
+        migrations.upgrade(connection)
+
+    # Проверка: дубли слиты в продукт и категорию с меньшим id
+    with engine.begin() as connection:
+        migrations.check(connection)
+        assert connection.execute(text(
+            "SELECT id, household_id, name FROM category ORDER BY id")).all() == [
+            (1, 0, "Овощи"), (3, 0, "Молочное")]
+        assert connection.execute(text(
+            "SELECT id, household_id, categoty_id FROM product ORDER BY id")).all() == [
+            (1, 0, 3), (3, 0, 1), (5, 0, None)]
+        assert connection.execute(text(
+            "SELECT household_id, product_id FROM item ORDER BY product_id")).all() == [
+            (0, 1), (0, 3)]
+        assert search(connection, "моло") == [1]
+        assert search(connection, "морк") == [3]
+        connection.execute(text("DELETE FROM product WHERE id = 5"))
+        assert search(connection, "хлеб") == []
+        product_indexes = migrations.index_list(connection, "product")
+        assert product_indexes["ix_product_household_category_clear_name"]
+        assert migrations.index_list(connection, "item")["ix_item_product_id"]
+        assert migrations.index_list(connection, "category")["ix_category_household_name"]
+        assert "ix_preset_household_id" in migrations.index_list(connection, "preset")
+
+
+def test_upgrade_interrupted(engine, monkeypatch: pytest.MonkeyPatch):
+    # Добавление тестовых данных: шаг households падает после изменения схемы
+    with engine.begin() as connection:
+        for ddl in BASELINE_SCHEMA + BASELINE_DATA:
+            connection.execute(text(ddl))
+
+    def households(connection):
+        migrations.households(connection)
+        raise RuntimeError("interrupted")
+
+    steps = migrations.MIGRATIONS
+    monkeypatch.setattr(migrations, "MIGRATIONS", steps[:2] + [households] + steps[3:])
+
+    # Запрос
+    with engine.connect() as connection:
+        with pytest.raises(RuntimeError, match="interrupted"):
+            migrations.upgrade(connection)
+    with engine.connect() as connection:
+        interrupted = migrations.current_version(connection)
+        columns = {column["name"] for column in inspect(connection).get_columns("product")}
+    monkeypatch.setattr(migrations, "MIGRATIONS", steps)
+    with engine.connect() as connection:
+        resumed = migrations.upgrade(connection)
+
+    # Проверка: шаг откатился целиком, повторный запуск продолжает с него
+    assert interrupted == 2
+    assert "household_id" not in columns
+    assert resumed == (2, len(steps))
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM product")).scalar() == 3
+
+
+def test_upgrade_stale_search_index(engine):
+    # Добавление тестовых данных: FTS индекс есть, продукты добавлены без триггеров
+    with engine.begin() as connection:
+        for ddl in BASELINE_SCHEMA:
+            connection.execute(text(ddl))
+        connection.execute(text(main.PRODUCT_FTS_DDL[0]))
+        for ddl in BASELINE_DATA:
+            connection.execute(text(ddl))
+
+    # Запрос
+    with engine.connect() as connection:
+        migrations.upgrade(connection)
+
+    # Проверка: индекс перестроен, удаление продукта проходит
+    with engine.begin() as connection:
+        assert search(connection, "моло") == [1]
+        connection.execute(text("DELETE FROM product WHERE id = 1"))
+        assert search(connection, "моло") == []
+
+
+def test_upgrade_household_categories(engine):
+    # Добавление тестовых данных: версия 3, категории общие для всех домохозяйств
+    with engine.connect() as connection:
+        migrations.upgrade(connection)
+    with engine.begin() as connection:
+        for ddl in [
+            "DROP TABLE category",
+            "CREATE TABLE category (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE)",
+            "ALTER TABLE purchaseevent DROP COLUMN household_id",
+            "UPDATE schema_version SET version = 3",
+            "INSERT INTO category (name) VALUES ('Овощи'), ('Молочное')",
+            "INSERT INTO product (household_id, name, clear_name, categoty_id) "
+            "VALUES (1, 'Морковь', 'морковь', 1), (2, 'Лук', 'лук', 1)",
+        ]:
+            connection.execute(text(ddl))
+
+    # Запрос
+    with engine.connect() as connection:
+        migrations.upgrade(connection)
+
+    # Проверка: каждое домохозяйство получило свою копию категории
+    with engine.connect() as connection:
+        categories = connection.execute(text(
+            "SELECT id, household_id, name FROM category ORDER BY id")).all()
+        assert categories == [(1, 0, "Овощи"), (2, 0, "Молочное"),
+                              (3, 1, "Овощи"), (4, 2, "Овощи")]
+        assert connection.execute(text(
+            "SELECT categoty_id FROM product ORDER BY id")).scalars().all() == [3, 4]
+        assert migrations.index_list(connection, "category") == {
+            "ix_category_household_name": True}
+        assert "household_id" in {
+            column["name"] for column in inspect(connection).get_columns("purchaseevent")}
+
+
+def test_check_outdated(engine):
+    with engine.connect() as connection:
+        with pytest.raises(RuntimeError, match="python -m app.migrations"):
+            migrations.check(connection)
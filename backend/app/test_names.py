@@ -0,0 +1,26 @@
+import pytest
+
+from .names import clear, compile_rules
+
+
+def test_clear():
+    assert clear("Тестовый товар 🍏") == "тестовый товар"
+    assert clear("Ёжевика") == "ежевика"
+    assert clear("  Кока-Кола  0,5 л ") == "кока кола 0 5 л"
+    assert clear("STRASSE") == clear("Straße") == "strasse"
+    assert clear("ｃａｆｅ ﬁ") == "cafe fi"
+    assert clear("Çay Ελληνικός") == "çay ελληνικόσ"
+
+
+def test_clear_cache():
+    clear.cache_clear()
+
+    clear("Молоко")
+    clear("Молоко")
+
+    assert clear.cache_info().hits == 1
+
+
+def test_compile_rules_unknown():
+    with pytest.raises(ValueError):
+        compile_rules([("upper",)])
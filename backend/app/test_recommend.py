@@ -0,0 +1,73 @@
+from .recommend import Recommender
+
+DAY = 86400
+
+
+def test_related():
+    recommender = Recommender(top_k=2, basket_gap=3600)
+
+    # Две корзины: хлеб с молоком дважды, хлеб с сыром один раз
+    recommender.update([(1, 0, 10, 0), (2, 0, 20, 60), (3, 0, 30, 120)])
+    recommender.update([(4, 0, 10, DAY), (5, 0, 20, DAY + 60)])
+
+    assert recommender.related(10) == [20, 30]
+    assert recommender.related(20) == [10, 30]
+    assert recommender.related(30) == [10, 20]
+    assert recommender.related(40) == []
+    # Поровну покупок, но молоко куплено позже
+    assert recommender.popular(0) == [20, 10]
+    assert recommender.last_event_id == 5
+
+
+def test_recency():
+    recommender = Recommender(top_k=3, half_life_days=1, basket_gap=0)
+
+    # Старые покупки весят меньше одной свежей
+    recommender.update([(1, 0, 10, 0), (2, 0, 10, 1), (3, 0, 10, 2), (4, 0, 20, 10 * DAY)])
+
+    assert recommender.popular(0) == [20, 10]
+
+
+def test_repeated_in_basket():
+    recommender = Recommender(basket_gap=3600)
+
+    recommender.update([(1, 0, 10, 0), (2, 0, 10, 60), (3, 0, 20, 120)])
+
+    assert recommender.related(10) == [20]
+    assert recommender.cooccurrence[10][20] == recommender.cooccurrence[20][10]
+
+
+def test_rescale():
+    recommender = Recommender(top_k=3, half_life_days=1, basket_gap=3600)
+
+    recommender.update([(1, 0, 10, 0), (2, 0, 20, 1), (3, 0, 30, 2)])
+    # Через 100 дней показатель экспоненты больше порога, веса пересчитаны
+    recommender.update([(4, 0, 40, 100 * DAY), (5, 0, 10, 100 * DAY + 1)])
+
+    assert len(recommender) == 4
+    assert max(recommender.popularity[0].values()) < 10
+    assert recommender.related(10) == [40, 30, 20]
+    assert recommender.popular(0)[0] == 10
+
+
+def test_sparse():
+    recommender = Recommender(basket_gap=0)
+
+    # 5000 продуктов парами: память по числу пар, а не по квадрату каталога
+    recommender.update([(n, 0, n, n // 2) for n in range(5000)])
+
+    assert len(recommender) == 5000
+    assert sum(map(len, recommender.cooccurrence.values())) == 5000
+
+
+def test_households():
+    recommender = Recommender(basket_gap=3600)
+
+    # Покупки двух домохозяйств в одно время - разные корзины
+    recommender.update([(1, 1, 10, 0), (2, 2, 20, 60), (3, 1, 30, 120)])
+
+    assert recommender.related(10) == [30]
+    assert recommender.related(20) == []
+    assert recommender.popular(1) == [30, 10]
+    assert recommender.popular(2) == [20]
+    assert recommender.popular(3) == []
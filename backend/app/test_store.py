@@ -0,0 +1,130 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+
+from .store import HttpStoreCatalogue, Offer, OfferCache, StoreCatalogue
+
+PRICES = {"молоко": 89.9, "хлеб": 45}
+
+
+def stand_in_store():
+    """Локальная замена магазина: запоминает запросы, отвечает по PRICES"""
+    store = FastAPI()
+    store.state.requests = []
+    store.state.prices = dict(PRICES)
+    store.state.ready = None
+
+    @store.post("/lookup")
+    async def lookup(request: Request):
+        names = (await request.json())["names"]
+        store.state.requests.append(names)
+        if store.state.ready is not None:
+            await store.state.ready.wait()
+        if store.state.prices is None:
+            return Response(status_code=500)
+        return {
+            name: {"title": name.title(), "price": price, "url": f"https://store/{name}"}
+            for name, price in store.state.prices.items()
+            if name in names
+        }
+
+    return store
+
+
+def catalogue(store: FastAPI, batch_size: int = 100):
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=store),
+                               base_url="http://store")
+    return HttpStoreCatalogue(client, batch_size)
+
+
+def test_catalogue_without_lookup():
+    class Catalogue(StoreCatalogue):
+        async def aclose(self):
+            pass
+
+    with pytest.raises(TypeError, match="lookup"):
+        Catalogue()
+
+
+def test_lookup_batches():
+    store = stand_in_store()
+
+    offers = asyncio.run(catalogue(store, batch_size=2).lookup(["молоко", "хлеб", "сыр"]))
+
+    assert offers == {"молоко": Offer("Молоко", 89.9, "https://store/молоко"),
+                      "хлеб": Offer("Хлеб", 45.0, "https://store/хлеб"),
+                      "сыр": None}
+    assert store.state.requests == [["молоко", "хлеб"], ["сыр"]]
+
+
+def test_concurrent_lookups_coalesced():
+    store = stand_in_store()
+    cache = OfferCache(catalogue(store))
+
+    async def lookups():
+        store.state.ready = asyncio.Event()
+        first = asyncio.ensure_future(cache.get(["молоко", "хлеб"]))
+        second = asyncio.ensure_future(cache.get(["хлеб"]))
+        await asyncio.sleep(0)
+        store.state.ready.set()
+        return await first, await second
+
+    first, second = asyncio.run(lookups())
+
+    assert store.state.requests == [["молоко", "хлеб"]]
+    assert first["молоко"].price == 89.9
+    assert second["хлеб"].price == 45
+    assert cache.stats()["coalesced"] == 1
+
+
+def test_stale_while_revalidate():
+    store = stand_in_store()
+    cache = OfferCache(catalogue(store), ttl=0, stale_ttl=60)
+
+    async def lookups():
+        await cache.get(["молоко"])
+        store.state.prices["молоко"] = 99.9
+        stale = cache.peek(["молоко"])
+        await asyncio.gather(*cache._inflight.values())
+        return stale, cache.peek(["молоко"])
+
+    stale, fresh = asyncio.run(lookups())
+
+    # Устаревшее отдано сразу, обновленное - следующему запросу
+    assert stale["молоко"].price == 89.9
+    assert fresh["молоко"].price == 99.9
+    assert cache.stats()["stale"] == 2
+
+
+def test_slow_store_not_awaited():
+    store = stand_in_store()
+    cache = OfferCache(catalogue(store))
+
+    async def lookups():
+        store.state.ready = asyncio.Event()
+        offers = await cache.get(["молоко"], timeout=0.01)
+        store.state.ready.set()
+        await asyncio.gather(*cache._inflight.values())
+        return offers
+
+    # Не дождавшийся запрос заполнил кэш для следующих
+    assert asyncio.run(lookups()) == {}
+    assert cache.peek(["молоко"])["молоко"].price == 89.9
+
+
+def test_store_errors_keep_cached():
+    store = stand_in_store()
+    cache = OfferCache(catalogue(store), ttl=0, stale_ttl=60)
+
+    async def lookups():
+        await cache.get(["молоко"])
+        store.state.prices = None
+        return await cache.get(["молоко"]), await cache.get(["хлеб"])
+
+    stale, missing = asyncio.run(lookups())
+
+    assert stale["молоко"].price == 89.9
+    assert missing == {}
+    assert cache.stats()["errors"] == 2
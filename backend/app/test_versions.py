@@ -0,0 +1,75 @@
+from .versions import ALL, ChangeCursor, DataVersion
+
+
+def test_data_version_memory():
+    version = DataVersion()
+
+    assert version.get() == 0
+    assert version.bump() == 1
+    assert version.get() == 1
+
+
+def test_data_version_shared_file(tmp_path):
+    # Два экземпляра, как два воркера с общим файлом
+    path = str(tmp_path / "app.db.version")
+    worker_1 = DataVersion(path)
+    worker_2 = DataVersion(path)
+
+    assert worker_1.get() == worker_2.get() == 0
+    worker_1.bump()
+    assert worker_2.get() == 1
+    worker_2.bump()
+    worker_2.bump()
+    assert worker_1.get() == 3
+
+    worker_1.close()
+    worker_2.close()
+    assert DataVersion(path).get() == 3
+
+
+def test_data_version_changes(tmp_path):
+    path = str(tmp_path / "app.db.version")
+    worker_1 = DataVersion(path, capacity=4)
+    worker_2 = DataVersion(path, capacity=4)
+
+    assert worker_1.bump(7, 8) == 2
+    assert worker_1.bump() == 3
+    assert worker_2.changes(0, 3) == [7, 8]
+    assert worker_2.changes(2, 3) == []
+    # Изменено все
+    worker_1.bump(ALL)
+    assert worker_2.changes(3, 4) is None
+    # Кольцо перезаписано
+    worker_1.bump(1, 2, 3)
+    assert worker_2.changes(4, 7) == [1, 2, 3]
+    assert worker_2.changes(2, 7) is None
+    assert worker_2.changes(0, 7) is None
+
+
+def test_data_version_old_file(tmp_path):
+    # Файл без кольца от предыдущей версии приложения
+    path = tmp_path / "app.db.version"
+    path.write_bytes((5).to_bytes(8, "little"))
+    version = DataVersion(str(path))
+
+    assert version.get() == 5
+    assert version.changes(4, 5) is None
+    assert version.bump(1) == 6
+    assert version.changes(5, 6) == [1]
+
+
+def test_change_cursor():
+    version = DataVersion()
+    cursor = ChangeCursor()
+
+    assert cursor.poll(version) == []
+    # Свои изменения
+    cursor.seen(version.bump(1, 2), 1, 2)
+    assert cursor.poll(version) == []
+    # Изменения другого воркера, свои после них
+    version.bump(3)
+    cursor.seen(version.bump(4), 4)
+    assert cursor.poll(version) == [3, 4]
+    version.bump(ALL)
+    assert cursor.poll(version) is None
+    assert cursor.version == 5
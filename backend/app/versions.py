@@ -0,0 +1,131 @@
+import fcntl
+import mmap
+import os
+import struct
+from typing import Optional
+
+COUNTER = struct.Struct("<Q")
+# Ячейка кольца изменений: версия и id измененного продукта
+SLOT = struct.Struct("<Qq")
+# id продукта в ячейке: версия без изменений продуктов, изменено все
+NOTHING = -1
+ALL = 0
+
+
+class DataVersion:
+    """Монотонный счетчик версии данных
+
+    Хранится в файле, отображенном в память, поэтому общий для всех
+    воркеров gunicorn на одной машине: чтение - это чтение из памяти без
+    системных вызовов, увеличение выполняется под блокировкой flock.
+    Без пути счетчик живет в анонимной памяти одного процесса.
+
+    За счетчиком в том же файле лежит кольцо из capacity последних
+    изменений: по нему воркер узнает, какие продукты изменили другие
+    воркеры, и обновляет свои кэши по одному продукту.
+    """
+
+    def __init__(self, path: Optional[str] = None, capacity: int = 4096):
+        self.path = path
+        self.capacity = capacity
+        self.size = COUNTER.size + capacity * SLOT.size
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            return self._map
+        if self.path is None:
+            self._map = mmap.mmap(-1, self.size)
+            return self._map
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < self.size:
+            # Новый или старый файл без кольца, другой воркер мог успеть раньше
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size < self.size:
+                    os.ftruncate(self._fd, self.size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, self.size)
+        return self._map
+
+    def _slot(self, version: int):
+        return COUNTER.size + version % self.capacity * SLOT.size
+
+    def get(self):
+        return COUNTER.unpack_from(self._open(), 0)[0]
+
+    def bump(self, *product_ids: int):
+        """Увеличение версии, вызывается после commit изменений
+
+        Каждый измененный продукт получает свою версию, ALL - изменено все.
+        Без id версия увеличивается на 1, например, для смены ETag.
+        """
+        counter = self._open()
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            version = COUNTER.unpack_from(counter, 0)[0]
+            for product_id in product_ids or (NOTHING,):
+                version += 1
+                SLOT.pack_into(counter, self._slot(version), version, product_id)
+            # Счетчик после ячеек: читатель не увидит версию без ее изменения
+            COUNTER.pack_into(counter, 0, version)
+        finally:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return version
+
+    def changes(self, since: int, until: int):
+        """id продуктов, измененных в версиях (since, until]
+
+        None - изменения уже вытеснены из кольца или изменено все.
+        """
+        if until - since > self.capacity:
+            return None
+        counter = self._open()
+        product_ids = []
+        for version in range(since + 1, until + 1):
+            slot_version, product_id = SLOT.unpack_from(counter, self._slot(version))
+            if slot_version != version or product_id == ALL:
+                return None
+            if product_id != NOTHING:
+                product_ids.append(product_id)
+        return product_ids
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class ChangeCursor:
+    """Версия данных, до которой изменения применены к кэшам процесса"""
+
+    def __init__(self, version: int = 0):
+        self.version = version
+
+    def poll(self, data_version: DataVersion):
+        """id продуктов, измененных с прошлого вызова, None - изменено все
+
+        Без изменений - только чтение счетчика из памяти.
+        """
+        version = data_version.get()
+        if version == self.version:
+            return []
+        product_ids = data_version.changes(self.version, version)
+        self.version = version
+        return product_ids
+
+    def seen(self, version: int, *product_ids: int):
+        """Свои изменения из bump процесс применил сам
+
+        Если другие процессы успели что-то изменить раньше, курсор не
+        сдвигается и все изменения будут прочитаны при следующем poll.
+        """
+        if self.version == version - max(len(product_ids), 1):
+            self.version = version
@@ -0,0 +1 @@
+"""Бенчмарки бэкенда, запуск из каталога backend: python -m benchmarks.<name>"""
@@ -0,0 +1,131 @@
+"""Время холодного старта: от запуска процесса до первого успешного ответа
+
+    python -m benchmarks.coldstart --runs 5
+
+БД мигрируется заранее, как при развертывании. Каждый запуск - отдельный
+процесс uvicorn: cold - с пустым каталогом байткода шаблонов, warm - с
+байткодом от предыдущего запуска. Отдельно сравнивается проверка схемы
+при старте воркера с прежним create_all на той же БД.
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel
+
+from app import migrations
+from app.main import create_search_index
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_response(env: dict, timeout: float = 30):
+    """(секунды до первого 200 на /, время первого поиска) одного запуска"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port)],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = "http://127.0.0.1:{}".format(port)
+        with httpx.Client(base_url=url) as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if client.get("/").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            else:
+                raise RuntimeError("Server did not start")
+            ready = time.perf_counter() - start
+            search_start = time.perf_counter()
+            client.get("/products/", params={"name": "хлеб"})
+            return ready, time.perf_counter() - search_start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def boot_schema_cost(database_url: str, runs: int):
+    """Средние секунды create_all и проверки версии на мигрированной БД"""
+    engine = create_engine(database_url)
+    results = {}
+    for name, step in [
+        (
+            "create_all",
+            lambda c: (SQLModel.metadata.create_all(c), create_search_index(c)),
+        ),
+        ("check", migrations.check),
+    ]:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                step(connection)
+            times.append(time.perf_counter() - start)
+        results[name] = statistics.mean(times)
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = "sqlite:///{}".format(os.path.join(directory, "bench.db"))
+        cache_dir = os.path.join(directory, "templates")
+        env = dict(os.environ, DATABASE_URL=database_url, TEMPLATE_CACHE_DIR=cache_dir)
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "app.migrations", "--database-url", database_url],
+            cwd=BACKEND_DIR,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        print("migrations: {:.3f} s".format(time.perf_counter() - start))
+
+        for name, seconds in boot_schema_cost(database_url, args.runs).items():
+            print("boot {:<10} {:>8.2f} ms".format(name, seconds * 1000))
+
+        print("{:<6} {:>12} {:>12}".format("cache", "ready ms", "search ms"))
+        for mode in ("cold", "warm"):
+            results = []
+            for _ in range(args.runs):
+                if mode == "cold":
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                os.makedirs(cache_dir, exist_ok=True)
+                results.append(first_response(env))
+            ready, search = zip(*results)
+            print(
+                "{:<6} {:>12.1f} {:>12.2f}".format(
+                    mode,
+                    statistics.median(ready) * 1000,
+                    statistics.median(search) * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
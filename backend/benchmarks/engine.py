@@ -0,0 +1,112 @@
+"""Конкурентное чтение и запись через движок БД с PRAGMA и без
+
+python -m benchmarks.engine --readers 8 --writers 2 --duration 5
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from sqlmodel import SQLModel, delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.main import SQLITE_PRAGMAS, Item, Product, clear, create_db_engine
+
+PROFILES = {
+    # Поведение до настройки: rollback journal, synchronous=FULL
+    "default": None,
+    "tuned": SQLITE_PRAGMAS,
+}
+
+
+async def seed(engine, count: int):
+    async with AsyncSession(engine) as session:
+        session.add_all(
+            Product(name=f"Товар {i}", clear_name=clear(f"Товар {i}"))
+            for i in range(count)
+        )
+        await session.commit()
+
+
+async def reader(engine, deadline: float, stats: dict):
+    while time.perf_counter() < deadline:
+        async with AsyncSession(engine) as session:
+            query = (
+                select(Product, Item)
+                .join(Item, isouter=True)
+                .where(Product.clear_name.like("товар 1%"))
+                .order_by(Product.clear_name)
+                .limit(50)
+            )
+            (await session.exec(query)).all()
+        stats["reads"] += 1
+
+
+async def writer(engine, deadline: float, products: range, stats: dict):
+    """Переключения продуктов своего диапазона: продукт в списке один раз"""
+    listed = set()
+    for product_id in itertools.cycle(products):
+        if time.perf_counter() >= deadline:
+            break
+        async with AsyncSession(engine) as session:
+            if product_id in listed:
+                await session.exec(delete(Item).where(Item.product_id == product_id))
+                listed.discard(product_id)
+            else:
+                session.add(Item(product_id=product_id))
+                listed.add(product_id)
+            await session.commit()
+        stats["writes"] += 1
+
+
+async def run_profile(name: str, args):
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        engine = create_db_engine(
+            url,
+            pragmas=PROFILES[name],
+            pool_size=args.readers + args.writers,
+        )
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        await seed(engine, args.products)
+
+        stats = {"reads": 0, "writes": 0}
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(
+            *(reader(engine, deadline, stats) for _ in range(args.readers)),
+            # Непересекающиеся диапазоны продуктов у писателей
+            *(
+                writer(
+                    engine,
+                    deadline,
+                    range(n + 1, args.products + 1, args.writers),
+                    stats,
+                )
+                for n in range(args.writers)
+            ),
+        )
+        await engine.dispose()
+
+    return {key: value / args.duration for key, value in stats.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=10_000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{'profile':<10}{'reads/s':>12}{'writes/s':>12}")
+    for name in PROFILES:
+        result = asyncio.run(run_profile(name, args))
+        print(f"{name:<10}{result['reads']:>12.1f}{result['writes']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
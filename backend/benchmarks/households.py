@@ -0,0 +1,197 @@
+"""Запросы множества домохозяйств с кэшем сессий и без него
+
+    python -m benchmarks.households --households 5000 --products 20 \\
+        --requests 2000 --concurrency 8
+
+Каждый запрос идет от случайного домохозяйства со своей cookie сессии.
+Кэш сессий выключается через ttl=0: тогда каждый запрос читает сессию из БД.
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import event, insert
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import app.main as app_main
+from app.auth import SessionCache, token_hash
+from app.events import Broadcaster
+from app.main import (
+    Household,
+    HouseholdSession,
+    Item,
+    Product,
+    app,
+    clear,
+    create_db_engine,
+    create_search_index,
+    get_db,
+)
+from app.versions import ChangeCursor, DataVersion
+
+from .load import percentile
+from .seed import NOUNS, product_names
+
+HTMX = {"HX-Request": "true"}
+
+
+def session_token(household_id: int):
+    return "bench-{}".format(household_id)
+
+
+async def seed_households(engine, households: int, products: int, items: int):
+    """Домохозяйства с каталогом, списком покупок и сессией каждое"""
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    names = product_names(households * products)
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        await connection.run_sync(create_search_index)
+        for start in range(1, households + 1, 1000):
+            ids = range(start, min(start + 1000, households + 1))
+            await connection.execute(
+                insert(Household), [{"id": h, "name": str(h)} for h in ids]
+            )
+            await connection.execute(
+                insert(HouseholdSession),
+                [
+                    {
+                        "token_hash": token_hash(session_token(h)),
+                        "household_id": h,
+                        "expires_at": expires_at,
+                    }
+                    for h in ids
+                ],
+            )
+            rows = [
+                {"household_id": h, "name": name, "clear_name": clear(name)}
+                for h in ids
+                for name in itertools.islice(names, products)
+            ]
+            result = await connection.execute(
+                insert(Product).returning(Product.id, Product.household_id), rows
+            )
+            product_rows = result.all()
+            await connection.execute(
+                insert(Item),
+                [
+                    {"product_id": product_id, "household_id": h}
+                    for n, (product_id, h) in enumerate(product_rows)
+                    if n % products < items
+                ],
+            )
+
+
+async def run_mode(client, args, ttl: float, queries: list):
+    app_main.session_cache = SessionCache(ttl)
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def worker(seed: int):
+        nonlocal errors
+        rnd = random.Random(seed)
+        for n in counter:
+            if n >= args.requests:
+                return
+            household_id = rnd.randint(1, args.households)
+            if n % 2:
+                url, params = "/products/", {"name": rnd.choice(NOUNS)[:4]}
+            else:
+                url, params = "/", {}
+            start = time.perf_counter()
+            response = await client.get(
+                url,
+                params=params,
+                headers=HTMX,
+                cookies={"session": session_token(household_id)},
+            )
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+
+    queries.clear()
+    await asyncio.gather(*(worker(seed) for seed in range(args.concurrency)))
+    stats = app_main.session_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return {
+        "cache": "on" if ttl else "off",
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "queries_per_request": len(queries) / args.requests,
+        "session_queries_per_request": sum(
+            "household_session" in query for query in queries
+        )
+        / args.requests,
+        "hit_ratio": stats["hits"] / lookups if lookups else 0.0,
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        start = time.perf_counter()
+        await seed_households(engine, args.households, args.products, args.items)
+        print("seed: {:.1f} s".format(time.perf_counter() - start))
+
+        queries = []
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            lambda *args: queries.append(args[2]),
+        )
+
+        async def get_db_override():
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                await app_main.sync_caches(session)
+                yield session
+
+        app.dependency_overrides[get_db] = get_db_override
+        app_main.data_version = DataVersion()
+        app_main.cache_cursor = ChangeCursor()
+        app_main.broadcaster = Broadcaster()
+        app_main.fragments.clear()
+
+        print(
+            "{:<6} {:>8} {:>8} {:>6} {:>10} {:>9}".format(
+                "cache", "p50 ms", "p95 ms", "q/req", "session q", "hit ratio"
+            )
+        )
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for ttl in (0, args.ttl):
+                result = await run_mode(client, args, ttl, queries)
+                print(
+                    "{cache:<6} {p50_ms:>8.2f} {p95_ms:>8.2f} "
+                    "{queries_per_request:>6.2f} {session_queries_per_request:>10.2f} "
+                    "{hit_ratio:>9.2f}".format(**result)
+                )
+
+        app.dependency_overrides.clear()
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--households", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=20, help="на домохозяйство")
+    parser.add_argument("--items", type=int, default=5, help="на домохозяйство")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ttl", type=float, default=60, help="TTL кэша сессий")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Нагрузочный тест эндпоинтов на больших каталогах
+
+    python -m benchmarks.load --products 10000,100000 --concurrency 8 \\
+        --requests 500 --output results.json
+
+Приложение запускается в процессе через httpx.ASGITransport, для каждого
+размера каталога создается отдельная временная БД.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy import event
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import app.main as app_main
+from app.events import Broadcaster
+from app.main import app, create_db_engine, get_db
+from app.versions import DataVersion
+
+from .seed import NOUNS, seed_database
+
+HTMX = {"HX-Request": "true"}
+
+
+def search_request(rnd: random.Random, n: int):
+    return "GET", "/products/", {"params": {"name": rnd.choice(NOUNS)[:4]}}
+
+
+def index_request(rnd: random.Random, n: int):
+    return "GET", "/", {}
+
+
+def quick_add_request(rnd: random.Random, n: int):
+    return "POST", "/products/quick_add", {"data": {"name": f"Новый товар {n}"}}
+
+
+SCENARIOS = {
+    "search": search_request,
+    "index": index_request,
+    "quick_add": quick_add_request,
+}
+
+
+def percentile(values: list, q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_scenario(client, name: str, requests: int, concurrency: int, queries):
+    make_request = SCENARIOS[name]
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def worker(seed: int):
+        nonlocal errors
+        rnd = random.Random(seed)
+        for n in counter:
+            if n >= requests:
+                return
+            method, url, kwargs = make_request(rnd, n)
+            start = time.perf_counter()
+            response = await client.request(method, url, headers=HTMX, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+
+    queries.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "endpoint": name,
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "queries_per_request": len(queries) / requests,
+    }
+
+
+async def run_size(products: int, args):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        start = time.perf_counter()
+        await seed_database(engine, products, min(args.items, products))
+        seed_time = time.perf_counter() - start
+
+        queries = []
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            lambda *args: queries.append(args[2]),
+        )
+
+        async def get_db_override():
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                yield session
+
+        app.dependency_overrides[get_db] = get_db_override
+        app_main.data_version = DataVersion()
+        app_main.broadcaster = Broadcaster()
+        app_main.fragments.clear()
+
+        results = []
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for name in args.scenarios:
+                result = await run_scenario(
+                    client, name, args.requests, args.concurrency, queries
+                )
+                result.update(products=products, seed_seconds=seed_time)
+                results.append(result)
+                print(
+                    "{products:>9} {endpoint:<10} {throughput:>9.1f} {p50_ms:>8.2f} "
+                    "{p95_ms:>8.2f} {p99_ms:>8.2f} {queries_per_request:>6.2f}".format(
+                        **result
+                    )
+                )
+
+        app.dependency_overrides.clear()
+        await engine.dispose()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", default="10000", help="размеры через запятую")
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS), help="через запятую"
+    )
+    parser.add_argument("--output", help="JSON файл с результатами")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+
+    print(
+        "{:>9} {:<10} {:>9} {:>8} {:>8} {:>8} {:>6}".format(
+            "products", "endpoint", "req/s", "p50 ms", "p95 ms", "p99 ms", "q/req"
+        )
+    )
+    results = []
+    for products in map(int, args.products.split(",")):
+        results.extend(asyncio.run(run_size(products, args)))
+
+    if args.output:
+        report = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "concurrency": args.concurrency,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Синтетические данные для бенчмарков"""
+
+import random
+
+from sqlalchemy import insert
+from sqlmodel import SQLModel
+
+from app.main import Item, Product, clear, create_search_index
+
+ADJECTIVES = [
+    "Свежий",
+    "Домашний",
+    "Органический",
+    "Копченый",
+    "Сладкий",
+    "Острый",
+    "Fresh",
+    "Organic",
+    "Classic",
+    "Smoked",
+    "Sweet",
+    "Spicy",
+    "🍏",
+]
+NOUNS = [
+    "хлеб",
+    "сыр",
+    "творог",
+    "йогурт",
+    "кефир",
+    "чай",
+    "кофе",
+    "соус",
+    "молоко",
+    "яблоки",
+    "картофель",
+    "ёжевика",
+    "bread",
+    "cheese",
+    "yogurt",
+    "coffee",
+    "sauce",
+    "pasta",
+    "apples",
+]
+BRANDS = ["Простоквашино", "Вкусвилл", "Lipton", "Barilla", "Heinz", "Danone", ""]
+
+
+def product_names(count: int, seed: int = 0):
+    """Уникальные названия продуктов на кириллице и латинице"""
+    rnd = random.Random(seed)
+    for i in range(count):
+        words = [rnd.choice(ADJECTIVES), rnd.choice(NOUNS), rnd.choice(BRANDS)]
+        yield "{} {}".format(" ".join(word for word in words if word), i)
+
+
+async def seed_database(engine, products: int, items: int, chunk_size: int = 10_000):
+    """Таблицы и products продуктов, первые items из них в списке покупок"""
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        await connection.run_sync(create_search_index)
+
+        chunk = []
+        for name in product_names(products):
+            chunk.append({"name": name, "clear_name": clear(name)})
+            if len(chunk) == chunk_size:
+                await connection.execute(insert(Product), chunk)
+                chunk = []
+        if chunk:
+            await connection.execute(insert(Product), chunk)
+
+        rows = [{"product_id": product_id} for product_id in range(1, items + 1)]
+        if rows:
+            await connection.execute(insert(Item), rows)
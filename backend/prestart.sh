@@ -0,0 +1,7 @@
+#! /usr/bin/env sh
+set -e
+
+# Образ запускает скрипт один раз перед стартом воркеров
+python -m app.migrations
+# Байткод шаблонов в общем каталоге, воркеры не разбирают шаблоны заново
+python -c "from app.main import load_templates; load_templates()"